@@ -7,6 +7,7 @@ from contextlib import contextmanager
 
 from libhoney import Client, IsClassicKey
 from beeline.trace import SynchronousTracer
+from beeline.batch import BatchHookWorker
 from beeline.version import VERSION
 from beeline import internal
 import beeline.propagation.default
@@ -62,12 +63,16 @@ class Beeline(object):
                  transmission_impl=None, sampler_hook=None, presend_hook=None,
                  http_trace_parser_hook=beeline.propagation.default.http_trace_parser_hook,
                  http_trace_propagation_hook=beeline.propagation.default.http_trace_propagation_hook,
-                 debug=False):
+                 debug=False, head_sampling=False, respect_parent_sampling=False,
+                 deterministic_sampler=None, id_generator=None,
+                 batch_sampler_hook=None, batch_presend_hook=None, trace_buffer=None,
+                 propagation_policy=None):
 
         self.client = None
         self.tracer_impl = None
         self.presend_hook = None
         self.sampler_hook = None
+        self.batch_worker = None
         self.http_trace_parser_hook = None
         self.http_trace_propagation_hook = None
 
@@ -150,6 +155,9 @@ class Beeline(object):
         else:
             beeline.propagation.propagate_dataset = False
 
+        if id_generator is not None:
+            beeline.trace.set_id_generator(id_generator)
+
         self.log('initialized honeycomb client: writekey=%s dataset=%s service_name=%s',
                  writekey, dataset, service_name)
 
@@ -167,6 +175,17 @@ class Beeline(object):
             sampler=sampler_hook,
             http_trace_parser=http_trace_parser_hook,
             http_trace_propagation=http_trace_propagation_hook)
+        self.tracer_impl.head_sampling = head_sampling
+        self.tracer_impl.respect_parent_sampling = respect_parent_sampling
+        self.tracer_impl.deterministic_sampler = deterministic_sampler
+        if batch_sampler_hook or batch_presend_hook:
+            self.batch_worker = BatchHookWorker(
+                sampler_hook=batch_sampler_hook, presend_hook=batch_presend_hook,
+                max_batch_size=max_batch_size, send_frequency=send_frequency,
+                block_on_send=block_on_send)
+            self.tracer_impl.batch_worker = self.batch_worker
+        self.tracer_impl.trace_buffer = trace_buffer
+        self.tracer_impl.propagation_policy = propagation_policy
         self.sampler_hook = sampler_hook
         self.presend_hook = presend_hook
         self.http_trace_parser_hook = http_trace_parser_hook
@@ -298,7 +317,9 @@ class Beeline(object):
             self.log("executing presend hook on event ev = %s", ev.fields())
             self.presend_hook(ev.fields())
 
-        if presampled:
+        if self.batch_worker:
+            self.batch_worker.send(ev, presampled=presampled)
+        elif presampled:
             self.log("enqueuing presampled event ev = %s", ev.fields())
             ev.send_presampled()
         else:
@@ -323,6 +344,9 @@ class Beeline(object):
         return self.client.responses()
 
     def close(self):
+        # hand any events waiting on the batch hooks to libhoney first
+        if self.batch_worker:
+            self.batch_worker.close()
         if self.client:
             self.client.close()
 
@@ -348,6 +372,42 @@ def init(writekey='', dataset='', service_name='', tracer=None,
             The functon should accept a dictionary of event fields, and can be used
             to add new fields, modify/scrub existing fields, or drop fields. This
             function is called after sampler_hook, if sampler_hook is set.
+    - `head_sampling`: if True, the deterministic sampling decision is made once
+            when a trace starts. Spans in traces that won't be sent then skip
+            collecting fields entirely; trace and span IDs are still generated
+            so propagation headers keep working. Has no effect if
+            `sampler_hook` is set, since that needs each event's fields.
+    - `respect_parent_sampling`: if True, traces continued from an upstream
+            service whose propagation headers carry a sampling decision, like
+            the W3C traceparent's sampled flag, B3 or Jaeger, drop the traces
+            the upstream didn't sample. Their spans skip collecting fields, as
+            with `head_sampling`. Traces it did sample are still sampled on
+            the trace ID at `sample_rate`, as are traces without a decision.
+            Either way, the upstream's decision is passed on to downstream
+            services unchanged.
+    - `deterministic_sampler`: if set, a function of (trace_id, sample_rate) that
+            returns whether a trace should be sent, used when `sampler_hook` is
+            not set. Defaults to a SHA1 hash of the trace ID, which makes the
+            same decisions as the other beelines. See
+            `beeline.trace.trace_id_ratio_sampler` for a cheaper alternative.
+    - `id_generator`: if set, a `beeline.trace.IdGenerator` used to generate
+            all new trace and span IDs.
+    - `batch_sampler_hook`: like `sampler_hook`, but accepts a list of event
+            field dicts and returns a list of (bool, int) tuples, one per
+            event. Batch hooks run on a background thread, in batches of up
+            to `max_batch_size` events, before the events are handed to
+            libhoney. Runs after `sampler_hook` and `presend_hook`, if set.
+    - `batch_presend_hook`: like `presend_hook`, but accepts a list of event
+            field dicts to modify in place. Runs on the same background thread,
+            after `batch_sampler_hook`.
+    - `trace_buffer`: if set, a `beeline.tail_sampling.TraceBuffer` that holds
+            each trace's spans until its root span finishes, then samples the
+            whole trace. Replaces deterministic sampling. Spans it keeps still
+            go through the other hooks. See `beeline.dynsampler` for trace
+            samplers that pick rates per key from recent traffic.
+    - `propagation_policy`: if set, a `beeline.propagation.PropagationPolicy`
+            that limits which trace fields are propagated to downstream
+            services, and how large they may get.
 
     If in doubt, just set `writekey` and `dataset` and move on!
     '''
@@ -0,0 +1,131 @@
+''' Batched sampler and presend hooks.
+
+The regular `sampler_hook` and `presend_hook` run once per event, on the
+thread that finishes the span. Batch hooks instead receive lists of finished
+events' field dicts and run on a background thread, before the events are
+handed to libhoney, so that expensive work like scrubbing is amortized over
+many events and kept off the request path.
+'''
+import os
+import queue
+import threading
+import time
+
+from beeline.internal import log, stringify_exception
+
+
+class BatchHookWorker(object):
+    ''' Collects finished events, runs the batch hooks over them on a
+    background thread and sends the events that were kept.
+
+    - `sampler_hook`: accepts a list of event field dicts and returns a list
+            with a (bool, int) tuple for each, with the same meaning as the
+            return value of `sampler_hook`.
+    - `presend_hook`: accepts the list of field dicts of the events that were
+            kept, and can modify each of them in place.
+
+    Events are batched until there are `max_batch_size` of them or
+    `send_frequency` seconds have passed since the first. If the hooks raise,
+    the batch is dropped rather than sent unscrubbed.
+    '''
+
+    def __init__(self, sampler_hook=None, presend_hook=None, max_batch_size=100,
+                 send_frequency=0.25, max_queue_size=10000, block_on_send=False):
+        self.sampler_hook = sampler_hook
+        self.presend_hook = presend_hook
+        self._max_batch_size = max_batch_size
+        self._send_frequency = send_frequency
+        self._max_queue_size = max_queue_size
+        self._block_on_send = block_on_send
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        # held while the worker thread is started or stopped
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # also called after a fork, since the worker thread doesn't survive it
+        with self._lock:
+            if self._pid == os.getpid():
+                # another thread's first send started it
+                return
+            self._queue = queue.Queue(self._max_queue_size)
+            self._thread = threading.Thread(
+                target=self._run, args=(self._queue,), name='honeycomb-beeline-batch-hooks', daemon=True)
+            self._thread.start()
+            # set last, so threads that see it also see the queue
+            self._pid = os.getpid()
+
+    def send(self, ev, presampled=True):
+        ''' Queues an event to have the batch hooks run over it. '''
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put((ev, presampled), block=self._block_on_send)
+        except queue.Full:
+            log("batch hook queue is full, dropping event ev = %s", ev.fields())
+
+    def close(self):
+        ''' Runs the hooks over any queued events, sends them and stops the
+        worker thread. '''
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            worker_queue, thread = self._queue, self._thread
+            self._thread = None
+            self._pid = None
+        worker_queue.put(None)
+        thread.join()
+
+    def _run(self, worker_queue):
+        # the queue is passed in, so a worker started after a fork or close
+        # never takes another worker's items
+        closing = False
+        while not closing:
+            item = worker_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self._send_frequency
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = worker_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            if self.sampler_hook:
+                log("executing batch sampler hook on %d events", len(batch))
+                decisions = self.sampler_hook([ev.fields() for ev, _ in batch])
+                if len(decisions) != len(batch):
+                    raise ValueError(
+                        f"batch sampler hook returned {len(decisions)} decisions for {len(batch)} events")
+                kept = []
+                for (ev, _), (keep, new_rate) in zip(batch, decisions):
+                    if keep:
+                        ev.sample_rate = new_rate
+                        kept.append((ev, True))
+                batch = kept
+
+            if self.presend_hook and batch:
+                log("executing batch presend hook on %d events", len(batch))
+                self.presend_hook([ev.fields() for ev, _ in batch])
+        except Exception as e:
+            log("error running batch hooks, dropping %d events: %s",
+                len(batch), stringify_exception(e))
+            return
+
+        for ev, presampled in batch:
+            if presampled:
+                ev.send_presampled()
+            else:
+                ev.send()
@@ -0,0 +1,463 @@
+''' Benchmarks for the beeline's instrumentation hot path.
+
+Each benchmark runs against a beeline initialized with a transmission that
+drops every event, so only the cost of the instrumentation itself is measured.
+For each benchmark we report:
+
+- `ns/op`: wall time per operation, the best of several timed runs
+- `alloc B/op`: the high water mark of memory allocated during one operation,
+  as traced by `tracemalloc`
+- `retained B/op`: memory still allocated once the operation has finished,
+  which should stay at zero unless something is leaking
+
+Results can be saved as a baseline and later runs compared against it:
+
+    poetry run bench --save baseline.json
+    poetry run bench --compare baseline.json
+
+The size of the trace headers each propagation format produces for the same
+context is printed after the results.
+
+When comparing, the command exits non-zero if any benchmark got slower or
+allocates more than the baseline by more than `--threshold`.
+'''
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import queue
+import sys
+import tracemalloc
+
+import beeline
+from beeline import timing
+from beeline.propagation import DictRequest, PropagationContext
+from beeline.propagation import b3, compact, honeycomb, jaeger, w3c
+
+BASELINE_VERSION = 1
+
+_BENCHMARKS = []
+
+
+class NullTransmission(object):
+    ''' A transmission that drops every event it is given. '''
+
+    def __init__(self):
+        self._responses = queue.Queue()
+
+    def start(self):
+        pass
+
+    def send(self, ev):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._responses.put(None)
+
+    def get_response_queue(self):
+        return self._responses
+
+
+def benchmark(name, is_async=False):
+    ''' Registers a benchmark. The decorated function must return a context
+    manager yielding the operation to measure. Setup and teardown happen
+    outside the measured loop. If `is_async` is set, the operation is a
+    coroutine function and the benchmark runs in an event loop. '''
+    def register(fn):
+        _BENCHMARKS.append((name, contextlib.contextmanager(fn), is_async))
+        return fn
+    return register
+
+
+@contextlib.contextmanager
+def _initialized_beeline():
+    beeline.init(writekey='benchmark', service_name='benchmark',
+                 transmission_impl=NullTransmission())
+    try:
+        yield beeline.get_beeline()
+    finally:
+        beeline.close()
+
+
+@benchmark('tracer')
+def bench_tracer():
+    def op():
+        with beeline.tracer('bench'):
+            pass
+    yield op
+
+
+@benchmark('tracer.child')
+def bench_tracer_child():
+    def op():
+        with beeline.tracer('bench'):
+            pass
+    with beeline.tracer('root'):
+        yield op
+
+
+def _start_finish_span(depth):
+    def bench_start_finish_span():
+        tracer = beeline.get_beeline().tracer_impl
+        root = tracer.start_trace(context={'name': 'root'})
+        parents = [tracer.start_span(context={'name': 'parent'}) for _ in range(depth - 1)]
+
+        def op():
+            tracer.finish_span(tracer.start_span(context={'name': 'bench'}))
+        try:
+            yield op
+        finally:
+            for span in reversed(parents):
+                tracer.finish_span(span)
+            tracer.finish_trace(root)
+    return bench_start_finish_span
+
+
+for _depth in (1, 8, 32):
+    benchmark(f'start_finish_span.depth_{_depth}')(_start_finish_span(_depth))
+
+
+@benchmark('add_context_field')
+def bench_add_context_field():
+    def op():
+        beeline.add_context_field('bench.field', 1)
+    with beeline.tracer('root'):
+        yield op
+
+
+@benchmark('add_rollup_field')
+def bench_add_rollup_field():
+    def op():
+        beeline.add_rollup_field('bench.duration_ms', 1.5)
+    with beeline.tracer('root'):
+        yield op
+
+
+@benchmark('traced.sync')
+def bench_traced_sync():
+    @beeline.traced('bench')
+    def op():
+        pass
+    yield op
+
+
+@benchmark('traced.generator')
+def bench_traced_generator():
+    @beeline.traced('bench')
+    def gen():
+        yield 1
+
+    def op():
+        for _ in gen():
+            pass
+    yield op
+
+
+@benchmark('traced.async', is_async=True)
+def bench_traced_async():
+    @beeline.traced('bench')
+    async def op():
+        pass
+    yield op
+
+
+def _propagation_context():
+    return PropagationContext(
+        trace_id='b2ff4d46b1f7ea2d9d2e7af72dd1bbe7',
+        parent_id='2bcb0e5a1d7ed1a0',
+        trace_fields={'app.user_id': 12345, 'app.tenant': 'bench'},
+        dataset='benchmark')
+
+
+@benchmark('propagation.honeycomb.marshal')
+def bench_honeycomb_marshal():
+    context = _propagation_context()
+
+    def op():
+        honeycomb.http_trace_propagation_hook(context)
+    yield op
+
+
+@benchmark('propagation.honeycomb.marshal_active_trace')
+def bench_honeycomb_marshal_active_trace():
+    tracer = beeline.get_beeline().tracer_impl
+
+    def op():
+        honeycomb.http_trace_propagation_hook(tracer.get_propagation_context())
+    with beeline.tracer('root'):
+        beeline.add_trace_field('user_id', 12345)
+        beeline.add_trace_field('tenant', 'bench')
+        yield op
+
+
+@benchmark('propagation.honeycomb.unmarshal')
+def bench_honeycomb_unmarshal():
+    request = DictRequest(honeycomb.http_trace_propagation_hook(_propagation_context()))
+
+    def op():
+        honeycomb.http_trace_parser_hook(request)
+    yield op
+
+
+@benchmark('propagation.w3c.marshal')
+def bench_w3c_marshal():
+    context = _propagation_context()
+    context.trace_fields = {'traceflags': '01', 'tracestate': 'vendor=value'}
+
+    def op():
+        w3c.http_trace_propagation_hook(context)
+    yield op
+
+
+@benchmark('propagation.w3c.unmarshal')
+def bench_w3c_unmarshal():
+    context = _propagation_context()
+    context.trace_fields = {'traceflags': '01', 'tracestate': 'vendor=value'}
+    request = DictRequest(w3c.http_trace_propagation_hook(context))
+
+    def op():
+        w3c.http_trace_parser_hook(request)
+    yield op
+
+
+@benchmark('propagation.compact.marshal')
+def bench_compact_marshal():
+    context = _propagation_context()
+
+    def op():
+        compact.http_trace_propagation_hook(context)
+    yield op
+
+
+@benchmark('propagation.compact.marshal_active_trace')
+def bench_compact_marshal_active_trace():
+    tracer = beeline.get_beeline().tracer_impl
+
+    def op():
+        compact.http_trace_propagation_hook(tracer.get_propagation_context())
+    with beeline.tracer('root'):
+        beeline.add_trace_field('user_id', 12345)
+        beeline.add_trace_field('tenant', 'bench')
+        yield op
+
+
+@benchmark('propagation.compact.unmarshal')
+def bench_compact_unmarshal():
+    request = DictRequest(compact.http_trace_propagation_hook(_propagation_context()))
+
+    def op():
+        compact.http_trace_parser_hook(request)
+    yield op
+
+
+@benchmark('propagation.b3.unmarshal')
+def bench_b3_unmarshal():
+    request = DictRequest(b3.http_trace_propagation_hook(_propagation_context()))
+
+    def op():
+        b3.http_trace_parser_hook(request)
+    yield op
+
+
+@benchmark('propagation.jaeger.unmarshal')
+def bench_jaeger_unmarshal():
+    request = DictRequest(jaeger.http_trace_propagation_hook(_propagation_context()))
+
+    def op():
+        jaeger.http_trace_parser_hook(request)
+    yield op
+
+
+def header_sizes():
+    ''' Returns the total size in bytes of the header names and values each
+    propagation format produces for the benchmarks' propagation context. '''
+    context = _propagation_context()
+    w3c_context = _propagation_context()
+    w3c_context.trace_fields = {'traceflags': '01', 'tracestate': 'vendor=value'}
+    sizes = {}
+    for name, headers in (('honeycomb', honeycomb.http_trace_propagation_hook(context)),
+                          ('w3c', w3c.http_trace_propagation_hook(w3c_context)),
+                          ('compact', compact.http_trace_propagation_hook(context))):
+        sizes[name] = sum(len(k) + len(v) for k, v in headers.items())
+    return sizes
+
+
+def _result(best_ns, iterations, alloc, retained, samples):
+    return {
+        'ns_per_op': best_ns / iterations,
+        'alloc_bytes_per_op': alloc / samples,
+        'retained_bytes_per_op': retained / samples,
+    }
+
+
+def _measure(op, iterations, repeat):
+    for _ in range(min(iterations, 1000)):
+        op()
+
+    best_ns = None
+    for _ in range(repeat):
+        start = timing.now_ns()
+        for _ in range(iterations):
+            op()
+        elapsed = timing.now_ns() - start
+        if best_ns is None or elapsed < best_ns:
+            best_ns = elapsed
+
+    samples = min(iterations, 100)
+    alloc = 0
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            # clearing the traces also resets the peak
+            tracemalloc.clear_traces()
+            op()
+            alloc += tracemalloc.get_traced_memory()[1]
+        # measured over a run of operations, so memory that one operation
+        # holds on to until the next is not counted as retained
+        tracemalloc.clear_traces()
+        for _ in range(samples):
+            op()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    return _result(best_ns, iterations, alloc, retained, samples)
+
+
+async def _measure_async(op, iterations, repeat):
+    for _ in range(min(iterations, 1000)):
+        await op()
+
+    best_ns = None
+    for _ in range(repeat):
+        start = timing.now_ns()
+        for _ in range(iterations):
+            await op()
+        elapsed = timing.now_ns() - start
+        if best_ns is None or elapsed < best_ns:
+            best_ns = elapsed
+
+    samples = min(iterations, 100)
+    alloc = 0
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            tracemalloc.clear_traces()
+            await op()
+            alloc += tracemalloc.get_traced_memory()[1]
+        tracemalloc.clear_traces()
+        for _ in range(samples):
+            await op()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    return _result(best_ns, iterations, alloc, retained, samples)
+
+
+def _run_one(factory, is_async, iterations, repeat):
+    if is_async:
+        async def run():
+            # the beeline picks its async tracer when initialized in a running loop
+            with _initialized_beeline():
+                with factory() as op:
+                    return await _measure_async(op, iterations, repeat)
+        return asyncio.run(run())
+
+    with _initialized_beeline():
+        with factory() as op:
+            return _measure(op, iterations, repeat)
+
+
+def run(names=None, iterations=20000, repeat=5):
+    ''' Runs the registered benchmarks and returns a dict of benchmark name
+    to results. If `names` is given, only benchmarks whose name contains one
+    of them are run. '''
+    results = {}
+    for name, factory, is_async in _BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = _run_one(factory, is_async, iterations, repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    ''' Compares results against a baseline's results. Returns a list of
+    (name, metric, baseline value, new value) for each metric that is worse
+    than the baseline by more than `threshold`, a fraction. '''
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('ns_per_op', 'alloc_bytes_per_op'):
+            if result[metric] > base[metric] * (1 + threshold):
+                regressions.append((name, metric, base[metric], result[metric]))
+    return regressions
+
+
+def _print_results(results, baseline):
+    print(f"{'benchmark':<44} {'ns/op':>12} {'alloc B/op':>12} {'retained B/op':>14}")
+    for name, result in results.items():
+        line = (f"{name:<44} {result['ns_per_op']:>12.1f} {result['alloc_bytes_per_op']:>12.1f}"
+                f" {result['retained_bytes_per_op']:>14.1f}")
+        base = baseline.get(name)
+        if base and base['ns_per_op']:
+            change = (result['ns_per_op'] - base['ns_per_op']) / base['ns_per_op']
+            line += f"  ({change:+.1%} ns/op)"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the beeline instrumentation hot path.')
+    parser.add_argument('names', nargs='*',
+                        help='only run benchmarks whose name contains one of these')
+    parser.add_argument('--iterations', type=int, default=20000,
+                        help='operations per timed run (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed runs per benchmark, the best is kept (default: %(default)s)')
+    parser.add_argument('--save', metavar='PATH',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare the results against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction a benchmark may regress by before failing (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('python') != platform.python_version():
+            print(f"warning: baseline was recorded on python {saved.get('python')}, "
+                  f"this is python {platform.python_version()}")
+        baseline = saved['results']
+
+    results = run(args.names, iterations=args.iterations, repeat=args.repeat)
+    _print_results(results, baseline)
+    print()
+    for name, size in header_sizes().items():
+        print(f"{'header size: ' + name:<44} {size:>12} B")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': BASELINE_VERSION,
+                'python': platform.python_version(),
+                'iterations': args.iterations,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, metric, before, after in regressions:
+        print(f"regression: {name} {metric} went from {before:.1f} to {after:.1f}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+''' Dynamic samplers, which pick a sample rate per key from recent traffic.
+
+Rare keys are sampled at or near 1, while the keys that dominate traffic,
+like health checks, get high sample rates. The rates are recomputed from the
+counts seen over each `interval`, following the samplers in Honeycomb's
+dynsampler-go:
+
+- `AvgSampleRate` aims for an average sample rate of `goal_sample_rate`
+  across all events
+- `EMASampleRate` does the same, but from an exponential moving average of
+  the counts, so rates adapt smoothly to bursty traffic
+- `TotalThroughput` aims to send `goal_throughput_per_sec` events a second,
+  shared between the keys
+
+A sampler samples whole traces, at the rate for their root span's key, as
+the trace sampler of a `beeline.tail_sampling.TraceBuffer`:
+
+    beeline.init(..., trace_buffer=TraceBuffer(AvgSampleRate(goal_sample_rate=20)))
+
+It can't be used as a `sampler_hook`: the hook sees each span on its own, and
+only the root span has fields like `request.route`, so the spans of one trace
+would get different rates and decisions. `sample_event` samples single events
+that aren't part of a trace.
+'''
+import math
+import random
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+from beeline.trace import _should_sample
+
+DEFAULT_KEY_FIELDS = ('request.route', 'response.status_code')
+
+
+class _CounterTable(object):
+    ''' Counts events per key in per-thread shards, so that counting an event
+    never takes a lock. '''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._shards = []
+
+    def increment(self, key):
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            with self._lock:
+                local.shard = {}
+                local.generation = self._generation
+                self._shards.append(local.shard)
+        shard = local.shard
+        shard[key] = shard.get(key, 0) + 1
+
+    def swap(self):
+        ''' Returns the counts since the last swap and starts counting afresh.
+        Threads move to new shards the next time they count something. '''
+        with self._lock:
+            shards, self._shards = self._shards, []
+            self._generation += 1
+        totals = {}
+        for shard in shards:
+            for key, count in shard.copy().items():
+                totals[key] = totals.get(key, 0) + count
+        return totals
+
+
+class DynamicSampler(object, metaclass=ABCMeta):
+    ''' Base class for the dynamic samplers. Subclasses implement
+    `compute_rates`.
+
+    - `key_fields`: the event fields whose values make up the key
+    - `interval`: how often, in seconds, sample rates are recomputed
+    '''
+
+    def __init__(self, key_fields=DEFAULT_KEY_FIELDS, interval=30):
+        self.key_fields = tuple(key_fields)
+        self.interval = interval
+        self._counts = _CounterTable()
+        self._rates = {}
+        self._lock = threading.Lock()
+        self._next_update = time.monotonic() + interval
+
+    @abstractmethod
+    def compute_rates(self, counts):
+        ''' Given the event count per key over the last interval, returns the
+        sample rate per key. '''
+        pass
+
+    def key(self, fields):
+        return ','.join(str(fields.get(f, '')) for f in self.key_fields)
+
+    def get_sample_rate(self, key):
+        ''' Counts an event with this key, and returns its sample rate. Keys
+        that weren't seen during the last interval are sampled at 1. '''
+        now = time.monotonic()
+        if now >= self._next_update:
+            self._update(now)
+        self._counts.increment(key)
+        return self._rates.get(key, 1)
+
+    def get_sample_rates(self):
+        ''' Returns the sample rate currently in effect for each key. '''
+        return dict(self._rates)
+
+    def _update(self, now):
+        with self._lock:
+            if now < self._next_update:
+                # another thread got here first
+                return
+            self._next_update = now + self.interval
+            self._rates = self.compute_rates(self._counts.swap())
+
+    def __call__(self, spans):
+        ''' Trace sampler for a `TraceBuffer`: given the fields of every span
+        in a trace, root span last, returns whether to keep the trace and its
+        sample rate. The trace is sampled at the rate for its root span's
+        key, which is counted once per trace. '''
+        if isinstance(spans, dict):
+            raise TypeError('dynamic samplers sample whole traces, use them with a TraceBuffer '
+                            'rather than as a sampler_hook')
+        return self.sample_event(spans[-1])
+
+    def sample_event(self, fields):
+        ''' Returns whether to keep a single event, and its sample rate. The
+        decision is made from the trace ID if the event has one. '''
+        rate = self.get_sample_rate(self.key(fields))
+        trace_id = fields.get('trace.trace_id')
+        if trace_id:
+            keep = _should_sample(trace_id, rate)
+        else:
+            keep = random.randint(1, rate) == 1
+        return keep, rate
+
+
+def _avg_sample_rates(counts, goal_sample_rate):
+    # spread the goal number of events over the keys in proportion to the log
+    # of their counts, so that rare keys are sampled at or near 1. Keys that
+    # need less than their share pass what's left on to the keys after them.
+    rates = {}
+    total = sum(counts.values())
+    log_sum = sum(math.log10(c) for c in counts.values() if c > 1)
+    if not log_sum:
+        return {key: 1 for key in counts}
+
+    goal_ratio = (total / goal_sample_rate) / log_sum
+    extra = 0.0
+    keys_remaining = len(counts)
+    for key in sorted(counts):
+        count = max(1.0, counts[key])
+        goal_for_key = max(1.0, math.log10(count) * goal_ratio)
+        extra_for_key = extra / keys_remaining
+        goal_for_key += extra_for_key
+        extra -= extra_for_key
+        keys_remaining -= 1
+        if count <= goal_for_key:
+            rates[key] = 1
+            extra += goal_for_key - count
+        else:
+            rates[key] = int(math.ceil(count / goal_for_key))
+            extra += goal_for_key - (count / rates[key])
+    return rates
+
+
+class AvgSampleRate(DynamicSampler):
+    ''' Aims for an average sample rate of `goal_sample_rate` over each
+    interval. '''
+
+    def __init__(self, goal_sample_rate=10, key_fields=DEFAULT_KEY_FIELDS, interval=30):
+        super().__init__(key_fields=key_fields, interval=interval)
+        self.goal_sample_rate = goal_sample_rate
+
+    def compute_rates(self, counts):
+        return _avg_sample_rates(counts, self.goal_sample_rate)
+
+
+class EMASampleRate(DynamicSampler):
+    ''' Aims for an average sample rate of `goal_sample_rate`, computed from
+    an exponential moving average of each key's count. `weight` is how much
+    the latest interval counts for, between 0 and 1. Keys whose average drops
+    below `age_out` are forgotten. '''
+
+    def __init__(self, goal_sample_rate=10, weight=0.5, age_out=0.5,
+                 key_fields=DEFAULT_KEY_FIELDS, interval=15):
+        super().__init__(key_fields=key_fields, interval=interval)
+        self.goal_sample_rate = goal_sample_rate
+        self.weight = weight
+        self.age_out = age_out
+        self._averages = {}
+
+    def compute_rates(self, counts):
+        averages = {}
+        for key in set(self._averages) | set(counts):
+            average = (self.weight * counts.get(key, 0) +
+                       (1 - self.weight) * self._averages.get(key, 0))
+            if average >= self.age_out:
+                averages[key] = average
+        self._averages = averages
+        return _avg_sample_rates(averages, self.goal_sample_rate)
+
+
+class TotalThroughput(DynamicSampler):
+    ''' Aims to send `goal_throughput_per_sec` events a second in total,
+    split evenly between the keys seen in each interval. '''
+
+    def __init__(self, goal_throughput_per_sec=100, key_fields=DEFAULT_KEY_FIELDS, interval=30):
+        super().__init__(key_fields=key_fields, interval=interval)
+        self.goal_throughput_per_sec = goal_throughput_per_sec
+
+    def compute_rates(self, counts):
+        if not counts:
+            return {}
+        per_key = max(1.0, self.goal_throughput_per_sec * self.interval / len(counts))
+        return {key: max(1, int(math.ceil(count / per_key))) for key, count in counts.items()}
@@ -16,6 +16,15 @@ def send_all():
         return bl.send_all()
 
 
+def is_sampled():
+    ''' returns False if there is nothing worth recording: either the beeline
+    isn't initialized, or the active trace was dropped by head sampling '''
+    bl = beeline.get_beeline()
+    if bl:
+        return bl.tracer_impl.is_sampled()
+    return False
+
+
 def log(msg, *args, **kwargs):
     bl = beeline.get_beeline()
     if bl:
@@ -0,0 +1,123 @@
+import beeline
+from beeline import timing
+from beeline.aiotrace import AsyncioTracer
+from beeline.middleware.routes import route_template
+from beeline.propagation import Request, lower_header_key
+
+
+class ASGIRequest(Request):
+    def __init__(self, mwname, scope):
+        self._mwname = mwname
+        self._scope = scope
+        # header name -> value, decoded the first time a header is read
+        self._headers = None
+
+    def header(self, key):
+        if self._headers is None:
+            # ASGI servers send header names in lower case
+            self._headers = {k.decode('latin-1'): v.decode('latin-1')
+                             for k, v in self._scope.get('headers', ())}
+        return self._headers.get(lower_header_key(key))
+
+    def method(self):
+        return self._scope.get('method')
+
+    def scheme(self):
+        return self._scope.get('scheme', 'http')
+
+    def host(self):
+        return self.header('host')
+
+    def path(self):
+        return self._scope.get('path')
+
+    def query(self):
+        return self._scope.get('query_string', b'').decode('latin-1')
+
+    def middleware_request(self):
+        return self._scope
+
+    def request_context(self):
+        request_method = self.method()
+        if request_method:
+            trace_name = f"{self._mwname}_http_{request_method.lower()}"
+        else:
+            trace_name = f"{self._mwname}_http"
+
+        client = self._scope.get('client')
+        return {
+            "name": trace_name,
+            "type": "http_server",
+            "request.host": self.host(),
+            "request.method": request_method,
+            "request.path": self.path(),
+            "request.route": route_template(self.path()),
+            "request.remote_addr": client[0] if client else None,
+            "request.content_length": self.header('content-length') or 0,
+            "request.user_agent": self.header('user-agent'),
+            "request.scheme": self.scheme(),
+            "request.query": self.query(),
+        }
+
+
+class HoneyASGIMiddleware(object):
+    ''' Traces each HTTP request to an ASGI application, e.g. Starlette or
+    Django under uvicorn.
+
+    The trace is kept in the `AsyncioTracer`'s context variable, so it
+    follows the request across awaits and into the tasks it starts, while
+    concurrent requests on the same event loop get their own traces. The
+    beeline must be initialized with the event loop running, e.g. in a
+    lifespan startup handler, for it to use the `AsyncioTracer`.
+
+    The trace finishes when the application returns, after the last chunk of
+    a streamed body has been sent, which is passed on as it comes rather
+    than buffered.
+    '''
+
+    def __init__(self, app, mwname="asgi"):
+        self.app = app
+        self._mwname = mwname
+        self._warned = False
+
+    async def __call__(self, scope, receive, send):
+        bl = beeline.get_beeline()
+        if scope['type'] != 'http' or not bl:
+            return await self.app(scope, receive, send)
+
+        tracer = bl.tracer_impl
+        if not isinstance(tracer, AsyncioTracer):
+            if not self._warned:
+                self._warned = True
+                bl.log('warning: HoneyASGIMiddleware needs the beeline to be initialized '
+                       'inside the event loop, not tracing requests')
+            return await self.app(scope, receive, send)
+
+        request = ASGIRequest(self._mwname, scope)
+        root_span = tracer.propagate_and_start_trace(request.request_context(), request)
+        start_time = root_span.start_time
+        body_size = 0
+
+        async def _send(message):
+            nonlocal body_size
+            message_type = message['type']
+            if message_type == 'http.response.start':
+                root_span.add_context_field("response.status_code", message['status'])
+                if start_time is not None:
+                    root_span.add_context_field(
+                        "response.time_to_first_byte_ms", timing.elapsed_ms(start_time))
+            elif message_type == 'http.response.body':
+                body_size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        except Exception as e:
+            root_span.add_context({
+                "request.error": str(type(e)),
+                "request.error_detail": beeline.internal.stringify_exception(e),
+            })
+            raise
+        finally:
+            root_span.add_context_field("response.body_size", body_size)
+            tracer.finish_trace(root_span)
@@ -0,0 +1,163 @@
+import asyncio
+import unittest
+from mock import Mock, patch
+
+import beeline
+from beeline.middleware.asgi import ASGIRequest, HoneyASGIMiddleware
+
+
+def _scope(headers=(), method='GET', path='/hello'):
+    return {
+        'type': 'http',
+        'method': method,
+        'scheme': 'https',
+        'path': path,
+        'query_string': b'a=1',
+        'client': ('10.0.0.1', 51234),
+        'headers': [(k.encode(), v.encode()) for k, v in headers],
+    }
+
+
+class TestASGIRequest(unittest.TestCase):
+    def test_request(self):
+        request = ASGIRequest('asgi', _scope([
+            ('host', 'example.com'),
+            ('x-honeycomb-trace', '1;trace_id=bloop,parent_id=scoop,context=e30K'),
+        ]))
+        self.assertEqual(request.header('X-Honeycomb-Trace'), '1;trace_id=bloop,parent_id=scoop,context=e30K')
+        self.assertIsNone(request.header('traceparent'))
+        self.assertEqual(request.query(), 'a=1')
+        self.assertEqual(request.request_context(), {
+            "name": "asgi_http_get",
+            "type": "http_server",
+            "request.host": "example.com",
+            "request.method": "GET",
+            "request.path": "/hello",
+            "request.route": "/hello",
+            "request.remote_addr": "10.0.0.1",
+            "request.content_length": 0,
+            "request.user_agent": None,
+            "request.scheme": "https",
+            "request.query": "a=1",
+        })
+
+
+class TestHoneyASGIMiddleware(unittest.TestCase):
+    def run_app(self, app, scope):
+        sent = []
+        finished = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            _beeline = beeline.Beeline(transmission_impl=Mock())
+            _beeline.tracer_impl._run_hooks_and_send = finished.append
+            with patch('beeline.get_beeline', return_value=_beeline):
+                await HoneyASGIMiddleware(app)(scope, receive, send)
+            return _beeline
+
+        return asyncio.run(run()), sent, finished
+
+    def test_streamed_response(self):
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            for chunk in (b'hello', b' ', b'world'):
+                await asyncio.sleep(0)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+        _beeline, sent, finished = self.run_app(app, _scope())
+        # the body is passed through as it is sent
+        self.assertEqual([m.get('body') for m in sent], [None, b'hello', b' ', b'world', b''])
+        self.assertEqual(len(finished), 1)
+        fields = finished[0].event.fields()
+        self.assertEqual(fields['name'], 'asgi_http_get')
+        self.assertEqual(fields['response.status_code'], 200)
+        self.assertEqual(fields['response.body_size'], 11)
+        self.assertLessEqual(fields['response.time_to_first_byte_ms'], fields['duration_ms'])
+
+    def test_trace_follows_request_across_awaits(self):
+        trace_ids = []
+
+        async def app(scope, receive, send):
+            with beeline.tracer('child'):
+                await asyncio.sleep(0)
+                trace_ids.append(beeline.get_beeline().tracer_impl.get_active_trace_id())
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        headers = [('traceparent', '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01')]
+        _beeline, _, finished = self.run_app(app, _scope(headers))
+        self.assertEqual(trace_ids, ['0af7651916cd43dd8448eb211c80319c'])
+        self.assertEqual(len(finished), 2)
+        child, root = finished[0], finished[1]
+        self.assertEqual(child.parent_id, root.id)
+        self.assertEqual(root.parent_id, 'b7ad6b7169203331')
+        self.assertIsNone(_beeline.tracer_impl._trace)
+
+    def test_concurrent_requests_are_independent(self):
+        finished = []
+
+        async def app(scope, receive, send):
+            await asyncio.sleep(0.01 if scope['path'] == '/slow' else 0)
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': scope['path'].encode()})
+
+        async def send(message):
+            pass
+
+        async def run():
+            _beeline = beeline.Beeline(transmission_impl=Mock())
+            _beeline.tracer_impl._run_hooks_and_send = finished.append
+            middleware = HoneyASGIMiddleware(app)
+            with patch('beeline.get_beeline', return_value=_beeline):
+                await asyncio.gather(middleware(_scope(path='/slow'), None, send),
+                                     middleware(_scope(path='/fast'), None, send))
+
+        asyncio.run(run())
+        self.assertEqual([s.event.fields()['request.path'] for s in finished], ['/fast', '/slow'])
+        self.assertNotEqual(finished[0].trace_id, finished[1].trace_id)
+
+    def test_exception(self):
+        async def app(scope, receive, send):
+            raise ValueError('nope')
+
+        finished = []
+
+        async def run():
+            _beeline = beeline.Beeline(transmission_impl=Mock())
+            _beeline.tracer_impl._run_hooks_and_send = finished.append
+            with patch('beeline.get_beeline', return_value=_beeline):
+                await HoneyASGIMiddleware(app)(_scope(), None, None)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(run())
+        fields = finished[0].event.fields()
+        self.assertEqual(fields['request.error'], str(ValueError))
+        self.assertEqual(fields['response.body_size'], 0)
+
+    def test_non_http_scope_passed_through(self):
+        app = Mock()
+
+        async def call_app(scope, receive, send):
+            app(scope)
+
+        with patch('beeline.get_beeline') as m_get_beeline:
+            asyncio.run(HoneyASGIMiddleware(call_app)({'type': 'lifespan'}, None, None))
+            m_get_beeline.return_value.tracer_impl.propagate_and_start_trace.assert_not_called()
+        app.assert_called_once_with({'type': 'lifespan'})
+
+    def test_synchronous_tracer_not_used(self):
+        _beeline = beeline.Beeline(transmission_impl=Mock())
+        _beeline.tracer_impl.propagate_and_start_trace = Mock()
+
+        async def app(scope, receive, send):
+            pass
+
+        with patch('beeline.get_beeline', return_value=_beeline):
+            asyncio.run(HoneyASGIMiddleware(app)(_scope(), None, None))
+        _beeline.tracer_impl.propagate_and_start_trace.assert_not_called()
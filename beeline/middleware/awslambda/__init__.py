@@ -1,7 +1,7 @@
 import traceback
 
 import beeline
-from beeline.propagation import Request
+from beeline.propagation import HeaderKeys, Request
 # In Lambda, a cold start is when Lambda has to spin up a new instance of a
 # function to satisfy a request, rather than re-use an existing instance.
 # This usually has a non-trivial effect on latency for the request and is
@@ -47,15 +47,14 @@ class LambdaRequest(Request):
                             self._attributes = event['Records'][0]['messageAttributes']
                             self._type = 'sqs'
             if self._type:
-                self._keymap = {k.lower(): k for k in self._attributes.keys()}
+                self._keys = HeaderKeys(self._attributes)
 
     def header(self, key):
         if not self._type:
             return None
-        lookup_key = key.lower()
-        if lookup_key not in self._keymap:
+        lookup_key = self._keys.find(key)
+        if lookup_key is None:
             return None
-        lookup_key = self._keymap[lookup_key]
         if self._type == 'headers':
             return self._attributes[lookup_key]
         elif self._type == 'sns':
@@ -1,6 +1,7 @@
 import beeline
+from beeline import timing
 from beeline.propagation import Request
-from beeline.middleware.wsgi import WSGIRequest
+from beeline.middleware.wsgi import WSGIRequest, trace_response
 
 
 class HoneyWSGIMiddleware(object):
@@ -9,14 +10,26 @@ class HoneyWSGIMiddleware(object):
         self.app = app
 
     def __call__(self, environ, start_response):
+        start_ns = timing.now_ns()
         wr = WSGIRequest("bottle", environ)
 
         root_span = beeline.propagate_and_start_trace(wr.request_context(), wr)
+        if root_span is None:
+            return self.app(environ, start_response)
 
         def _start_response(status, headers, *args):
             beeline.add_context_field("response.status_code", status)
-            beeline.finish_trace(root_span)
+            # bottle has routed the request by now
+            route = environ.get('bottle.route')
+            if route is not None:
+                beeline.add_context_field("request.route", route.rule)
 
             return start_response(status, headers, *args)
 
-        return self.app(environ, _start_response)
+        try:
+            response = self.app(environ, _start_response)
+        except Exception:
+            beeline.finish_trace(root_span)
+            raise
+        # the trace is finished once the body has been sent
+        return trace_response(environ, response, root_span, start_ns, beeline.finish_trace)
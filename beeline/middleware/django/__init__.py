@@ -1,8 +1,26 @@
 import contextlib
-import datetime
+import inspect
+import math
+from contextvars import ContextVar
 import beeline
-from beeline.propagation import Request
+from beeline import timing
+from beeline.middleware.routes import route_template
+from beeline.propagation import Request, environ_header_key
 from django.db import connections
+from django.db.backends.signals import connection_created
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6, which Django < 4.1 allows. Without a way to mark the
+    # middleware as async, which python >= 3.12 has, it's only sync capable.
+    from inspect import iscoroutinefunction
+    markcoroutinefunction = getattr(inspect, 'markcoroutinefunction', None)
+
+try:
+    from beeline.aiotrace import AsyncioTracer
+except ImportError:
+    AsyncioTracer = None
 
 
 class DjangoRequest(Request):
@@ -15,8 +33,7 @@ class DjangoRequest(Request):
             beeline.get_beeline().log(request.META)
 
     def header(self, key):
-        lookup_key = "HTTP_" + key.upper().replace('-', '_')
-        return self._request.META.get(lookup_key)
+        return self._request.META.get(environ_header_key(key))
 
     def method(self):
         return self._request.method
@@ -38,11 +55,36 @@ class DjangoRequest(Request):
 
 
 class HoneyDBWrapper(object):
+    ''' Traces database queries, as a Django database execute wrapper.
+
+    If `aggregate` is set, the queries made under the same span with the same
+    SQL, e.g. the N queries of an N+1 loop, are folded into one summary span,
+    with the number of queries in `db.call_count`, their total, minimum,
+    maximum and 95th percentile durations, and the rows they affected. A
+    query only made once still gets a span of its own, as do queries that
+    fail or take at least `slow_query_ms`. The summary spans are sent when
+    a query is made under another span, or when `flush` is called, which
+    must happen before the trace finishes.
+    '''
+
+    def __init__(self, aggregate=False, slow_query_ms=None):
+        self.aggregate = aggregate
+        self.slow_query_ms = slow_query_ms
+        # the span the pending queries were made under, and their SQL ->
+        # _QueryGroup, in the order the queries were first made
+        self._parent = None
+        self._groups = {}
 
     def __call__(self, execute, sql, params, many, context):
-        # if beeline has not been initialised, just execute query
-        if not beeline.get_beeline():
+        # if beeline has not been initialised, or the trace won't be sent,
+        # just execute query
+        if not beeline.internal.is_sampled():
             return execute(sql, params, many, context)
+        if self.aggregate:
+            tracer = beeline.get_beeline().tracer_impl
+            parent = tracer.get_active_span()
+            if parent is not None:
+                return self._execute_aggregated(tracer, parent, execute, sql, params, many, context)
 
         vendor = context['connection'].vendor
         trace_name = f"django_{vendor}_query"
@@ -56,10 +98,9 @@ class HoneyDBWrapper(object):
             beeline.add_rollup_field("db.call_count", 1)
 
             try:
-                db_call_start = datetime.datetime.now()
+                db_call_start = timing.now_ns()
                 result = execute(sql, params, many, context)
-                db_call_diff = datetime.datetime.now() - db_call_start
-                duration = db_call_diff.total_seconds() * 1000
+                duration = timing.elapsed_ms(db_call_start)
                 beeline.add_context_field("db.duration", duration)
                 beeline.add_rollup_field("db.total_duration", duration)
             except Exception as e:
@@ -76,15 +117,176 @@ class HoneyDBWrapper(object):
                         "db.rows_affected": context['cursor'].cursor.rowcount,
                     })
 
+    def _execute_aggregated(self, tracer, parent, execute, sql, params, many, context):
+        if parent is not self._parent:
+            self.flush()
+            self._parent = parent
+
+        vendor = context['connection'].vendor
+        fields = {
+            "type": "db",
+            "db.query": sql,
+            "db.query_args": params,
+        }
+        start = timing.now_ns()
+        try:
+            result = execute(sql, params, many, context)
+        except Exception as e:
+            fields["db.error"] = str(type(e))
+            fields["db.error_detail"] = beeline.internal.stringify_exception(e)
+            fields.update(_cursor_fields(vendor, context))
+            _send_query_span(tracer, parent.id, vendor, fields, start, timing.now_ns(), 1)
+            raise
+
+        end = timing.now_ns()
+        duration = timing.elapsed_ms(start, end)
+        cursor_fields = _cursor_fields(vendor, context)
+        if self.slow_query_ms is not None and duration >= self.slow_query_ms:
+            fields["db.duration"] = duration
+            fields.update(cursor_fields)
+            _send_query_span(tracer, parent.id, vendor, fields, start, end, 1, duration)
+            return result
+
+        group = self._groups.get(sql)
+        if group is None:
+            group = self._groups[sql] = _QueryGroup(vendor, params, start)
+        group.add(end, duration, cursor_fields)
+        return result
+
+    def flush(self):
+        ''' Sends the spans of the pending aggregated queries. '''
+        parent, groups = self._parent, self._groups
+        self._parent, self._groups = None, {}
+        if not groups or not beeline.get_beeline():
+            return
+
+        tracer = beeline.get_beeline().tracer_impl
+        for sql, group in groups.items():
+            fields = {
+                "type": "db",
+                "db.query": sql,
+            }
+            total_duration = sum(group.durations)
+            if len(group.durations) == 1:
+                fields["db.query_args"] = group.params
+                fields["db.duration"] = total_duration
+            else:
+                durations = sorted(group.durations)
+                fields.update({
+                    "db.min_duration": durations[0],
+                    "db.max_duration": durations[-1],
+                    # nearest rank
+                    "db.p95_duration": durations[math.ceil(len(durations) * 0.95) - 1],
+                })
+            if group.rows_affected is not None:
+                fields["db.last_insert_id"] = group.last_insert_id
+                fields["db.rows_affected"] = group.rows_affected
+            _send_query_span(tracer, parent.id, group.vendor, fields, group.start, group.end,
+                             len(group.durations), total_duration)
+
+
+class _QueryGroup(object):
+    ''' The aggregated queries made under one span with the same SQL. '''
+
+    __slots__ = ('vendor', 'params', 'start', 'end', 'durations', 'last_insert_id', 'rows_affected')
+
+    def __init__(self, vendor, params, start):
+        self.vendor = vendor
+        # the first query's, sent if it's the only one
+        self.params = params
+        self.start = start
+        self.end = start
+        self.durations = []
+        # only known for postgresql and mysql
+        self.last_insert_id = None
+        self.rows_affected = None
+
+    def add(self, end, duration, cursor_fields):
+        self.end = end
+        self.durations.append(duration)
+        if cursor_fields:
+            self.last_insert_id = cursor_fields["db.last_insert_id"]
+            rows_affected = cursor_fields["db.rows_affected"]
+            if self.rows_affected is None:
+                self.rows_affected = rows_affected
+            elif rows_affected > 0:
+                # the row count is -1 when the driver doesn't know it
+                self.rows_affected = max(self.rows_affected, 0) + rows_affected
+
+
+def _cursor_fields(vendor, context):
+    if vendor in ('postgresql', 'mysql'):
+        return {
+            "db.last_insert_id": getattr(context['cursor'].cursor, 'lastrowid', None),
+            "db.rows_affected": context['cursor'].cursor.rowcount,
+        }
+    return {}
+
+
+def _send_query_span(tracer, parent_id, vendor, fields, start, end, call_count, total_duration=None):
+    # the query has already run, so the span is started and finished after
+    # the fact, with the query's timings
+    fields["name"] = f"django_{vendor}_query"
+    span = tracer.start_span(context=fields, parent_id=parent_id)
+    if span is None:
+        return
+    span.start_time = start
+    tracer.add_rollup_field("db.call_count", call_count)
+    if total_duration is not None:
+        tracer.add_rollup_field("db.total_duration", total_duration)
+    tracer.finish_span(span, end_time=end)
+
+
+# the HoneyDBWrapper of the async request being handled
+_request_db_wrapper = ContextVar('beeline_django_db_wrapper', default=None)
+
+
+def _dispatch_query(execute, sql, params, many, context):
+    db_wrapper = _request_db_wrapper.get()
+    if db_wrapper is None:
+        return execute(sql, params, many, context)
+    return db_wrapper(execute, sql, params, many, context)
+
+
+def _install_query_dispatch(sender, connection, **kwargs):
+    # connection_created is sent again each time a connection reconnects
+    if _dispatch_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_dispatch_query)
+
 
 class HoneyMiddlewareBase(object):
+    ''' Traces each request. Works with both the WSGI and ASGI handlers: if
+    the rest of the middleware chain is async, so is this middleware, so
+    Django doesn't have to run it in a thread.
+
+    Async requests are only traced if the beeline uses the `AsyncioTracer`,
+    which keeps each request's trace separate, so it must be initialized
+    with the event loop running, e.g. in asgi.py under uvicorn.
+    '''
+
+    sync_capable = True
+    async_capable = markcoroutinefunction is not None
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self._warned = False
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+            # Django runs the sync hooks of async middleware in a thread, but
+            # adding fields doesn't block. Django always calls
+            # process_exception synchronously, so it has no async version.
+            if type(self).process_view is HoneyMiddlewareBase.process_view:
+                self.process_view = self.process_view_async
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.create_http_event(request)
         return response
 
+    async def __acall__(self, request):
+        return await self.create_http_event_async(request)
+
     def get_context_from_request(self, request):
         trace_name = f"django_http_{request.method.lower()}"
         return {
@@ -93,6 +295,8 @@ class HoneyMiddlewareBase(object):
             "request.host": request.get_host(),
             "request.method": request.method,
             "request.path": request.path,
+            # replaced by the resolved route in process_view
+            "request.route": route_template(request.path),
             "request.remote_addr": request.META.get('REMOTE_ADDR'),
             "request.content_length": request.META.get('CONTENT_LENGTH', 0),
             "request.user_agent": request.META.get('HTTP_USER_AGENT'),
@@ -112,15 +316,37 @@ class HoneyMiddlewareBase(object):
         if not beeline.get_beeline():
             return self.get_response(request)
 
+        root_span = self._start_http_trace(request)
+        response = self.get_response(request)
+        self._finish_http_trace(request, response, root_span)
+        return response
+
+    async def create_http_event_async(self, request):
+        bl = beeline.get_beeline()
+        # if beeline has not been initialised, just execute request
+        if not bl:
+            return await self.get_response(request)
+        if AsyncioTracer is None or not isinstance(bl.tracer_impl, AsyncioTracer):
+            if not self._warned:
+                self._warned = True
+                bl.log('warning: the beeline must be initialized inside the event loop '
+                       'to trace async Django requests, not tracing requests')
+            return await self.get_response(request)
+
+        root_span = self._start_http_trace(request)
+        response = await self.get_response(request)
+        self._finish_http_trace(request, response, root_span)
+        return response
+
+    def _start_http_trace(self, request):
         # Code to be executed for each request before
         # the view (and later middleware) are called.
         dr = DjangoRequest(request)
 
         request_context = self.get_context_from_request(request)
-        root_span = beeline.propagate_and_start_trace(request_context, dr)
-
-        response = self.get_response(request)
+        return beeline.propagate_and_start_trace(request_context, dr)
 
+    def _finish_http_trace(self, request, response, root_span):
         # Code to be executed for each request/response after
         # the view is called.
         response_context = self.get_context_from_response(request, response)
@@ -132,23 +358,41 @@ class HoneyMiddlewareBase(object):
         def wrap_streaming_content(content):
             for chunk in content:
                 yield chunk
-            beeline.finish_trace(root_span)
+            self._finish_trace(request, root_span)
+
+        async def wrap_async_streaming_content(content):
+            async for chunk in content:
+                yield chunk
+            self._finish_trace(request, root_span)
 
         if response.streaming:
-            response.streaming_content = wrap_streaming_content(
-                response.streaming_content
-            )
+            if getattr(response, 'is_async', False):
+                # Django >= 4.2 streams async iterators without a thread
+                response.streaming_content = wrap_async_streaming_content(
+                    response.streaming_content
+                )
+            else:
+                response.streaming_content = wrap_streaming_content(
+                    response.streaming_content
+                )
         else:
-            beeline.finish_trace(root_span)
+            self._finish_trace(request, root_span)
 
-        return response
+    def _finish_trace(self, request, root_span):
+        beeline.finish_trace(root_span)
 
     def process_exception(self, request, exception):
         if beeline.get_beeline():
             beeline.add_context_field(
                 "request.error_detail", beeline.internal.stringify_exception(exception))
 
-    def process_view(self, request, view_func, view_args, view_kwargs):
+    def process_view(self, request, view_func, view_args, view_kwargs):  # pylint: disable=method-hidden
+        self._add_view_context(request, view_func)
+
+    async def process_view_async(self, request, view_func, view_args, view_kwargs):
+        self._add_view_context(request, view_func)
+
+    def _add_view_context(self, request, view_func):
         if beeline.get_beeline():
             try:
                 beeline.add_context_field("django.view_func", view_func.__name__)
@@ -166,9 +410,38 @@ class HoneyMiddlewareHttp(HoneyMiddlewareBase):
 
 
 class HoneyMiddleware(HoneyMiddlewareBase):
+    ''' Traces each request and the database queries it makes.
+
+    To fold repeated queries into summary spans, set `aggregate_queries` on
+    a subclass, and optionally `slow_query_ms`; see `HoneyDBWrapper`.
+    '''
+
+    aggregate_queries = False
+    slow_query_ms = None
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(self):
+            # Under ASGI, sync views run on worker threads shared by all
+            # requests, as are those threads' connections, so they can't be
+            # wrapped per request. Each connection instead gets one wrapper,
+            # when it connects, that passes the queries on to the current
+            # request's wrapper.
+            connection_created.connect(_install_query_dispatch,
+                                       dispatch_uid='beeline_django_query_dispatch')
+
+    def _db_wrapper(self, request):
+        db_wrapper = HoneyDBWrapper(aggregate=self.aggregate_queries, slow_query_ms=self.slow_query_ms)
+        if self.aggregate_queries:
+            # the queries are flushed when the trace finishes
+            request._honey_db_wrapper = db_wrapper  # pylint: disable=protected-access
+        return db_wrapper
+
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         try:
-            db_wrapper = HoneyDBWrapper()
+            db_wrapper = self._db_wrapper(request)
             # db instrumentation is only present in Django > 2.0
             with contextlib.ExitStack() as stack:
                 for connection in connections.all():
@@ -194,6 +467,29 @@ class HoneyMiddleware(HoneyMiddlewareBase):
 
         return response
 
+    def _finish_trace(self, request, root_span):
+        db_wrapper = getattr(request, '_honey_db_wrapper', None)
+        if db_wrapper is not None:
+            db_wrapper.flush()
+        super()._finish_trace(request, root_span)
+
+    async def __acall__(self, request):
+        if not beeline.get_beeline():
+            return await self.get_response(request)
+
+        # sync_to_async runs the views in a copy of this context
+        token = _request_db_wrapper.set(self._db_wrapper(request))
+        try:
+            response = await self.create_http_event_async(request)
+        except BaseException:
+            _request_db_wrapper.reset(token)
+            raise
+        # streaming content is sent from this request's task, so the wrapper
+        # is left set for its queries
+        if not response.streaming:
+            _request_db_wrapper.reset(token)
+        return response
+
 
 class HoneyMiddlewareWithPOST(HoneyMiddleware):
     ''' HoneyMiddlewareWithPOST is a subclass of HoneyMiddleware. The only difference is that
@@ -208,6 +504,8 @@ class HoneyMiddlewareWithPOST(HoneyMiddleware):
             "request.host": request.get_host(),
             "request.method": request.method,
             "request.path": request.path,
+            # replaced by the resolved route in process_view
+            "request.route": route_template(request.path),
             "request.remote_addr": request.META.get('REMOTE_ADDR'),
             "request.content_length": request.META.get('CONTENT_LENGTH', 0),
             "request.user_agent": request.META.get('HTTP_USER_AGENT'),
@@ -1,12 +1,20 @@
+import asyncio
+import contextlib
+import threading
 import unittest
 from mock import Mock, call, patch
 
+from asgiref.sync import sync_to_async
+
 import django
 from django.http import HttpResponse, StreamingHttpResponse
 from django.test.client import Client
 from django.conf.urls import url
+from django.db.backends.signals import connection_created
 
-from beeline.middleware.django import HoneyMiddlewareBase
+import beeline
+from beeline.middleware.django import (
+    HoneyDBWrapper, HoneyMiddleware, HoneyMiddlewareBase)
 
 
 class SimpleWSGITest(unittest.TestCase):
@@ -17,6 +25,7 @@ class SimpleWSGITest(unittest.TestCase):
     def test_call_middleware(self):
         ''' Just call the middleware and ensure that the code runs '''
         mock_req = Mock()
+        mock_req.path = "/hello/"
         mock_resp = Mock()
         mock_resp.return_value.streaming = False
         mock_trace = Mock()
@@ -32,6 +41,304 @@ class SimpleWSGITest(unittest.TestCase):
         self.assertEqual(resp, mock_resp.return_value)
 
 
+def _mock_request():
+    request = Mock()
+    request.method = "GET"
+    request.path = "/hello/"
+    request.META = {}
+    return request
+
+
+class AsyncMiddlewareTest(unittest.TestCase):
+    def run_middleware(self, middleware_cls, get_response):
+        finished = []
+
+        async def run():
+            _beeline = beeline.Beeline(transmission_impl=Mock())
+            _beeline.tracer_impl._run_hooks_and_send = finished.append
+            with patch('beeline.get_beeline', return_value=_beeline):
+                mw = middleware_cls(get_response)
+                self.assertTrue(asyncio.iscoroutinefunction(mw))
+                response = await mw(_mock_request())
+                if response.streaming:
+                    self.assertEqual(finished, [])
+                    response.content = [chunk async for chunk in response.streaming_content]
+            return response
+
+        return asyncio.run(run()), finished
+
+    def test_sync_chain_stays_sync(self):
+        mw = HoneyMiddlewareBase(Mock())
+        self.assertFalse(asyncio.iscoroutinefunction(mw))
+
+    def test_async_middleware(self):
+        async def get_response(request):
+            await asyncio.sleep(0)
+            beeline.add_context_field("view", "hello")
+            return Mock(status_code=201, streaming=False)
+
+        for middleware_cls in (HoneyMiddlewareBase, HoneyMiddleware):
+            response, finished = self.run_middleware(middleware_cls, get_response)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(finished), 1)
+            fields = finished[0].event.fields()
+            self.assertEqual(fields["name"], "django_http_get")
+            self.assertEqual(fields["view"], "hello")
+            self.assertEqual(fields["response.status_code"], 201)
+
+    def test_async_streaming_response(self):
+        async def content():
+            yield b"hello "
+            await asyncio.sleep(0)
+            yield b"world"
+
+        async def get_response(request):
+            return Mock(status_code=200, streaming=True, is_async=True, streaming_content=content())
+
+        for middleware_cls in (HoneyMiddlewareBase, HoneyMiddleware):
+            response, finished = self.run_middleware(middleware_cls, get_response)
+            self.assertEqual(response.content, [b"hello ", b"world"])
+            self.assertEqual(len(finished), 1)
+
+    def test_async_process_view(self):
+        async def get_response(request):
+            return Mock(status_code=200, streaming=False)
+
+        self.assertFalse(asyncio.iscoroutinefunction(HoneyMiddlewareBase(Mock()).process_view))
+        mw = HoneyMiddlewareBase(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(mw.process_view))
+
+        def view(request):
+            pass
+
+        request = _mock_request()
+        request.resolver_match.route = "hello/<int:id>/"
+        with patch('beeline.middleware.django.beeline') as m_beeline:
+            asyncio.run(mw.process_view(request, view, (), {}))
+        m_beeline.add_context_field.assert_has_calls([
+            call("django.view_func", "view"), call("request.route", "hello/<int:id>/")])
+
+    def test_async_requests_need_asyncio_tracer(self):
+        _beeline = beeline.Beeline(transmission_impl=Mock())
+        _beeline.tracer_impl.propagate_and_start_trace = Mock()
+        response = Mock()
+
+        async def get_response(request):
+            return response
+
+        with patch('beeline.get_beeline', return_value=_beeline):
+            mw = HoneyMiddlewareBase(get_response)
+            self.assertIs(asyncio.run(mw(_mock_request())), response)
+        _beeline.tracer_impl.propagate_and_start_trace.assert_not_called()
+
+
+class _Connection(object):
+    vendor = "sqlite"
+
+    def __init__(self):
+        self.execute_wrappers = []
+        self.threads = []
+
+    @contextlib.contextmanager
+    def execute_wrapper(self, wrapper):
+        self.execute_wrappers.append(wrapper)
+        try:
+            yield
+        finally:
+            self.execute_wrappers.pop()
+
+    def execute(self, sql):
+        self.threads.append(threading.get_ident())
+        execute = Mock()
+        for wrapper in self.execute_wrappers:
+            wrapper(execute, sql, (), False, {"connection": self})
+
+
+class AsyncDBWrapperTest(unittest.TestCase):
+    def run_requests(self, middleware_cls, connection, *get_responses):
+        finished = []
+
+        async def run():
+            _beeline = beeline.Beeline(transmission_impl=Mock())
+            _beeline.tracer_impl._run_hooks_and_send = finished.append
+            with patch('beeline.get_beeline', return_value=_beeline):
+                mws = [middleware_cls(get_response) for get_response in get_responses]
+                connection_created.send(sender=_Connection, connection=connection)
+                await asyncio.gather(*(mw(_mock_request()) for mw in mws))
+                # a query outside a request isn't traced
+                await sync_to_async(connection.execute)("SELECT 0")
+
+        asyncio.run(run())
+        return finished
+
+    def test_queries_dispatched_to_request(self):
+        connection = _Connection()
+
+        async def get_response(request):
+            await sync_to_async(connection.execute)("SELECT 1")
+            return Mock(status_code=200, streaming=False)
+
+        finished = self.run_requests(HoneyMiddleware, connection, get_response)
+        # the connection is only wrapped once, however often it connects
+        connection_created.send(sender=_Connection, connection=connection)
+        self.assertEqual(len(connection.execute_wrappers), 1)
+        self.assertEqual(len(finished), 2)
+        query, root = finished[0], finished[1]
+        self.assertEqual(query.fields["db.query"], "SELECT 1")
+        self.assertEqual(query.parent_id, root.id)
+
+    def test_overlapping_requests(self):
+        connection = _Connection()
+        started = []
+        both_started = asyncio.Event()
+
+        def make_get_response(sql):
+            async def get_response(request):
+                started.append(sql)
+                if len(started) == 2:
+                    both_started.set()
+                await both_started.wait()
+                await sync_to_async(connection.execute)(sql)
+                return Mock(status_code=200, streaming=False)
+            return get_response
+
+        finished = self.run_requests(HoneyMiddleware, connection,
+                                     make_get_response("SELECT 1"), make_get_response("SELECT 2"))
+        roots = {span.trace_id: span for span in finished if span.is_root()}
+        queries = [span for span in finished if not span.is_root()]
+        self.assertEqual(len(roots), 2)
+        self.assertEqual(sorted(q.fields["db.query"] for q in queries), ["SELECT 1", "SELECT 2"])
+        for query in queries:
+            self.assertEqual(query.parent_id, roots[query.trace_id].id)
+
+    def test_queries_aggregated(self):
+        connection = _Connection()
+
+        class AggregatingMiddleware(HoneyMiddleware):
+            aggregate_queries = True
+
+        def run_queries():
+            for _ in range(3):
+                connection.execute("SELECT 1")
+
+        async def get_response(request):
+            await sync_to_async(run_queries)()
+            return Mock(status_code=200, streaming=False)
+
+        finished = self.run_requests(AggregatingMiddleware, connection, get_response)
+        self.assertEqual(len(finished), 2)
+        query, root = finished[0], finished[1]
+        self.assertEqual(query.fields["db.call_count"], 3)
+        self.assertEqual(query.parent_id, root.id)
+        self.assertTrue(root.is_root())
+
+
+def _query_context(vendor="postgresql", rowcount=1):
+    cursor = Mock()
+    cursor.cursor.rowcount = rowcount
+    cursor.cursor.lastrowid = None
+    connection = Mock()
+    connection.vendor = vendor
+    return {"connection": connection, "cursor": cursor}
+
+
+class AggregatedDBWrapperTest(unittest.TestCase):
+    def setUp(self):
+        self.finished = []
+        self._beeline = beeline.Beeline(transmission_impl=Mock())
+        self._beeline.tracer_impl._run_hooks_and_send = self.finished.append
+        patch('beeline.get_beeline', return_value=self._beeline).start()
+        self.addCleanup(patch.stopall)
+
+    def query_spans(self):
+        return [s.fields for s in self.finished if s.fields["name"] == "django_postgresql_query"]
+
+    def test_repeated_queries_folded(self):
+        tracer = self._beeline.tracer_impl
+        execute = Mock(return_value="result")
+        db_wrapper = HoneyDBWrapper(aggregate=True)
+
+        root = tracer.start_trace(context={"name": "request"})
+        for i in range(20):
+            self.assertEqual(db_wrapper(execute, "SELECT * FROM t WHERE id = %s", (i,), False,
+                                        _query_context()), "result")
+        db_wrapper(execute, "SELECT 1", (), False, _query_context(rowcount=-1))
+        self.assertEqual(self.finished, [])
+        db_wrapper.flush()
+        tracer.finish_trace(root)
+
+        self.assertEqual(execute.call_count, 21)
+        summary, single = self.query_spans()
+        self.assertEqual(summary["db.query"], "SELECT * FROM t WHERE id = %s")
+        self.assertEqual(summary["db.call_count"], 20)
+        self.assertEqual(summary["db.rows_affected"], 20)
+        self.assertNotIn("db.query_args", summary)
+        self.assertLessEqual(summary["db.min_duration"], summary["db.p95_duration"])
+        self.assertLessEqual(summary["db.p95_duration"], summary["db.max_duration"])
+        self.assertGreaterEqual(summary["duration_ms"], summary["db.total_duration"])
+        self.assertEqual(summary["trace.parent_id"], root.id)
+
+        self.assertEqual(single["db.query_args"], ())
+        self.assertEqual(single["db.call_count"], 1)
+        self.assertEqual(single["db.rows_affected"], -1)
+        self.assertIn("db.duration", single)
+
+        # the request's rollups still count every query
+        self.assertEqual(self.finished[-1].fields["rollup.db.call_count"], 21)
+
+    def test_flushed_when_parent_span_changes(self):
+        tracer = self._beeline.tracer_impl
+        execute = Mock()
+        db_wrapper = HoneyDBWrapper(aggregate=True)
+
+        root = tracer.start_trace(context={"name": "request"})
+        child = tracer.start_span(context={"name": "child"})
+        db_wrapper(execute, "SELECT 1", (), False, _query_context())
+        db_wrapper(execute, "SELECT 1", (), False, _query_context())
+        tracer.finish_span(child)
+        db_wrapper(execute, "SELECT 1", (), False, _query_context())
+        self.assertEqual([s["trace.parent_id"] for s in self.query_spans()], [child.id])
+        db_wrapper.flush()
+        tracer.finish_trace(root)
+        self.assertEqual([s["trace.parent_id"] for s in self.query_spans()], [child.id, root.id])
+
+    def test_slow_and_failed_queries_sent_alone(self):
+        tracer = self._beeline.tracer_impl
+        db_wrapper = HoneyDBWrapper(aggregate=True, slow_query_ms=0)
+
+        root = tracer.start_trace(context={"name": "request"})
+        db_wrapper(Mock(), "SELECT 1", (1,), False, _query_context())
+        self.assertEqual(len(self.query_spans()), 1)
+        with self.assertRaises(ValueError):
+            db_wrapper(Mock(side_effect=ValueError("boom")), "SELECT 2", (2,), False, _query_context())
+        tracer.finish_trace(root)
+
+        slow, failed = self.query_spans()
+        self.assertEqual(slow["db.query_args"], (1,))
+        self.assertIn("db.duration", slow)
+        self.assertEqual(failed["db.query_args"], (2,))
+        self.assertEqual(failed["db.error_detail"], "boom")
+
+    def test_middleware_flushes_before_trace_finishes(self):
+        execute = Mock()
+
+        class AggregatingMiddleware(HoneyMiddleware):
+            aggregate_queries = True
+
+        def get_response(request):
+            db_wrapper = request._honey_db_wrapper  # pylint: disable=protected-access
+            for _ in range(3):
+                db_wrapper(execute, "SELECT 1", (), False, _query_context())
+            response = Mock()
+            response.streaming = False
+            return response
+
+        patch('beeline.middleware.django.connections').start()
+        AggregatingMiddleware(get_response)(_mock_request())
+        self.assertEqual([s["db.call_count"] for s in self.query_spans()], [3])
+        self.assertTrue(self.finished[-1].is_root())
+
+
 @unittest.skipIf(django.VERSION < (2, 2), "Routes are only supported on Django 2.2 and higher")
 class FullViewTestCase(unittest.TestCase):
     def setUp(self):
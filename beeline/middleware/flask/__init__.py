@@ -2,12 +2,13 @@ import datetime
 import threading
 
 import beeline
+from beeline import timing
 import flask  # to avoid namespace collision with request vs Request
 from beeline.propagation import Request
 from flask import current_app, signals
 # needed to build a request object from environ in the middleware
 from werkzeug.wrappers import Request
-from beeline.middleware.wsgi import WSGIRequest
+from beeline.middleware.wsgi import WSGIRequest, trace_response
 
 
 class HoneyMiddleware(object):
@@ -22,16 +23,20 @@ class HoneyMiddleware(object):
             app = HoneyDBMiddleware(app)
 
     def _before_request(self):
-        beeline.add_field("request.route", flask.request.endpoint)
+        # the rule flask matched the request to, e.g. /users/<int:user_id>
+        url_rule = flask.request.url_rule
+        if url_rule is not None:
+            beeline.add_field("request.route", url_rule.rule)
+        beeline.add_field("flask.endpoint", flask.request.endpoint)
 
     def _teardown_request(self, exception):
+        # the trace is finished by HoneyWSGIMiddleware, once the response
+        # body has been sent
         if exception:
             beeline.add_field('request.error_detail',
                               beeline.internal.stringify_exception(exception))
             beeline.add_field('request.error', str(type(exception)))
 
-        beeline.internal.send_event()
-
 
 class HoneyWSGIMiddleware(object):
 
@@ -39,20 +44,27 @@ class HoneyWSGIMiddleware(object):
         self.app = app
 
     def __call__(self, environ, start_response):
+        start_ns = timing.now_ns()
         req = Request(environ, shallow=True)
         wr = WSGIRequest("flask", environ)
 
         root_span = beeline.propagate_and_start_trace(wr.request_context(), wr)
+        if root_span is None:
+            return self.app(environ, start_response)
 
         def _start_response(status, headers, *args):
             status_code = int(status[0:4])
             beeline.add_context_field("response.status_code", status_code)
-            if not signals.signals_available:
-                beeline.finish_trace(root_span)
 
             return start_response(status, headers, *args)
 
-        return self.app(environ, _start_response)
+        try:
+            response = self.app(environ, _start_response)
+        except Exception:
+            beeline.finish_trace(root_span)
+            raise
+        # the trace is finished once the body has been sent
+        return trace_response(environ, response, root_span, start_ns, beeline.finish_trace)
 
 
 class HoneyDBMiddleware(object):
@@ -77,7 +89,7 @@ class HoneyDBMiddleware(object):
             pass
 
     def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
-        if not current_app:
+        if not current_app or not beeline.internal.is_sampled():
             return
 
         params = []
@@ -103,10 +115,10 @@ class HoneyDBMiddleware(object):
             "db.query_args": params,
         })
 
-        self.query_start_time = datetime.datetime.now()
+        self.query_start_time = timing.now_ns()
 
     def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
-        if not current_app:
+        if not current_app or not beeline.internal.is_sampled():
             return
 
         fields = {
@@ -116,8 +128,7 @@ class HoneyDBMiddleware(object):
 
         # only try to calculate query duration if we have a start time
         if self.query_start_time:
-            query_duration = datetime.datetime.now() - self.query_start_time
-            fields["db.duration"] = query_duration.total_seconds() * 1000
+            fields["db.duration"] = timing.elapsed_ms(self.query_start_time)
 
         beeline.add_context(fields)
         if self.state.span:
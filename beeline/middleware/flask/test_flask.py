@@ -18,8 +18,10 @@ class SimpleWSGITest(unittest.TestCase):
         mock_environ = {}
         self.m_gbl.propagate_and_start_trace.return_value = mock_trace
 
+        mock_app.return_value = [b"hello ", b"world"]
+
         mw = HoneyWSGIMiddleware(mock_app)
-        mw({}, mock_resp)
+        response = mw({}, mock_resp)
         self.m_gbl.propagate_and_start_trace.assert_called_once()
 
         mock_app.assert_called_once_with(mock_environ, ANY)
@@ -31,7 +33,14 @@ class SimpleWSGITest(unittest.TestCase):
         resp_func("200", 2)
 
         mock_resp.assert_called_once_with("200", 2)
+        # the trace is only finished once the body has been sent
+        self.m_gbl.finish_trace.assert_not_called()
+        self.assertEqual(list(response), [b"hello ", b"world"])
+        response.close()
         self.m_gbl.finish_trace.assert_called_once_with(mock_trace)
+        fields = mock_trace.add_context.call_args[0][0]
+        self.assertEqual(fields["response.body_size"], 11)
+        self.assertIn("response.time_to_first_byte_ms", fields)
 
 
 class HoneyDBMiddlewareTest(unittest.TestCase):
@@ -0,0 +1,42 @@
+''' Route templates for the `request.route` field.
+
+Raw request paths like /users/8313/orders have too many distinct values to
+group or sample on. Where the framework has already matched the request to a
+route, e.g. Django's `resolver_match` or Flask's `url_rule`, the middleware
+records that route's template. Until then, and for frameworks that don't
+expose one, `route_template` derives a template from the path by replacing
+the segments that look like IDs, e.g. /users/:id/orders.
+
+Templates aren't cached: keyed on the raw path, a cache would grow with the
+very cardinality it's meant to remove. Instead the normalization only splits
+the path once and skips the regexes for segments that can't match them.
+'''
+import re
+
+_UUID_RE = re.compile(r'^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$')
+_HEX_RE = re.compile(r'^(?=.*[0-9])[0-9a-fA-F]{16,}$')
+_DIGITS = '0123456789'
+
+
+def _normalize_segment(segment):
+    if not segment:
+        return segment
+    if not segment.strip(_DIGITS):
+        return ':id'
+    if len(segment) < 16:
+        return segment
+    if len(segment) in (32, 36) and _UUID_RE.match(segment):
+        return ':uuid'
+    if _HEX_RE.match(segment):
+        return ':hash'
+    return segment
+
+
+def route_template(path):
+    '''
+    Returns a route template for the raw request path, with numeric IDs,
+    UUIDs and long hex strings replaced by :id, :uuid and :hash.
+    '''
+    if path is None:
+        return None
+    return '/'.join(_normalize_segment(s) for s in path.split('/'))
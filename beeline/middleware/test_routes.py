@@ -0,0 +1,31 @@
+import unittest
+
+from beeline.middleware.routes import route_template
+from beeline.middleware.wsgi import WSGIRequest
+
+
+class TestRouteTemplate(unittest.TestCase):
+    def test_route_template(self):
+        self.assertIsNone(route_template(None))
+        self.assertEqual(route_template(""), "")
+        self.assertEqual(route_template("/"), "/")
+        self.assertEqual(route_template("/hello/world/"), "/hello/world/")
+        self.assertEqual(route_template("/users/8313/orders/42"), "/users/:id/orders/:id")
+        self.assertEqual(
+            route_template("/things/123e4567-e89b-12d3-a456-426614174000"), "/things/:uuid")
+        self.assertEqual(route_template("/things/123E4567E89B12D3A456426614174000"), "/things/:uuid")
+        self.assertEqual(route_template("/blobs/0af7651916cd43dd8448eb211c80319c0a"), "/blobs/:hash")
+        # words made of hex letters, and short hex strings, are left alone
+        self.assertEqual(route_template("/deadbeefdeadbeefcafe/v2"), "/deadbeefdeadbeefcafe/v2")
+        self.assertEqual(route_template("/colors/ff00aa"), "/colors/ff00aa")
+        self.assertEqual(route_template("/v1/user1"), "/v1/user1")
+
+    def test_long_paths(self):
+        path = "/files/" + "a/" * 1024 + "1"
+        self.assertTrue(route_template(path).endswith("/a/:id"))
+
+    def test_wsgi_request_context(self):
+        request = WSGIRequest("wsgi", {"REQUEST_METHOD": "GET", "PATH_INFO": "/users/8313"})
+        context = request.request_context()
+        self.assertEqual(context["request.path"], "/users/8313")
+        self.assertEqual(context["request.route"], "/users/:id")
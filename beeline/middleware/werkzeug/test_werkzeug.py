@@ -1,4 +1,6 @@
+import io
 import unittest
+from wsgiref.util import FileWrapper
 from mock import Mock, patch, ANY
 
 from beeline.middleware.werkzeug import HoneyWSGIMiddleware
@@ -17,8 +19,10 @@ class SimpleWSGITest(unittest.TestCase):
         mock_environ = {}
         self.m_gbl.propagate_and_start_trace.return_value = mock_trace
 
+        mock_app.return_value = [b"hello ", b"world"]
+
         mw = HoneyWSGIMiddleware(mock_app)
-        mw({}, mock_resp)
+        response = mw({}, mock_resp)
         self.m_gbl.propagate_and_start_trace.assert_called_once()
 
         mock_app.assert_called_once_with(mock_environ, ANY)
@@ -30,4 +34,61 @@ class SimpleWSGITest(unittest.TestCase):
         resp_func(1, 2)
 
         mock_resp.assert_called_once_with(1, 2)
+        # the trace is only finished once the body has been sent
+        self.m_gbl.finish_trace.assert_not_called()
+        self.assertEqual(list(response), [b"hello ", b"world"])
+        response.close()
+        self.m_gbl.finish_trace.assert_called_once_with(mock_trace)
+        fields = mock_trace.add_context.call_args[0][0]
+        self.assertEqual(fields["response.body_size"], 11)
+        self.assertIn("response.time_to_first_byte_ms", fields)
+
+    def test_app_raises(self):
+        mock_trace = Mock()
+        self.m_gbl.propagate_and_start_trace.return_value = mock_trace
+        mock_app = Mock(side_effect=ValueError("nope"))
+
+        with self.assertRaises(ValueError):
+            HoneyWSGIMiddleware(mock_app)({}, Mock())
         self.m_gbl.finish_trace.assert_called_once_with(mock_trace)
+
+    def test_streamed_body(self):
+        mock_trace = Mock()
+        self.m_gbl.propagate_and_start_trace.return_value = mock_trace
+        body = Mock()
+        body.__iter__ = Mock(return_value=iter([b"", b"a" * 10, b"b" * 5]))
+
+        response = HoneyWSGIMiddleware(Mock(return_value=body))({}, Mock())
+        chunks = iter(response)
+        self.assertEqual(next(chunks), b"")
+        self.assertEqual(next(chunks), b"a" * 10)
+        self.m_gbl.finish_trace.assert_not_called()
+        self.assertEqual(list(chunks), [b"b" * 5])
+
+        response.close()
+        response.close()
+        # the app's iterable is closed too, and the trace finished once
+        body.close.assert_called_once_with()
+        self.m_gbl.finish_trace.assert_called_once_with(mock_trace)
+        fields = mock_trace.add_context.call_args[0][0]
+        self.assertEqual(fields["response.body_size"], 15)
+
+    def test_file_wrapper_passed_through(self):
+        mock_trace = Mock()
+        self.m_gbl.propagate_and_start_trace.return_value = mock_trace
+        body = FileWrapper(io.BytesIO(b"hello"))
+        environ = {'wsgi.file_wrapper': FileWrapper}
+
+        response = HoneyWSGIMiddleware(Mock(return_value=body))(environ, Mock())
+        # the server has to see its own file wrapper to use sendfile
+        self.assertIs(response, body)
+        self.m_gbl.finish_trace.assert_called_once_with(mock_trace)
+
+    def test_beeline_not_initialized(self):
+        self.m_gbl.propagate_and_start_trace.return_value = None
+        mock_app = Mock()
+        mock_resp = Mock()
+
+        response = HoneyWSGIMiddleware(mock_app)({}, mock_resp)
+        self.assertIs(response, mock_app.return_value)
+        mock_app.assert_called_once_with({}, mock_resp)
@@ -1,4 +1,6 @@
-from beeline.propagation import Request
+from beeline import timing
+from beeline.propagation import Request, environ_header_key
+from beeline.middleware.routes import route_template
 
 
 class WSGIRequest(Request):
@@ -7,9 +9,7 @@ class WSGIRequest(Request):
         self._environ = environ
 
     def header(self, key):
-        # FIXME: Is this .upper strictly necessary? Does environ already do it for us?
-        lookup_key = "HTTP_" + key.upper().replace('-', '_')
-        return self._environ.get(lookup_key)
+        return self._environ.get(environ_header_key(key))
 
     def method(self):
         return self._environ.get('REQUEST_METHOD')
@@ -42,9 +42,64 @@ class WSGIRequest(Request):
             "request.host": self._environ.get('HTTP_HOST'),
             "request.method": request_method,
             "request.path": self._environ.get('PATH_INFO'),
+            # replaced by the framework's route template once it has routed the request
+            "request.route": route_template(self._environ.get('PATH_INFO')),
             "request.remote_addr": self._environ.get('REMOTE_ADDR'),
             "request.content_length": self._environ.get('CONTENT_LENGTH', 0),
             "request.user_agent": self._environ.get('HTTP_USER_AGENT'),
             "request.scheme": self._environ.get('wsgi.url_scheme'),
             "request.query": self._environ.get('QUERY_STRING')
         }
+
+
+def trace_response(environ, response, root_span, start_ns, finish_trace):
+    ''' Returns the response a WSGI application returned, wrapped in a
+    `TracedWSGIResponse`. Responses made with the server's
+    `wsgi.file_wrapper`, e.g. by Flask's `send_file`, are returned as they
+    are, so the server still recognizes them and can send the file with
+    sendfile; their trace is finished now, without the body's timings. '''
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if isinstance(file_wrapper, type) and isinstance(response, file_wrapper):
+        finish_trace(root_span)
+        return response
+    return TracedWSGIResponse(response, root_span, start_ns, finish_trace)
+
+
+class TracedWSGIResponse(object):
+    ''' Wraps the iterable a WSGI application returns, so that the trace is
+    only finished once the server has sent the whole body and closed the
+    response. Records `response.time_to_first_byte_ms`, from `start_ns` until
+    the first chunk of the body is produced, and `response.body_size`, the
+    bytes sent. '''
+
+    def __init__(self, iterable, root_span, start_ns, finish_trace):
+        self._iterable = iterable
+        self._root_span = root_span
+        self._start_ns = start_ns
+        self._finish_trace = finish_trace
+        self._first_byte_ms = None
+        self._body_size = 0
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._iterable:
+            if chunk:
+                if self._first_byte_ms is None:
+                    self._first_byte_ms = timing.elapsed_ms(self._start_ns)
+                self._body_size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            fields = {"response.body_size": self._body_size}
+            if self._first_byte_ms is not None:
+                fields["response.time_to_first_byte_ms"] = self._first_byte_ms
+            self._root_span.add_context(fields)
+            self._finish_trace(self._root_span)
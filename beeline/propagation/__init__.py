@@ -1,4 +1,6 @@
 from abc import ABCMeta, abstractmethod
+import base64
+import json
 import beeline
 
 
@@ -13,13 +15,175 @@ class PropagationContext(object):
     and W3C headers. http_trace_parser_hooks generate this from requests, and
     http_trace_propagation_hooks use this to generate a set of headers for
     outbound HTTP requests.
+
+    `trace` is the `beeline.trace.Trace` the context was taken from, if any,
+    which caches the encoded trace fields.
+
+    `sampled` is the upstream sampling decision for formats that carry one,
+    or None if it wasn't made or isn't known.
     '''
 
-    def __init__(self, trace_id, parent_id, trace_fields={}, dataset=None):
+    def __init__(self, trace_id, parent_id, trace_fields={}, dataset=None, trace=None, sampled=None):
         self.trace_id = trace_id
         self.parent_id = parent_id
         self.trace_fields = trace_fields
         self.dataset = dataset
+        self.trace = trace
+        self.sampled = sampled
+
+    def encoded_trace_fields(self, encoder=None):
+        '''
+        Returns the trace fields encoded by `encoder`, by default JSON and
+        then base64 encoded, as they are sent in the X-Honeycomb-Trace header.
+        The encoding is cached on the trace until its fields change.
+        '''
+        if self.trace is not None:
+            return self.trace.encode_fields(self.trace_fields, encoder)
+        return (encoder or encode_trace_fields)(self.trace_fields)
+
+
+def encode_trace_fields(trace_fields):
+    '''
+    Encodes trace fields for the context of the X-Honeycomb-Trace header.
+    '''
+    return base64.b64encode(json.dumps(trace_fields, default=_json_default).encode()).decode()
+
+
+def _json_default(o):
+    # trace field values that aren't JSON types but propagate as strings,
+    # like a W3C tracestate. Imported here, as the w3c module imports this one.
+    from beeline.propagation.w3c import TraceState  # pylint: disable=import-outside-toplevel
+    if isinstance(o, TraceState):
+        return str(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class PropagationPolicy(object):
+    '''
+    Limits the trace fields propagated to downstream services, which
+    otherwise get every trace field, including ones like request.* that
+    are only of use locally.
+
+    - `allow`: if set, only fields whose names start with one of these
+            prefixes are propagated
+    - `deny`: fields whose names start with one of these prefixes are not
+            propagated, even if allowed
+    - `max_bytes`: if set, the most the encoded trace fields may take up in
+            the X-Honeycomb-Trace header. The most recently added fields are
+            dropped until they fit.
+
+    Whether a field name passes `allow` and `deny` is remembered, so each
+    name is only matched against the prefixes once.
+    '''
+
+    # the most field names whose verdict is remembered
+    MAX_CACHED_NAMES = 10000
+
+    def __init__(self, allow=None, deny=None, max_bytes=None):
+        self._allow = tuple(allow) if allow is not None else None
+        self._deny = tuple(deny) if deny else ()
+        self.max_bytes = max_bytes
+        self._verdicts = {}
+
+    def allows(self, name):
+        verdict = self._verdicts.get(name)
+        if verdict is None:
+            verdict = ((self._allow is None or name.startswith(self._allow)) and
+                       not name.startswith(self._deny))
+            if len(self._verdicts) < self.MAX_CACHED_NAMES:
+                self._verdicts[name] = verdict
+        return verdict
+
+    def filter(self, trace_fields):
+        '''
+        Returns a new dict of the trace fields to propagate.
+        '''
+        fields = {k: v for k, v in trace_fields.items() if self.allows(k)}
+        if self.max_bytes is not None:
+            self._fit_to_budget(fields)
+        return fields
+
+    def _fit_to_budget(self, fields):
+        # json.dumps puts "{" and "}" around the items and ", " between them,
+        # and base64 encodes every 3 bytes as 4
+        sizes = []
+        for k, v in list(fields.items()):
+            try:
+                sizes.append((k, len(json.dumps({k: v})) - 2))
+            except (TypeError, ValueError):
+                # can't be propagated anyway
+                del fields[k]
+        json_length = 2 + sum(size for _, size in sizes) + 2 * max(len(sizes) - 1, 0)
+        while sizes and 4 * ((json_length + 2) // 3) > self.max_bytes:
+            k, size = sizes.pop()
+            del fields[k]
+            json_length -= size + (2 if sizes else 0)
+
+
+# The headers read by the beeline's own propagation formats, whose lookup keys
+# are computed once here rather than on every request.
+PROPAGATION_HEADERS = (
+    'X-Honeycomb-Trace', 'X-Honeycomb-Trace-Bin', 'traceparent', 'tracestate',
+    'b3', 'X-B3-TraceId', 'X-B3-SpanId', 'X-B3-ParentSpanId', 'X-B3-Sampled', 'X-B3-Flags',
+    'uber-trace-id',
+)
+# other headers, e.g. read by custom parser hooks, are remembered up to this many
+MAX_CACHED_HEADER_KEYS = 1000
+
+_LOWER_HEADER_KEYS = {k: k.lower() for k in PROPAGATION_HEADERS}
+_ENVIRON_HEADER_KEYS = {k: "HTTP_" + k.upper().replace('-', '_') for k in PROPAGATION_HEADERS}
+
+
+def lower_header_key(key):
+    '''
+    Returns the header name in lower case.
+    '''
+    lookup_key = _LOWER_HEADER_KEYS.get(key)
+    if lookup_key is None:
+        lookup_key = key.lower()
+        if len(_LOWER_HEADER_KEYS) < MAX_CACHED_HEADER_KEYS:
+            _LOWER_HEADER_KEYS[key] = lookup_key
+    return lookup_key
+
+
+def environ_header_key(key):
+    '''
+    Returns the key of the header in a WSGI environ or Django's request.META,
+    e.g. HTTP_X_HONEYCOMB_TRACE for X-Honeycomb-Trace.
+    '''
+    lookup_key = _ENVIRON_HEADER_KEYS.get(key)
+    if lookup_key is None:
+        lookup_key = "HTTP_" + key.upper().replace('-', '_')
+        if len(_ENVIRON_HEADER_KEYS) < MAX_CACHED_HEADER_KEYS:
+            _ENVIRON_HEADER_KEYS[key] = lookup_key
+    return lookup_key
+
+
+class HeaderKeys(object):
+    '''
+    Finds header names in a dict of headers regardless of case. The header
+    is looked up as asked for, then in lower case, and only if both miss is
+    the dict's every key lowered to build a keymap, once.
+    '''
+
+    __slots__ = ('_headers', '_keymap')
+
+    def __init__(self, headers):
+        self._headers = headers
+        self._keymap = None
+
+    def find(self, key):
+        '''
+        Returns the key the header is stored under, or None if it is missing.
+        '''
+        if key in self._headers:
+            return key
+        lookup_key = lower_header_key(key)
+        if lookup_key in self._headers:
+            return lookup_key
+        if self._keymap is None:
+            self._keymap = {k.lower(): k for k in self._headers}
+        return self._keymap.get(lookup_key)
 
 
 class Request(object, metaclass=ABCMeta):
@@ -92,13 +256,12 @@ class DictRequest(Request):
     def __init__(self, headers, props={}):
         self._headers = headers
         self._props = props
-        self._keymap = {k.lower(): k for k in self._headers.keys()}
+        self._keys = HeaderKeys(headers)
 
     def header(self, key):
-        lookup_key = key.lower()
-        if lookup_key not in self._keymap:
+        lookup_key = self._keys.find(key)
+        if lookup_key is None:
             return None
-        lookup_key = self._keymap[lookup_key]
         return self._headers[lookup_key]
 
     def method(self):
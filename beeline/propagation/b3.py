@@ -0,0 +1,144 @@
+''' B3 propagation, as used by Zipkin and many service meshes.
+
+Both the single `b3` header and the multiple `X-B3-*` headers are read, the
+single header first. B3 trace IDs may be 64 or 128 bits: 64 bit IDs are
+padded to 128 bits with leading zeros, as the beeline and W3C use, and sent
+downstream as 64 bit IDs again, so the upstream's trace ID survives the
+round trip.
+
+The sampling state is put in the context's `sampled`: True for sampled or
+debug, False for not sampled, and None when the upstream left it undecided.
+A header with only a sampling state, like `b3: 0`, gives a context with no
+IDs, which starts a new trace that still follows the upstream's decision
+when `respect_parent_sampling` is set.
+'''
+import beeline
+from beeline.propagation import PropagationContext
+
+_HEX_DIGITS = "0123456789abcdef"
+_EMPTY_TRACE_ID = "0" * 32
+_EMPTY_SPAN_ID = "0" * 16
+# the high 64 bits of a 64 bit trace ID padded to 128 bits
+_TRACE_ID_PADDING = "0" * 16
+
+# the single header's sampling state, and the multi header X-B3-Sampled
+# values, including the legacy "true" and "false"
+_SAMPLED = {"1": True, "d": True, "0": False, "true": True, "false": False}
+
+
+def http_trace_parser_hook(request):
+    '''
+    Retrieves the B3 propagation context out of the request.
+    request must implement the beeline.propagation.Request abstract base class
+    '''
+    try:
+        header = request.header('b3')
+        if header:
+            return unmarshal_single_header(header)
+        trace_id = request.header('X-B3-TraceId')
+        if trace_id:
+            return unmarshal_multi_header(
+                trace_id, request.header('X-B3-SpanId'),
+                request.header('X-B3-Sampled'), request.header('X-B3-Flags'))
+        sampled = request.header('X-B3-Sampled')
+        if request.header('X-B3-Flags') == "1":
+            sampled = "d"
+        if sampled in _SAMPLED:
+            return PropagationContext(None, None, {}, sampled=_SAMPLED[sampled])
+    except Exception as e:
+        beeline.internal.log(
+            'error attempting to extract b3 trace context: %s', beeline.internal.stringify_exception(e))
+    return None
+
+
+def http_trace_propagation_hook(propagation_context):
+    '''
+    Given a propagation context, returns the multiple X-B3-* headers to be
+    added to outbound requests.
+    '''
+    if not propagation_context:
+        return None
+
+    headers = {
+        "X-B3-TraceId": _marshal_trace_id(propagation_context.trace_id),
+        "X-B3-SpanId": propagation_context.parent_id,
+    }
+    if propagation_context.sampled is not None:
+        headers["X-B3-Sampled"] = "1" if propagation_context.sampled else "0"
+    return headers
+
+
+def http_trace_single_header_propagation_hook(propagation_context):
+    '''
+    Given a propagation context, returns the single b3 header to be added to
+    outbound requests.
+    '''
+    if not propagation_context:
+        return None
+
+    return {"b3": marshal_single_header(propagation_context)}
+
+
+def marshal_single_header(propagation_context):
+    '''
+    Given a propagation context, returns the contents of a b3 header.
+    '''
+    header = f"{_marshal_trace_id(propagation_context.trace_id)}-{propagation_context.parent_id}"
+    if propagation_context.sampled is not None:
+        header += "-1" if propagation_context.sampled else "-0"
+    return header
+
+
+def unmarshal_single_header(header):
+    '''
+    Given the b3 header, returns a PropagationContext, or None if it isn't
+    valid. If the header only has a sampling state, the context has no IDs.
+    '''
+    # {TraceId}-{SpanId}[-{SamplingState}[-{ParentSpanId}]], or {SamplingState}
+    parts = header.split('-', 3)
+    if len(parts) < 2:
+        # the legacy "true" and "false" are only used by X-B3-Sampled
+        if header in ("0", "1", "d"):
+            return PropagationContext(None, None, {}, sampled=_SAMPLED[header])
+        return None
+    sampled = None
+    if len(parts) > 2:
+        if parts[2] not in _SAMPLED:
+            return None
+        sampled = _SAMPLED[parts[2]]
+    return _context(parts[0], parts[1], sampled)
+
+
+def unmarshal_multi_header(trace_id, span_id, sampled=None, flags=None):
+    '''
+    Given the values of the X-B3-TraceId, X-B3-SpanId, X-B3-Sampled and
+    X-B3-Flags headers, returns a PropagationContext, or None if they aren't
+    valid.
+    '''
+    if flags == "1":
+        # debug implies sampled
+        sampled = True
+    elif sampled is not None:
+        if sampled not in _SAMPLED:
+            return None
+        sampled = _SAMPLED[sampled]
+    return _context(trace_id, span_id, sampled)
+
+
+def _context(trace_id, span_id, sampled):
+    if not span_id or len(span_id) != 16 or span_id.strip(_HEX_DIGITS) or span_id == _EMPTY_SPAN_ID:
+        return None
+    if len(trace_id) == 16:
+        trace_id = _TRACE_ID_PADDING + trace_id
+    elif len(trace_id) != 32:
+        return None
+    if trace_id.strip(_HEX_DIGITS) or trace_id == _EMPTY_TRACE_ID:
+        return None
+    return PropagationContext(trace_id, span_id, {}, sampled=sampled)
+
+
+def _marshal_trace_id(trace_id):
+    # send padded 64 bit trace IDs as they were received
+    if len(trace_id) == 32 and trace_id.startswith(_TRACE_ID_PADDING):
+        return trace_id[16:]
+    return trace_id
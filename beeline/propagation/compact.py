@@ -0,0 +1,317 @@
+''' A compact binary propagation format, for hops between services that all
+run the beeline.
+
+The X-Honeycomb-Trace header carries hex IDs and base64 encoded JSON, so it is
+larger than it needs to be and costly to parse. This format carries the same
+trace ID, parent ID, dataset and trace fields as:
+
+- a version byte, then a flags byte
+- the trace ID and parent ID, each a varint of (length << 1 | is_hex) then
+  the ID, as raw bytes when it is lowercase hex and as UTF-8 otherwise
+- the dataset, if the DATASET flag is set, as a varint length then UTF-8
+- the trace fields, if any, as a varint length then compact JSON, which is
+  zlib compressed when that makes it smaller and the COMPRESSED flag is set
+
+`encode` and `decode` work with the bytes, e.g. for message queue attributes
+that can hold binary values. In HTTP headers the bytes are sent base64url
+encoded, without padding, in the X-Honeycomb-Trace-Bin header:
+
+    beeline.init(
+        ...,
+        http_trace_parser_hook=compact.http_trace_parser_hook,
+        http_trace_propagation_hook=compact.http_trace_propagation_hook,
+    )
+'''
+import base64
+import functools
+import json
+import zlib
+
+import beeline
+from beeline.propagation import PropagationContext, _json_default
+from beeline.propagation.honeycomb import copy_context
+
+HEADER_NAME = 'X-Honeycomb-Trace-Bin'
+ATTRIBUTE_NAME = 'honeycomb-trace-bin'
+
+VERSION = 1
+FLAG_DATASET = 0x01
+FLAG_COMPRESSED = 0x02
+
+# trace fields shorter than this aren't worth compressing
+COMPRESS_MIN_LENGTH = 128
+CONTEXT_CACHE_SIZE = 1024
+# trace fields longer than this, compressed or once decompressed, aren't cached
+MAX_CACHED_CONTEXT_LENGTH = 4096
+# trace fields that decompress to more than this are rejected
+MAX_CONTEXT_LENGTH = 65536
+
+_HEX_DIGITS = '0123456789abcdef'
+# the ID headers for the beeline's 16 byte trace IDs and 8 byte span IDs
+_TRACE_ID_HEADER = 16 << 1 | 1
+_PARENT_ID_HEADER = 8 << 1 | 1
+_BEELINE_IDS_PREFIX = bytes((VERSION, 0, _TRACE_ID_HEADER))
+_json_encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
+
+
+def http_trace_parser_hook(request):
+    '''
+    Retrieves the compact propagation context out of the request.
+    request must implement the beeline.propagation.Request abstract base class
+    '''
+    trace_header = request.header(HEADER_NAME)
+    if trace_header:
+        try:
+            trace_id, parent_id, context, dataset = unmarshal_propagation_context_with_dataset(trace_header)
+            # no trace ID if the version is unsupported
+            if trace_id:
+                return PropagationContext(trace_id, parent_id, context, dataset)
+        except Exception as e:
+            beeline.internal.log(
+                'error attempting to extract compact trace context: %s', beeline.internal.stringify_exception(e))
+    return None
+
+
+def http_trace_propagation_hook(propagation_context):
+    '''
+    Given a propagation context, returns a dictionary of key value pairs that should be
+    added to outbound requests (usually HTTP headers)
+    '''
+    if not propagation_context:
+        return None
+
+    return {HEADER_NAME: marshal_propagation_context(propagation_context)}
+
+
+def attributes_parser_hook(attributes):
+    '''
+    Retrieves the compact propagation context out of a message's attributes,
+    a mapping with the bytes produced by `attributes_propagation_hook`.
+    '''
+    data = attributes.get(ATTRIBUTE_NAME)
+    if data:
+        try:
+            trace_id, parent_id, context, dataset = decode(data)
+            if trace_id:
+                return PropagationContext(trace_id, parent_id, context, dataset)
+        except Exception as e:
+            beeline.internal.log(
+                'error attempting to extract compact trace context: %s', beeline.internal.stringify_exception(e))
+    return None
+
+
+def attributes_propagation_hook(propagation_context):
+    '''
+    Given a propagation context, returns a dictionary of attributes to add to
+    an outbound message, for queues whose attributes can hold bytes.
+    '''
+    if not propagation_context:
+        return None
+
+    return {ATTRIBUTE_NAME: encode(propagation_context)}
+
+
+def marshal_propagation_context(propagation_context):
+    '''
+    Given a propagation context, returns the contents of a trace header to be
+    injected by middleware.
+    '''
+    if not propagation_context:
+        return None
+
+    return base64.urlsafe_b64encode(encode(propagation_context)).rstrip(b'=').decode()
+
+
+def unmarshal_propagation_context_with_dataset(trace_header):
+    '''
+    Given the body of the `X-Honeycomb-Trace-Bin` header, returns the
+    trace_id, parent_id, trace fields and dataset.
+    '''
+    data = trace_header.encode()
+    return decode(base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4)))
+
+
+def encode(propagation_context):
+    '''
+    Returns the propagation context in the compact binary format.
+    '''
+    flags = 0
+    trace_id = propagation_context.trace_id
+    parent_id = propagation_context.parent_id
+    if (trace_id and parent_id and len(trace_id) == 32 and len(parent_id) == 16 and
+            not (trace_id + parent_id).strip(_HEX_DIGITS)):
+        # the beeline's own IDs, so the ID headers are known in advance
+        out = bytearray(_BEELINE_IDS_PREFIX)
+        out += bytes.fromhex(trace_id)
+        out.append(_PARENT_ID_HEADER)
+        out += bytes.fromhex(parent_id)
+    else:
+        out = bytearray((VERSION, 0))
+        _write_id(out, trace_id)
+        _write_id(out, parent_id)
+
+    if beeline.propagation.propagate_dataset and propagation_context.dataset:
+        flags |= FLAG_DATASET
+        _write_bytes(out, propagation_context.dataset.encode())
+
+    if propagation_context.trace_fields:
+        # cached on the trace, like the X-Honeycomb-Trace context
+        compressed, context = propagation_context.encoded_trace_fields(encode_trace_fields)
+        if compressed:
+            flags |= FLAG_COMPRESSED
+        _write_bytes(out, context)
+
+    out[1] = flags
+    return bytes(out)
+
+
+def encode_trace_fields(trace_fields):
+    '''
+    Returns whether the trace fields were compressed, and their encoding.
+    '''
+    context = _json_encoder.encode(trace_fields).encode()
+    if len(context) >= COMPRESS_MIN_LENGTH:
+        compressed = zlib.compress(context)
+        if len(compressed) < len(context):
+            return True, compressed
+    return False, context
+
+
+def decode(data):
+    '''
+    Given bytes in the compact binary format, returns the trace_id,
+    parent_id, trace fields and dataset.
+    '''
+    data = bytes(data)
+    if not data or data[0] != VERSION:
+        beeline.internal.log(
+            'warning: compact trace context version %s is unsupported', data[0] if data else None)
+        return None, None, None, None
+    flags = data[1]
+    if data[2] == _TRACE_ID_HEADER and len(data) >= 28 and data[19] == _PARENT_ID_HEADER:
+        trace_id = data[3:19].hex()
+        parent_id = data[20:28].hex()
+        pos = 28
+    else:
+        trace_id, pos = _read_id(data, 2)
+        parent_id, pos = _read_id(data, pos)
+
+    dataset = None
+    if flags & FLAG_DATASET:
+        value, pos = _read_bytes(data, pos)
+        if beeline.propagation.propagate_dataset:
+            dataset = value.decode()
+
+    context = {}
+    if pos < len(data):
+        value, pos = _read_bytes(data, pos)
+        context = decode_context(value, bool(flags & FLAG_COMPRESSED))
+    if pos != len(data):
+        raise ValueError('trailing data after compact trace context')
+
+    return trace_id, parent_id, context, dataset
+
+
+class _ContextTooLong(ValueError):
+    pass
+
+
+def _decode_context(value, compressed, max_length=MAX_CONTEXT_LENGTH):
+    if compressed:
+        # the header is untrusted, so don't let it decompress to any size
+        decompressor = zlib.decompressobj()
+        value = decompressor.decompress(value, max_length)
+        if decompressor.unconsumed_tail:
+            raise _ContextTooLong('compact trace context is too long')
+        if not decompressor.eof:
+            raise ValueError('truncated compact trace context')
+    return json.loads(value.decode())
+
+
+def _decode_short_context(value, compressed):
+    # raises _ContextTooLong, which isn't cached, if it decompresses to more
+    # than the cache allows
+    return _decode_context(value, compressed, MAX_CACHED_CONTEXT_LENGTH)
+
+
+_decode_context_cached = functools.lru_cache(maxsize=CONTEXT_CACHE_SIZE)(_decode_short_context)
+
+
+def decode_context(value, compressed=False):
+    '''
+    Decodes the trace fields segment, using a decode cache like
+    `beeline.propagation.honeycomb.decode_context`. Each caller gets its own
+    copy of the fields.
+    '''
+    if len(value) <= MAX_CACHED_CONTEXT_LENGTH:
+        try:
+            return copy_context(_decode_context_cached(value, compressed))
+        except _ContextTooLong:
+            pass
+    return _decode_context(value, compressed)
+
+
+def context_cache_info():
+    '''
+    Returns the decode cache's hits, misses, maxsize and currsize, as a
+    `functools.lru_cache` cache_info named tuple.
+    '''
+    return _decode_context_cached.cache_info()
+
+
+def clear_context_cache():
+    _decode_context_cached.cache_clear()
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _write_bytes(out, value):
+    _write_varint(out, len(value))
+    out += value
+
+
+def _read_bytes(data, pos):
+    n, pos = _read_varint(data, pos)
+    end = pos + n
+    if end > len(data):
+        raise ValueError('truncated compact trace context')
+    return data[pos:end], end
+
+
+def _write_id(out, id):
+    id = id or ''
+    if id and len(id) % 2 == 0 and not id.strip(_HEX_DIGITS):
+        value = bytes.fromhex(id)
+        _write_varint(out, len(value) << 1 | 1)
+    else:
+        value = id.encode()
+        _write_varint(out, len(value) << 1)
+    out += value
+
+
+def _read_id(data, pos):
+    header, pos = _read_varint(data, pos)
+    end = pos + (header >> 1)
+    if end > len(data):
+        raise ValueError('truncated compact trace context')
+    value = data[pos:end]
+    if header & 1:
+        return value.hex(), end
+    return value.decode() or None, end
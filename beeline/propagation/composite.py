@@ -0,0 +1,64 @@
+''' Propagation in several formats at once, e.g. while migrating from the
+honeycomb header to W3C trace context:
+
+    propagator = CompositePropagator([honeycomb, w3c])
+    beeline.init(
+        ...,
+        http_trace_parser_hook=propagator.http_trace_parser_hook,
+        http_trace_propagation_hook=propagator.http_trace_propagation_hook,
+    )
+'''
+import beeline
+from beeline.propagation import honeycomb, w3c
+
+
+class CompositePropagator(object):
+    '''
+    Combines propagation formats, each a module or object with
+    `http_trace_parser_hook` and `http_trace_propagation_hook` functions,
+    such as `beeline.propagation.honeycomb`.
+
+    Outbound requests get the headers of every format, all built from the
+    one propagation context, so the trace fields are only filtered and
+    encoded once per trace (see `beeline.trace.Trace.encode_fields`).
+    Inbound requests are parsed with each format in turn, and the first
+    context found is used.
+    '''
+
+    def __init__(self, propagators=(honeycomb, w3c)):
+        self.propagators = tuple(propagators)
+        # looked up once rather than on every request
+        self._parser_hooks = tuple(p.http_trace_parser_hook for p in self.propagators)
+        self._propagation_hooks = tuple(p.http_trace_propagation_hook for p in self.propagators)
+
+    def http_trace_parser_hook(self, request):
+        '''
+        Retrieves the propagation context out of the request, using the first
+        format whose headers are present and valid.
+        '''
+        for hook in self._parser_hooks:
+            propagation_context = hook(request)
+            if propagation_context:
+                return propagation_context
+        return None
+
+    def http_trace_propagation_hook(self, propagation_context):
+        '''
+        Given a propagation context, returns a dictionary of the headers of
+        every format.
+        '''
+        if not propagation_context:
+            return None
+
+        headers = {}
+        for hook in self._propagation_hooks:
+            try:
+                format_headers = hook(propagation_context)
+            except Exception as e:
+                # one broken format shouldn't stop the others propagating
+                beeline.internal.log(
+                    'error: propagation hook %s raised: %s', hook, beeline.internal.stringify_exception(e))
+                continue
+            if format_headers:
+                headers.update(format_headers)
+        return headers
@@ -4,13 +4,12 @@ from beeline.propagation import honeycomb, w3c
 def http_trace_parser_hook(request):
     """
     Retrieves the propagation context out of the request. Uses the honeycomb header, with W3C header as fallback.
+    The W3C headers are only looked at if there is no usable honeycomb header.
     """
     honeycomb_header_value = honeycomb.http_trace_parser_hook(request)
-    w3c_header_value = w3c.http_trace_parser_hook(request)
     if honeycomb_header_value:
         return honeycomb_header_value
-    else:
-        return w3c_header_value
+    return w3c.http_trace_parser_hook(request)
 
 
 def http_trace_propagation_hook(propagation_context):
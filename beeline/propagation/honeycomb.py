@@ -1,9 +1,17 @@
 import beeline
 from beeline.propagation import PropagationContext
 import base64
+import copy
+import functools
 import json
 from urllib.parse import quote, unquote
 
+# Inbound contexts are often identical across many requests, e.g. when a proxy
+# adds the same fields to each, so decoded contexts are kept in an LRU cache.
+CONTEXT_CACHE_SIZE = 1024
+# longer contexts are decoded every time, to bound the memory the cache uses
+MAX_CACHED_CONTEXT_LENGTH = 4096
+
 
 def http_trace_parser_hook(request):
     '''
@@ -41,23 +49,19 @@ def marshal_propagation_context(propagation_context):
     if not propagation_context:
         return None
 
-    # FIXME: Since ALL trace fields are in propagation_context, we may want to strip
-    # some automatically added trace fields that we DON'T want to propagate - e.g. request.*
+    # Trace fields that shouldn't be propagated, e.g. request.*, can be left out
+    # with a beeline.propagation.PropagationPolicy
     version = 1
-    trace_fields = base64.b64encode(json.dumps(
-        propagation_context.trace_fields).encode()).decode()
+    # cached on the trace, so usually only the IDs change between headers
+    trace_fields = propagation_context.encoded_trace_fields()
 
-    components = [f"trace_id={propagation_context.trace_id}",
-                  f"parent_id={propagation_context.parent_id}",
-                  f"context={trace_fields}"]
+    components = (f"trace_id={propagation_context.trace_id},"
+                  f"parent_id={propagation_context.parent_id},context={trace_fields}")
 
     if beeline.propagation.propagate_dataset and propagation_context.dataset:
-        components.insert(0, f"dataset={quote(propagation_context.dataset)}")
-
-    join_components = ",".join(components)
-    trace_header = f"{version};{join_components}"
+        return f"{version};dataset={quote(propagation_context.dataset)},{components}"
 
-    return trace_header
+    return f"{version};{components}"
 
 
 def unmarshal_propagation_context(trace_header):
@@ -94,7 +98,7 @@ def unmarshal_propagation_context_with_dataset(trace_header):
         elif k == 'parent_id':
             parent_id = v
         elif k == 'context':
-            context = json.loads(base64.b64decode(v.encode()).decode())
+            context = decode_context(v)
         elif k == 'dataset' and beeline.propagation.propagate_dataset:
             dataset = unquote(v)
 
@@ -103,3 +107,47 @@ def unmarshal_propagation_context_with_dataset(trace_header):
         context = {}
 
     return trace_id, parent_id, context, dataset
+
+
+def _decode_context(encoded_context):
+    return json.loads(base64.b64decode(encoded_context.encode()).decode())
+
+
+_decode_context_cached = functools.lru_cache(maxsize=CONTEXT_CACHE_SIZE)(_decode_context)
+
+
+def decode_context(encoded_context):
+    '''
+    Decodes the `context` segment of an `X-Honeycomb-Trace` header, using
+    the decode cache. The cached value is never handed out, so each caller
+    gets its own copy to modify.
+    '''
+    if len(encoded_context) > MAX_CACHED_CONTEXT_LENGTH:
+        return _decode_context(encoded_context)
+    return copy_context(_decode_context_cached(encoded_context))
+
+
+def copy_context(context):
+    '''
+    Returns a copy of a decoded context that shares nothing mutable with it.
+    Trace fields are mostly strings and numbers, so only nested dicts and
+    lists are deep copied.
+    '''
+    if isinstance(context, dict):
+        return {k: copy.deepcopy(v) if isinstance(v, (dict, list)) else v
+                for k, v in context.items()}
+    if isinstance(context, list):
+        return copy.deepcopy(context)
+    return context
+
+
+def context_cache_info():
+    '''
+    Returns the decode cache's hits, misses, maxsize and currsize, as a
+    `functools.lru_cache` cache_info named tuple.
+    '''
+    return _decode_context_cached.cache_info()
+
+
+def clear_context_cache():
+    _decode_context_cached.cache_clear()
@@ -0,0 +1,87 @@
+''' Jaeger propagation, with the `uber-trace-id` header:
+
+    {trace-id}:{span-id}:{parent-span-id}:{flags}
+
+Jaeger trace IDs may be 64 or 128 bits, with leading zeros left out. They are
+padded to 128 bits as the beeline and W3C use, and 64 bit IDs are sent
+downstream as 64 bit IDs again, so the upstream's trace ID survives the round
+trip. The sampled flag is put in the context's `sampled`.
+'''
+from urllib.parse import unquote
+
+import beeline
+from beeline.propagation import PropagationContext
+
+_HEX_DIGITS = "0123456789abcdef"
+# the high 64 bits of a 64 bit trace ID padded to 128 bits
+_TRACE_ID_PADDING = "0" * 16
+
+FLAG_SAMPLED = 0x01
+FLAG_DEBUG = 0x02
+
+
+def http_trace_parser_hook(request):
+    '''
+    Retrieves the Jaeger propagation context out of the request.
+    request must implement the beeline.propagation.Request abstract base class
+    '''
+    header = request.header('uber-trace-id')
+    if header:
+        try:
+            return unmarshal_propagation_context(header)
+        except Exception as e:
+            beeline.internal.log(
+                'error attempting to extract jaeger trace context: %s', beeline.internal.stringify_exception(e))
+    return None
+
+
+def http_trace_propagation_hook(propagation_context):
+    '''
+    Given a propagation context, returns a dictionary of key value pairs that should be
+    added to outbound requests (usually HTTP headers)
+    '''
+    if not propagation_context:
+        return None
+
+    return {"uber-trace-id": marshal_propagation_context(propagation_context)}
+
+
+def marshal_propagation_context(propagation_context):
+    '''
+    Given a propagation context, returns the contents of an uber-trace-id
+    header. Like the W3C traceparent, it is marked sampled unless the
+    context says otherwise.
+    '''
+    trace_id = propagation_context.trace_id
+    if len(trace_id) == 32 and trace_id.startswith(_TRACE_ID_PADDING):
+        trace_id = trace_id[16:]
+    flags = 0 if propagation_context.sampled is False else FLAG_SAMPLED
+    # the parent span ID is deprecated, and 0 when not used
+    return f"{trace_id}:{propagation_context.parent_id}:0:{flags:x}"
+
+
+def unmarshal_propagation_context(header):
+    '''
+    Given the uber-trace-id header, returns a PropagationContext, or None if
+    it isn't valid.
+    '''
+    if '%' in header:
+        # some clients URL encode the header
+        header = unquote(header)
+    parts = header.split(':')
+    if len(parts) != 4:
+        return None
+    trace_id, span_id, _, flags = parts
+
+    if not 0 < len(trace_id) <= 32 or not 0 < len(span_id) <= 16 or not 0 < len(flags) <= 2:
+        return None
+    if trace_id.strip(_HEX_DIGITS) or span_id.strip(_HEX_DIGITS) or flags.strip(_HEX_DIGITS):
+        return None
+    # leading zeros may have been left out
+    trace_id = trace_id.rjust(32, "0")
+    span_id = span_id.rjust(16, "0")
+    if not trace_id.strip("0") or not span_id.strip("0"):
+        return None
+
+    flags = int(flags, 16)
+    return PropagationContext(trace_id, span_id, {}, sampled=bool(flags & (FLAG_SAMPLED | FLAG_DEBUG)))
@@ -0,0 +1,110 @@
+import unittest
+from mock import Mock
+from beeline.propagation import DictRequest, PropagationContext
+from beeline.propagation import b3
+from beeline.trace import SynchronousTracer
+
+_TEST_TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+_TEST_TRACE_ID_64 = "8448eb211c80319c"
+_TEST_SPAN_ID = "b7ad6b7169203331"
+
+
+class TestB3Parsing(unittest.TestCase):
+    def test_single_header(self):
+        pc = b3.http_trace_parser_hook(DictRequest({
+            "b3": f"{_TEST_TRACE_ID}-{_TEST_SPAN_ID}-1-00f067aa0ba902b7"}))
+        self.assertEqual(pc.trace_id, _TEST_TRACE_ID)
+        self.assertEqual(pc.parent_id, _TEST_SPAN_ID)
+        self.assertEqual(pc.trace_fields, {})
+        self.assertTrue(pc.sampled)
+
+        for state, sampled in (("0", False), ("d", True)):
+            pc = b3.unmarshal_single_header(f"{_TEST_TRACE_ID}-{_TEST_SPAN_ID}-{state}")
+            self.assertEqual(pc.sampled, sampled)
+        pc = b3.unmarshal_single_header(f"{_TEST_TRACE_ID}-{_TEST_SPAN_ID}")
+        self.assertIsNone(pc.sampled)
+
+    def test_multi_header(self):
+        pc = b3.http_trace_parser_hook(DictRequest({
+            "X-B3-TraceId": _TEST_TRACE_ID,
+            "X-B3-SpanId": _TEST_SPAN_ID,
+            "X-B3-ParentSpanId": "00f067aa0ba902b7",
+            "X-B3-Sampled": "0",
+        }))
+        self.assertEqual(pc.trace_id, _TEST_TRACE_ID)
+        self.assertEqual(pc.parent_id, _TEST_SPAN_ID)
+        self.assertIs(pc.sampled, False)
+
+        self.assertIs(b3.unmarshal_multi_header(_TEST_TRACE_ID, _TEST_SPAN_ID, "true").sampled, True)
+        self.assertIs(b3.unmarshal_multi_header(_TEST_TRACE_ID, _TEST_SPAN_ID, flags="1").sampled, True)
+        self.assertIsNone(b3.unmarshal_multi_header(_TEST_TRACE_ID, _TEST_SPAN_ID).sampled)
+
+    def test_sampling_state_only(self):
+        for headers, sampled in (({"b3": "0"}, False),
+                                 ({"b3": "1"}, True),
+                                 ({"b3": "d"}, True),
+                                 ({"X-B3-Sampled": "0"}, False),
+                                 ({"X-B3-Flags": "1"}, True)):
+            pc = b3.http_trace_parser_hook(DictRequest(headers))
+            self.assertIsNone(pc.trace_id)
+            self.assertIsNone(pc.parent_id)
+            self.assertIs(pc.sampled, sampled)
+
+    def test_deny_respected_without_ids(self):
+        tracer = SynchronousTracer(Mock())
+        tracer.respect_parent_sampling = True
+        tracer.http_trace_parser_hook = b3.http_trace_parser_hook
+        root = tracer.propagate_and_start_trace({}, DictRequest({"b3": "0"}))
+        self.assertFalse(root.sampled)
+        self.assertIsNone(root.parent_id)
+        self.assertTrue(root.trace_id)
+        tracer.finish_trace(root)
+
+    def test_single_header_preferred(self):
+        pc = b3.http_trace_parser_hook(DictRequest({
+            "b3": f"{_TEST_TRACE_ID}-{_TEST_SPAN_ID}",
+            "X-B3-TraceId": "a" * 32,
+            "X-B3-SpanId": "b" * 16,
+        }))
+        self.assertEqual(pc.trace_id, _TEST_TRACE_ID)
+
+    def test_64_bit_trace_id_padded(self):
+        pc = b3.unmarshal_single_header(f"{_TEST_TRACE_ID_64}-{_TEST_SPAN_ID}")
+        self.assertEqual(pc.trace_id, "0000000000000000" + _TEST_TRACE_ID_64)
+
+    def test_invalid(self):
+        for header in ("x", "true",
+                       f"{_TEST_TRACE_ID}-{_TEST_SPAN_ID}-x",
+                       f"{_TEST_TRACE_ID[:20]}-{_TEST_SPAN_ID}",
+                       f"{_TEST_TRACE_ID.upper()}-{_TEST_SPAN_ID}",
+                       f"{'0' * 32}-{_TEST_SPAN_ID}",
+                       f"{_TEST_TRACE_ID}-{'0' * 16}",
+                       f"{_TEST_TRACE_ID}-{_TEST_SPAN_ID[:10]}"):
+            self.assertIsNone(b3.http_trace_parser_hook(DictRequest({"b3": header})), header)
+        self.assertIsNone(b3.http_trace_parser_hook(DictRequest({
+            "X-B3-TraceId": _TEST_TRACE_ID, "X-B3-SpanId": _TEST_SPAN_ID, "X-B3-Sampled": "yes"})))
+        self.assertIsNone(b3.http_trace_parser_hook(DictRequest({"X-B3-TraceId": _TEST_TRACE_ID})))
+        self.assertIsNone(b3.http_trace_parser_hook(DictRequest({})))
+
+
+class TestB3Propagation(unittest.TestCase):
+    def test_multi_header(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_SPAN_ID, {"key": "value"})
+        self.assertEqual(b3.http_trace_propagation_hook(pc), {
+            "X-B3-TraceId": _TEST_TRACE_ID,
+            "X-B3-SpanId": _TEST_SPAN_ID,
+        })
+        pc.sampled = False
+        self.assertEqual(b3.http_trace_propagation_hook(pc)["X-B3-Sampled"], "0")
+        self.assertIsNone(b3.http_trace_propagation_hook(None))
+
+    def test_single_header(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_SPAN_ID, {}, sampled=True)
+        self.assertEqual(b3.http_trace_single_header_propagation_hook(pc),
+                         {"b3": f"{_TEST_TRACE_ID}-{_TEST_SPAN_ID}-1"})
+        self.assertIsNone(b3.http_trace_single_header_propagation_hook(None))
+
+    def test_64_bit_trace_id_roundtrip(self):
+        pc = b3.unmarshal_single_header(f"{_TEST_TRACE_ID_64}-{_TEST_SPAN_ID}-0")
+        self.assertEqual(b3.marshal_single_header(pc), f"{_TEST_TRACE_ID_64}-{_TEST_SPAN_ID}-0")
+        self.assertEqual(b3.http_trace_propagation_hook(pc)["X-B3-TraceId"], _TEST_TRACE_ID_64)
@@ -0,0 +1,136 @@
+import base64
+import json
+import unittest
+import zlib
+from mock import Mock, patch
+import beeline.propagation
+from beeline.propagation import DictRequest, PropagationContext
+from beeline.propagation import compact
+from beeline.propagation import honeycomb as hc
+
+_TEST_TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+_TEST_PARENT_ID = "b7ad6b7169203331"
+
+
+class TestMarshalUnmarshal(unittest.TestCase):
+    def test_roundtrip(self):
+        '''Verify that we can successfully roundtrip (marshal and unmarshal)'''
+        trace_fields = {"key": "value", "number": 1}
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, trace_fields, "my dataset")
+        header = compact.marshal_propagation_context(pc)
+        self.assertEqual(compact.unmarshal_propagation_context_with_dataset(header),
+                         (_TEST_TRACE_ID, _TEST_PARENT_ID, trace_fields, "my dataset"))
+        # header safe, and smaller than the X-Honeycomb-Trace header
+        self.assertRegex(header, r'^[A-Za-z0-9_-]+$')
+        self.assertLess(len(header), len(hc.marshal_propagation_context(pc)))
+
+    def test_roundtrip_ids_of_any_shape(self):
+        for trace_id, parent_id in (("bloop", "scoop"),
+                                    ("ABCDEF", "0af7"),
+                                    ("été", "1234567"),
+                                    ("a" * 200, "b" * 300)):
+            pc = PropagationContext(trace_id, parent_id, {})
+            self.assertEqual(compact.decode(compact.encode(pc)), (trace_id, parent_id, {}, None))
+
+    def test_ids_sent_as_bytes(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {})
+        # version, flags, and a length byte before each ID
+        self.assertEqual(len(compact.encode(pc)), 2 + 1 + 16 + 1 + 8)
+
+    def test_large_trace_fields_compressed(self):
+        trace_fields = {f"app.field{i}": "value" for i in range(50)}
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, trace_fields)
+        data = compact.encode(pc)
+        self.assertTrue(data[1] & compact.FLAG_COMPRESSED)
+        self.assertLess(len(data), len(str(trace_fields)))
+        self.assertEqual(compact.decode(data)[2], trace_fields)
+
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"})
+        self.assertFalse(compact.encode(pc)[1] & compact.FLAG_COMPRESSED)
+
+    def test_invalid(self):
+        data = compact.encode(PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"}))
+        with self.assertRaises(ValueError):
+            compact.decode(data[:-3])
+        with self.assertRaises(ValueError):
+            compact.decode(data + b'\x00')
+        self.assertEqual(compact.decode(b'\x02' + data[1:]), (None, None, None, None))
+
+    def test_decompressed_size_limited(self):
+        compact.clear_context_cache()
+        self.addCleanup(compact.clear_context_cache)
+        large = {"key": "x" * compact.MAX_CACHED_CONTEXT_LENGTH}
+        value = zlib.compress(json.dumps(large).encode())
+        self.assertLess(len(value), compact.MAX_CACHED_CONTEXT_LENGTH)
+        # decoded, but not cached
+        self.assertEqual(compact.decode_context(value, True), large)
+        self.assertEqual(compact.context_cache_info().currsize, 0)
+
+        too_large = zlib.compress(json.dumps({"key": "x" * compact.MAX_CONTEXT_LENGTH}).encode())
+        with self.assertRaises(ValueError):
+            compact.decode_context(too_large, True)
+        with self.assertRaises(ValueError):
+            compact.decode_context(value[:-4], True)
+
+    def test_decoded_context_not_shared(self):
+        compact.clear_context_cache()
+        data = compact.encode(PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"}))
+        _, _, context, _ = compact.decode(data)
+        context["key"] = "changed"
+        _, _, context, _ = compact.decode(data)
+        self.assertEqual(context, {"key": "value"})
+
+    def test_encoded_trace_fields_cached_on_trace(self):
+        tracer = beeline.trace.SynchronousTracer(Mock())
+        tracer.start_trace(trace_id=_TEST_TRACE_ID)
+        tracer.add_trace_field("key", "value")
+
+        with patch('beeline.propagation.compact._json_encoder') as m_encoder:
+            m_encoder.encode.return_value = '{"app.key":"value"}'
+            data = compact.encode(tracer.get_propagation_context())
+            tracer.start_span()
+            data2 = compact.encode(tracer.get_propagation_context())
+            self.assertEqual(m_encoder.encode.call_count, 1)
+            self.assertNotEqual(data, data2)
+            # the honeycomb encoding is cached separately
+            hc.marshal_propagation_context(tracer.get_propagation_context())
+            self.assertEqual(compact.decode(data2)[2], {"app.key": "value"})
+
+
+class TestCompactHooks(unittest.TestCase):
+    def test_http_roundtrip(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"})
+        headers = compact.http_trace_propagation_hook(pc)
+        self.assertEqual(list(headers), ["X-Honeycomb-Trace-Bin"])
+        new_pc = compact.http_trace_parser_hook(DictRequest(headers))
+        self.assertEqual(new_pc.trace_id, _TEST_TRACE_ID)
+        self.assertEqual(new_pc.parent_id, _TEST_PARENT_ID)
+        self.assertEqual(new_pc.trace_fields, {"key": "value"})
+
+    def test_attributes_roundtrip(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"})
+        attributes = compact.attributes_propagation_hook(pc)
+        self.assertIsInstance(attributes["honeycomb-trace-bin"], bytes)
+        new_pc = compact.attributes_parser_hook(attributes)
+        self.assertEqual(new_pc.trace_id, _TEST_TRACE_ID)
+        self.assertEqual(new_pc.parent_id, _TEST_PARENT_ID)
+        self.assertEqual(new_pc.trace_fields, {"key": "value"})
+
+    def test_no_context(self):
+        self.assertIsNone(compact.http_trace_propagation_hook(None))
+        self.assertIsNone(compact.attributes_propagation_hook(None))
+        self.assertIsNone(compact.http_trace_parser_hook(DictRequest({})))
+        self.assertIsNone(compact.attributes_parser_hook({}))
+
+    def test_invalid_header_ignored(self):
+        request = DictRequest({"X-Honeycomb-Trace-Bin": "AQAh"})
+        self.assertIsNone(compact.http_trace_parser_hook(request))
+
+    def test_unsupported_version_ignored(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"})
+        data = b'\x02' + compact.encode(pc)[1:]
+        header = compact.marshal_propagation_context(pc)
+        self.assertIsNotNone(compact.http_trace_parser_hook(DictRequest({"X-Honeycomb-Trace-Bin": header})))
+        header = base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+        self.assertIsNone(compact.http_trace_parser_hook(DictRequest({"X-Honeycomb-Trace-Bin": header})))
+        self.assertIsNone(compact.attributes_parser_hook({"honeycomb-trace-bin": data}))
@@ -0,0 +1,59 @@
+import unittest
+from mock import Mock, patch
+import beeline.propagation
+from beeline.propagation import DictRequest, PropagationContext
+from beeline.propagation import compact, honeycomb, w3c
+from beeline.propagation.composite import CompositePropagator
+
+_TEST_TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+_TEST_PARENT_ID = "b7ad6b7169203331"
+
+
+class TestCompositePropagator(unittest.TestCase):
+    def test_propagation_emits_every_format(self):
+        propagator = CompositePropagator()
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"})
+        headers = propagator.http_trace_propagation_hook(pc)
+        self.assertEqual(headers, {
+            "X-Honeycomb-Trace": honeycomb.marshal_propagation_context(pc),
+            "traceparent": f"00-{_TEST_TRACE_ID}-{_TEST_PARENT_ID}-01",
+        })
+        self.assertIsNone(propagator.http_trace_propagation_hook(None))
+
+    def test_parser_uses_first_format_found(self):
+        propagator = CompositePropagator([compact, honeycomb, w3c])
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"key": "value"})
+        headers = propagator.http_trace_propagation_hook(pc)
+        self.assertEqual(set(headers), {"X-Honeycomb-Trace-Bin", "X-Honeycomb-Trace", "traceparent"})
+
+        with patch('beeline.propagation.honeycomb.http_trace_parser_hook') as m_honeycomb:
+            propagator = CompositePropagator([compact, honeycomb, w3c])
+            new_pc = propagator.http_trace_parser_hook(DictRequest(headers))
+            m_honeycomb.assert_not_called()
+        self.assertEqual(new_pc.trace_fields, {"key": "value"})
+
+        propagator = CompositePropagator([compact, honeycomb, w3c])
+        w3c_headers = {"traceparent": headers["traceparent"]}
+        new_pc = propagator.http_trace_parser_hook(DictRequest(w3c_headers))
+        self.assertEqual((new_pc.trace_id, new_pc.parent_id), (_TEST_TRACE_ID, _TEST_PARENT_ID))
+        self.assertIsNone(propagator.http_trace_parser_hook(DictRequest({})))
+
+    def test_broken_format_skipped(self):
+        broken = Mock()
+        broken.http_trace_propagation_hook.side_effect = ValueError("nope")
+        propagator = CompositePropagator([broken, w3c])
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {})
+        self.assertEqual(list(propagator.http_trace_propagation_hook(pc)), ["traceparent"])
+
+    def test_trace_fields_encoded_once(self):
+        propagator = CompositePropagator([honeycomb, w3c, compact])
+        tracer = beeline.trace.SynchronousTracer(Mock())
+        tracer.start_trace(trace_id=_TEST_TRACE_ID)
+        tracer.add_trace_field("key", "value")
+        with patch('beeline.propagation.encode_trace_fields',
+                   wraps=beeline.propagation.encode_trace_fields) as m_encode:
+            for _ in range(3):
+                tracer.start_span()
+                headers = propagator.http_trace_propagation_hook(tracer.get_propagation_context())
+            self.assertEqual(m_encode.call_count, 1)
+        self.assertEqual(len(headers), 3)
@@ -1,4 +1,5 @@
 import unittest
+from mock import Mock, patch
 import beeline.propagation
 from beeline.propagation import DictRequest, PropagationContext
 import beeline.propagation.honeycomb as hc
@@ -20,6 +21,95 @@ class TestMarshalUnmarshal(unittest.TestCase):
         self.assertEqual(parent_id, new_parent_id)
         self.assertEqual(trace_fields, new_trace_fields)
 
+    def test_encoded_trace_fields_cached_on_trace(self):
+        '''The encoded context is reused until the trace fields change'''
+        tracer = beeline.trace.SynchronousTracer(Mock())
+        tracer.start_trace(trace_id="bloop")
+        tracer.add_trace_field("key", "value")
+
+        with patch('beeline.propagation.encode_trace_fields',
+                   wraps=beeline.propagation.encode_trace_fields) as m_encode:
+            header = hc.marshal_propagation_context(tracer.get_propagation_context())
+            tracer.start_span()
+            header2 = hc.marshal_propagation_context(tracer.get_propagation_context())
+            self.assertEqual(m_encode.call_count, 1)
+            # only the parent ID differs
+            self.assertNotEqual(header, header2)
+            self.assertEqual(header.split(',context=')[1], header2.split(',context=')[1])
+
+            tracer.add_trace_field("more", "values")
+            header3 = hc.marshal_propagation_context(tracer.get_propagation_context())
+            self.assertEqual(m_encode.call_count, 2)
+
+            tracer.remove_trace_field("key")
+            hc.marshal_propagation_context(tracer.get_propagation_context())
+            self.assertEqual(m_encode.call_count, 3)
+
+        _, _, trace_fields = hc.unmarshal_propagation_context(header3)
+        self.assertEqual(trace_fields, {"app.key": "value", "app.more": "values"})
+
+    def test_propagation_policy(self):
+        '''Only the trace fields allowed by the policy are propagated, and the
+        filtered fields are cached on the trace'''
+        tracer = beeline.trace.SynchronousTracer(Mock())
+        tracer.propagation_policy = beeline.propagation.PropagationPolicy(deny=['app.request.'])
+        tracer.start_trace(trace_id="bloop")
+        tracer.add_trace_field("tenant", "acme")
+        tracer.add_trace_field("request.path", "/very/long/path")
+
+        pc = tracer.get_propagation_context()
+        self.assertEqual(pc.trace_fields, {"app.tenant": "acme"})
+        self.assertIs(tracer.get_propagation_context().trace_fields, pc.trace_fields)
+
+        with patch('beeline.propagation.encode_trace_fields',
+                   wraps=beeline.propagation.encode_trace_fields) as m_encode:
+            header = hc.marshal_propagation_context(pc)
+            hc.marshal_propagation_context(tracer.get_propagation_context())
+            self.assertEqual(m_encode.call_count, 1)
+        _, _, trace_fields = hc.unmarshal_propagation_context(header)
+        self.assertEqual(trace_fields, {"app.tenant": "acme"})
+
+        tracer.add_trace_field("user", "u")
+        self.assertEqual(tracer.get_propagation_context().trace_fields,
+                         {"app.tenant": "acme", "app.user": "u"})
+
+    def test_decode_cache(self):
+        '''Repeated contexts are decoded once, and each caller gets its own dict'''
+        hc.clear_context_cache()
+        self.addCleanup(hc.clear_context_cache)
+        pc = PropagationContext("bloop", "scoop", {"tenant": "acme", "build": "abc123"})
+        header = hc.marshal_propagation_context(pc)
+
+        _, _, context = hc.unmarshal_propagation_context(header)
+        context['mutated'] = True
+        _, _, context2 = hc.unmarshal_propagation_context(header)
+        self.assertEqual(context2, {"tenant": "acme", "build": "abc123"})
+        self.assertIsNot(context, context2)
+
+        info = hc.context_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+    def test_decode_cache_nested_values_not_shared(self):
+        hc.clear_context_cache()
+        self.addCleanup(hc.clear_context_cache)
+        pc = PropagationContext("bloop", "scoop", {"user": {"id": 1, "roles": ["admin"]}})
+        header = hc.marshal_propagation_context(pc)
+
+        _, _, context = hc.unmarshal_propagation_context(header)
+        context["user"]["id"] = 2
+        context["user"]["roles"].append("owner")
+        _, _, context2 = hc.unmarshal_propagation_context(header)
+        self.assertEqual(context2, {"user": {"id": 1, "roles": ["admin"]}})
+        self.assertEqual(hc.context_cache_info().hits, 1)
+
+    def test_decode_cache_skips_long_contexts(self):
+        hc.clear_context_cache()
+        self.addCleanup(hc.clear_context_cache)
+        pc = PropagationContext("bloop", "scoop", {"big": "x" * hc.MAX_CACHED_CONTEXT_LENGTH})
+        _, _, context = hc.unmarshal_propagation_context(hc.marshal_propagation_context(pc))
+        self.assertEqual(context, pc.trace_fields)
+        self.assertEqual(hc.context_cache_info().currsize, 0)
+
     def test_roundtrip_with_dataset(self):
         '''Verify that we can successfully roundtrip (marshal and unmarshal)'''
         beeline.propagation.propagate_dataset = True
@@ -0,0 +1,60 @@
+import unittest
+from beeline.propagation import DictRequest, PropagationContext
+from beeline.propagation import jaeger
+
+_TEST_TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+_TEST_TRACE_ID_64 = "8448eb211c80319c"
+_TEST_SPAN_ID = "b7ad6b7169203331"
+
+
+class TestJaegerParsing(unittest.TestCase):
+    def test_parse(self):
+        pc = jaeger.http_trace_parser_hook(DictRequest({
+            "uber-trace-id": f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}:0:1"}))
+        self.assertEqual(pc.trace_id, _TEST_TRACE_ID)
+        self.assertEqual(pc.parent_id, _TEST_SPAN_ID)
+        self.assertEqual(pc.trace_fields, {})
+        self.assertIs(pc.sampled, True)
+
+        self.assertIs(jaeger.unmarshal_propagation_context(
+            f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}:0:0").sampled, False)
+        # debug implies sampled
+        self.assertIs(jaeger.unmarshal_propagation_context(
+            f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}:0:2").sampled, True)
+
+    def test_short_ids_padded(self):
+        pc = jaeger.unmarshal_propagation_context("abc:def:0:1")
+        self.assertEqual(pc.trace_id, "0" * 29 + "abc")
+        self.assertEqual(pc.parent_id, "0" * 13 + "def")
+
+    def test_url_encoded(self):
+        pc = jaeger.unmarshal_propagation_context(f"{_TEST_TRACE_ID}%3A{_TEST_SPAN_ID}%3A0%3A1")
+        self.assertEqual(pc.trace_id, _TEST_TRACE_ID)
+        self.assertEqual(pc.parent_id, _TEST_SPAN_ID)
+
+    def test_invalid(self):
+        for header in (f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}:0",
+                       f"{_TEST_TRACE_ID}1:{_TEST_SPAN_ID}:0:1",
+                       f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}1:0:1",
+                       f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}:0:",
+                       f"{_TEST_TRACE_ID}:xyz:0:1",
+                       f"0:{_TEST_SPAN_ID}:0:1",
+                       f"{_TEST_TRACE_ID}:000:0:1"):
+            self.assertIsNone(jaeger.http_trace_parser_hook(DictRequest({"uber-trace-id": header})), header)
+        self.assertIsNone(jaeger.http_trace_parser_hook(DictRequest({})))
+
+
+class TestJaegerPropagation(unittest.TestCase):
+    def test_propagation(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_SPAN_ID, {"key": "value"})
+        self.assertEqual(jaeger.http_trace_propagation_hook(pc),
+                         {"uber-trace-id": f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}:0:1"})
+        pc.sampled = False
+        self.assertEqual(jaeger.marshal_propagation_context(pc), f"{_TEST_TRACE_ID}:{_TEST_SPAN_ID}:0:0")
+        self.assertIsNone(jaeger.http_trace_propagation_hook(None))
+
+    def test_64_bit_trace_id_roundtrip(self):
+        header = f"{_TEST_TRACE_ID_64}:{_TEST_SPAN_ID}:0:1"
+        pc = jaeger.unmarshal_propagation_context(header)
+        self.assertEqual(pc.trace_id, "0" * 16 + _TEST_TRACE_ID_64)
+        self.assertEqual(jaeger.marshal_propagation_context(pc), header)
@@ -1,5 +1,7 @@
 import unittest
+from mock import patch
 import beeline.propagation
+from beeline.propagation import default
 
 header_value = '1;trace_id=bloop,parent_id=scoop,context=e30K'
 
@@ -18,6 +20,20 @@ class TestDictRequest(unittest.TestCase):
         value = request.header('upperCaseHeader')
         self.assertEqual(value, "value")
 
+    def test_keymap_only_built_when_needed(self):
+        request = beeline.propagation.DictRequest({
+            'x-honeycomb-trace': "lower",
+            'traceparent': "exact",
+            'MixedCaseHeader': "value",
+        })
+        self.assertEqual(request.header('X-Honeycomb-Trace'), "lower")
+        self.assertEqual(request.header('traceparent'), "exact")
+        self.assertIsNone(request._keys._keymap)
+
+        self.assertEqual(request.header('mixedcaseheader'), "value")
+        self.assertIsNone(request.header('tracestate'))
+        self.assertIsNotNone(request._keys._keymap)
+
     def test_request_props(self):
         '''Test we correctly return request props'''
         request = beeline.propagation.DictRequest({
@@ -38,3 +54,80 @@ class TestDictRequest(unittest.TestCase):
         self.assertEqual(request.host(), "api.honeycomb.io")
         self.assertEqual(request.path(), "/1/event")
         self.assertEqual(request.query(), "key=value")
+
+
+class TestDefaultHTTPTraceParserHook(unittest.TestCase):
+    def test_honeycomb_header_short_circuits(self):
+        request = beeline.propagation.DictRequest({
+            'X-Honeycomb-Trace': header_value,
+            'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01',
+        })
+        with patch('beeline.propagation.w3c.http_trace_parser_hook') as m_w3c:
+            pc = default.http_trace_parser_hook(request)
+            m_w3c.assert_not_called()
+        self.assertEqual(pc.trace_id, 'bloop')
+
+    def test_w3c_fallback(self):
+        request = beeline.propagation.DictRequest({
+            'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01',
+        })
+        pc = default.http_trace_parser_hook(request)
+        self.assertEqual(pc.trace_id, '0af7651916cd43dd8448eb211c80319c')
+        self.assertIsNone(default.http_trace_parser_hook(beeline.propagation.DictRequest({})))
+
+
+class TestPropagationPolicy(unittest.TestCase):
+    def test_allow_and_deny(self):
+        fields = {'app.tenant': 'acme', 'app.tenant_tier': 'gold', 'app.request.path': '/x', 'app.user': 'u'}
+        policy = beeline.propagation.PropagationPolicy(allow=['app.tenant', 'app.request.'])
+        self.assertEqual(policy.filter(fields), {
+            'app.tenant': 'acme', 'app.tenant_tier': 'gold', 'app.request.path': '/x'})
+
+        policy = beeline.propagation.PropagationPolicy(deny=['app.request.'])
+        self.assertEqual(policy.filter(fields), {
+            'app.tenant': 'acme', 'app.tenant_tier': 'gold', 'app.user': 'u'})
+
+        policy = beeline.propagation.PropagationPolicy(allow=['app.tenant'], deny=['app.tenant_'])
+        self.assertEqual(policy.filter(fields), {'app.tenant': 'acme'})
+        # verdicts are remembered per name
+        self.assertEqual(policy._verdicts['app.user'], False)
+        self.assertEqual(policy.filter(fields), {'app.tenant': 'acme'})
+
+        # the input isn't modified
+        self.assertEqual(len(fields), 4)
+
+    def test_max_bytes(self):
+        fields = {'app.a': 'x' * 10, 'app.b': 'y' * 100, 'app.c': 1}
+        policy = beeline.propagation.PropagationPolicy(max_bytes=80)
+        filtered = policy.filter(fields)
+        # the most recently added fields are dropped first
+        self.assertEqual(filtered, {'app.a': 'x' * 10})
+        self.assertLessEqual(len(beeline.propagation.encode_trace_fields(filtered)), 80)
+
+        # exactly at the limit is fine
+        limit = len(beeline.propagation.encode_trace_fields(fields))
+        policy = beeline.propagation.PropagationPolicy(max_bytes=limit)
+        self.assertEqual(policy.filter(fields), fields)
+        policy = beeline.propagation.PropagationPolicy(max_bytes=limit - 1)
+        self.assertEqual(policy.filter(fields), {'app.a': 'x' * 10, 'app.b': 'y' * 100})
+
+    def test_unencodable_fields_dropped(self):
+        policy = beeline.propagation.PropagationPolicy(max_bytes=1000)
+        self.assertEqual(policy.filter({'app.a': 1, 'app.b': object()}), {'app.a': 1})
+
+
+class TestHeaderKeys(unittest.TestCase):
+    def test_environ_header_key(self):
+        self.assertEqual(beeline.propagation.environ_header_key('X-Honeycomb-Trace'), 'HTTP_X_HONEYCOMB_TRACE')
+        self.assertEqual(beeline.propagation.environ_header_key('uber-trace-id'), 'HTTP_UBER_TRACE_ID')
+        self.assertEqual(beeline.propagation.environ_header_key('x-custom-header'), 'HTTP_X_CUSTOM_HEADER')
+        self.assertEqual(beeline.propagation._ENVIRON_HEADER_KEYS['x-custom-header'], 'HTTP_X_CUSTOM_HEADER')
+
+    def test_lower_header_key(self):
+        self.assertEqual(beeline.propagation.lower_header_key('X-B3-TraceId'), 'x-b3-traceid')
+        self.assertEqual(beeline.propagation.lower_header_key('X-Custom-Header'), 'x-custom-header')
+
+    def test_cache_is_bounded(self):
+        with patch.object(beeline.propagation, 'MAX_CACHED_HEADER_KEYS', 0):
+            self.assertEqual(beeline.propagation.environ_header_key('X-Uncached'), 'HTTP_X_UNCACHED')
+        self.assertNotIn('X-Uncached', beeline.propagation._ENVIRON_HEADER_KEYS)
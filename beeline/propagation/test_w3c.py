@@ -1,6 +1,6 @@
 import unittest
 from beeline.propagation import DictRequest, PropagationContext
-from beeline.propagation import w3c
+from beeline.propagation import compact, honeycomb, w3c
 
 _TEST_TRACEPARENT_HEADER = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00"
 _TEST_TRACEPARENT_HEADER_DEFAULT_TRACEFLAGS = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
@@ -59,6 +59,17 @@ class TestW3CHTTPTraceParserHook(unittest.TestCase):
         pc = w3c.http_trace_parser_hook(req)
         self.assertIsNone(pc)
 
+    def test_sampled_flag(self):
+        pc = w3c.http_trace_parser_hook(DictRequest(_TEST_HEADERS))
+        self.assertIs(pc.sampled, False)
+        pc = w3c.http_trace_parser_hook(DictRequest({
+            "traceparent": _TEST_TRACEPARENT_HEADER_DEFAULT_TRACEFLAGS}))
+        self.assertIs(pc.sampled, True)
+        # other flags don't matter
+        pc = w3c.http_trace_parser_hook(DictRequest({
+            "traceparent": _TEST_TRACEPARENT_HEADER[:-2] + "02"}))
+        self.assertIs(pc.sampled, False)
+
 
 class TestW3CHTTPTracePropagationHook(unittest.TestCase):
     def test_generates_correct_headers(self):
@@ -74,6 +85,21 @@ class TestW3CHTTPTracePropagationHook(unittest.TestCase):
         self.assertEqual(headers['tracestate'],
                          _TEST_TRACESTATE_HEADER)
 
+    def test_unsampled_context_without_trace_flags(self):
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {}, sampled=False)
+        self.assertEqual(w3c.marshal_traceparent(pc), _TEST_TRACEPARENT_HEADER)
+
+    def test_sampling_decision_keeps_other_flags(self):
+        traceparent = _TEST_TRACEPARENT_HEADER[:-2]
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID,
+                                {"traceflags": "03"}, sampled=False)
+        self.assertEqual(w3c.marshal_traceparent(pc), traceparent + "02")
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID,
+                                {"traceflags": "02"}, sampled=True)
+        self.assertEqual(w3c.marshal_traceparent(pc), traceparent + "03")
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"traceflags": "03"})
+        self.assertEqual(w3c.marshal_traceparent(pc), traceparent + "03")
+
     def test_defaults_trace_flags_to_sampled(self):
         pc = PropagationContext(
             _TEST_TRACE_ID, _TEST_PARENT_ID
@@ -82,3 +108,133 @@ class TestW3CHTTPTracePropagationHook(unittest.TestCase):
         self.assertIn('traceparent', headers)
         self.assertEqual(headers['traceparent'],
                          _TEST_TRACEPARENT_HEADER_DEFAULT_TRACEFLAGS)
+
+
+class TestW3CUnmarshalTraceparent(unittest.TestCase):
+    def test_version_00(self):
+        self.assertEqual(w3c.unmarshal_traceparent(_TEST_TRACEPARENT_HEADER),
+                         (_TEST_TRACE_ID, _TEST_PARENT_ID, _TEST_TRACE_FLAGS))
+        # padding whitespace is allowed
+        self.assertEqual(w3c.unmarshal_traceparent(" \t" + _TEST_TRACEPARENT_HEADER + " "),
+                         (_TEST_TRACE_ID, _TEST_PARENT_ID, _TEST_TRACE_FLAGS))
+
+    def test_invalid_version_00(self):
+        for header in [
+            _TEST_TRACEPARENT_HEADER.upper(),
+            _TEST_TRACEPARENT_HEADER[:10] + "g" + _TEST_TRACEPARENT_HEADER[11:],
+            _TEST_TRACEPARENT_HEADER[:-1] + "z",
+            _TEST_TRACEPARENT_HEADER + "-extra",
+            _TEST_TRACEPARENT_HEADER[:-1],
+            "00-" + "0" * 32 + "-b7ad6b7169203331-01",
+            "00-0af7651916cd43dd8448eb211c80319c-" + "0" * 16 + "-01",
+            "00_0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01",
+        ]:
+            self.assertIsNone(w3c.unmarshal_traceparent(header), header)
+
+    def test_future_versions(self):
+        # later versions may add fields, which we ignore
+        self.assertEqual(w3c.unmarshal_traceparent("01-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01-what"),
+                         (_TEST_TRACE_ID, _TEST_PARENT_ID, "01"))
+        self.assertIsNone(w3c.unmarshal_traceparent("ff-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"))
+
+
+class TestTraceState(unittest.TestCase):
+    def test_passed_through_unparsed(self):
+        ts = w3c.unmarshal_tracestate(_TEST_TRACESTATE_HEADER)
+        self.assertEqual(str(ts), _TEST_TRACESTATE_HEADER)
+        self.assertIsNone(ts._members)
+        self.assertEqual(ts, _TEST_TRACESTATE)
+        self.assertIsNone(w3c.unmarshal_tracestate(None))
+
+    def test_lookup(self):
+        ts = w3c.TraceState("foo=bar, bar=baz,  ,foo=dup")
+        self.assertEqual(ts["foo"], "bar")
+        self.assertEqual(ts.get("bar"), "baz")
+        self.assertIsNone(ts.get("nope"))
+        self.assertIn("bar", ts)
+        self.assertEqual(list(ts), ["foo", "bar"])
+        self.assertEqual(len(ts), 2)
+        # the duplicate is dropped from the header
+        self.assertEqual(str(ts), "foo=bar,bar=baz")
+
+    def test_invalid_members_dropped(self):
+        ts = w3c.TraceState("foo=bar,Upper=case,nosep,ok@vendor=1,bad=val=ue")
+        self.assertEqual(len(ts), 2)
+        self.assertEqual(str(ts), "foo=bar,ok@vendor=1")
+
+    def test_set_moves_member_to_front(self):
+        ts = w3c.TraceState(_TEST_TRACESTATE_HEADER)
+        ts["hny"] = "abc"
+        self.assertEqual(str(ts), "hny=abc,foo=bar,bar=baz")
+        ts["bar"] = "new"
+        self.assertEqual(str(ts), "bar=new,hny=abc,foo=bar")
+        del ts["hny"]
+        self.assertEqual(str(ts), "bar=new,foo=bar")
+        with self.assertRaises(ValueError):
+            ts["Bad"] = "x"
+        with self.assertRaises(ValueError):
+            ts["ok"] = "bad,value"
+
+    def test_serialized_form_cached(self):
+        ts = w3c.TraceState(_TEST_TRACESTATE_HEADER)
+        ts["hny"] = "abc"
+        header = str(ts)
+        self.assertIs(str(ts), header)
+        ts["hny"] = "def"
+        self.assertIsNot(str(ts), header)
+
+    def test_member_limit(self):
+        ts = w3c.TraceState(",".join(f"k{i}=v" for i in range(40)))
+        self.assertEqual(len(ts), 32)
+        self.assertEqual(list(ts)[-1], "k31")
+        ts["new"] = "v"
+        self.assertEqual(len(ts), 32)
+        self.assertEqual(list(ts)[0], "new")
+        self.assertNotIn("k31", ts)
+
+    def test_length_limit(self):
+        ts = w3c.TraceState()
+        ts["small"] = "v"
+        ts["long"] = "x" * 200
+        for i in range(20):
+            ts[f"key{i:02d}"] = "y" * 10
+        header = str(ts)
+        self.assertLessEqual(len(header), w3c.TraceState.MAX_LENGTH)
+        # the long member goes first, even though others are older
+        self.assertNotIn("long", ts)
+        self.assertIn("small", ts)
+
+        ts = w3c.TraceState()
+        for i in range(30):
+            ts[f"key{i:02d}"] = "z" * 20
+        self.assertLessEqual(len(str(ts)), w3c.TraceState.MAX_LENGTH)
+        # the oldest members are dropped from the end
+        self.assertIn("key29", ts)
+        self.assertNotIn("key00", ts)
+
+    def test_marshal(self):
+        ts = w3c.TraceState(_TEST_TRACESTATE_HEADER)
+        ts["hny"] = "abc"
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"tracestate": ts})
+        self.assertEqual(w3c.http_trace_propagation_hook(pc)["tracestate"], "hny=abc,foo=bar,bar=baz")
+
+        pc = PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"tracestate": w3c.TraceState()})
+        self.assertNotIn("tracestate", w3c.http_trace_propagation_hook(pc))
+
+    def test_other_formats(self):
+        # a context parsed from W3C headers can be sent on in other formats
+        pc = w3c.http_trace_parser_hook(DictRequest(_TEST_HEADERS))
+        ts = pc.trace_fields["tracestate"]
+        ts["hny"] = "abc"
+
+        header = honeycomb.http_trace_propagation_hook(pc)["X-Honeycomb-Trace"]
+        _, _, trace_fields, _ = honeycomb.unmarshal_propagation_context_with_dataset(header)
+        self.assertEqual(trace_fields["tracestate"], "hny=abc,foo=bar,bar=baz")
+        self.assertEqual(trace_fields["traceflags"], _TEST_TRACE_FLAGS)
+
+        _, _, trace_fields, _ = compact.decode(compact.encode(pc))
+        self.assertEqual(trace_fields["tracestate"], "hny=abc,foo=bar,bar=baz")
+
+        with self.assertRaises(TypeError):
+            honeycomb.marshal_propagation_context(
+                PropagationContext(_TEST_TRACE_ID, _TEST_PARENT_ID, {"obj": object()}))
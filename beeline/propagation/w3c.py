@@ -1,5 +1,6 @@
 import beeline
 from beeline.propagation import PropagationContext
+from collections import OrderedDict
 import re
 
 # Cribbed from OpenTelemetry python implementation.
@@ -10,6 +11,18 @@ _TRACEPARENT_HEADER_FORMAT = (
 _TRACEPARENT_HEADER_FORMAT_RE = re.compile(_TRACEPARENT_HEADER_FORMAT)
 _EMPTY_TRACE_ID = "0" * 32
 _EMPTY_PARENT_ID = "0" * 16
+_HEX_DIGITS = "0123456789abcdef"
+# version-00 traceparents are always "00-<trace id>-<parent id>-<flags>"
+_TRACEPARENT_V00_LENGTH = 55
+_TRACE_FLAG_SAMPLED = 0x01
+
+# Also from OpenTelemetry, following the tracestate grammar in the W3C spec.
+_TRACESTATE_KEY_FORMAT_RE = re.compile(
+    r"[a-z][_0-9a-z\-\*\/]{0,255}|[a-z0-9][_0-9a-z\-\*\/]{0,240}@[a-z][_0-9a-z\-\*\/]{0,13}")
+_TRACESTATE_VALUE_FORMAT_RE = re.compile(
+    r"[\x20-\x2b\x2d-\x3c\x3e-\x7e]{0,255}[\x21-\x2b\x2d-\x3c\x3e-\x7e]")
+# members longer than this are the first to go when the header is too long
+_TRACESTATE_LONG_MEMBER_LENGTH = 128
 
 
 def http_trace_parser_hook(request):
@@ -31,7 +44,8 @@ def http_trace_parser_hook(request):
         trace_fields = {}
         trace_fields['traceflags'] = trace_flags
         trace_fields['tracestate'] = tracestate
-        return PropagationContext(trace_id, parent_id, trace_fields)
+        return PropagationContext(trace_id, parent_id, trace_fields,
+                                  sampled=bool(int(trace_flags, 16) & _TRACE_FLAG_SAMPLED))
     except Exception as e:
         beeline.internal.log(
             'error attempting to extract w3c trace: %s', beeline.internal.stringify_exception(e))
@@ -68,9 +82,17 @@ def marshal_traceparent(propagation_context):
     if not propagation_context:
         return None
 
+    # keep whatever flags we received and only set or clear the sampled bit
     trace_flags = propagation_context.trace_fields.get('traceflags')
-    if not trace_flags:
-        trace_flags = "01"
+    try:
+        flags = int(trace_flags, 16) if trace_flags else _TRACE_FLAG_SAMPLED
+    except ValueError:
+        flags = _TRACE_FLAG_SAMPLED
+    if propagation_context.sampled is False:
+        flags &= ~_TRACE_FLAG_SAMPLED
+    elif propagation_context.sampled is True:
+        flags |= _TRACE_FLAG_SAMPLED
+    trace_flags = f"{flags & 0xff:02x}"
 
     traceparent_header = f"00-{propagation_context.trace_id}-{propagation_context.parent_id}-{trace_flags}"
 
@@ -84,11 +106,29 @@ def marshal_tracestate(propagation_context):
         return None
 
     tracestate_header = propagation_context.trace_fields.get('tracestate')
+    if isinstance(tracestate_header, TraceState):
+        # only serialized again if it was changed
+        return str(tracestate_header) or None
     return tracestate_header
 
 
 def unmarshal_traceparent(header):
-    match = re.search(_TRACEPARENT_HEADER_FORMAT_RE, header)
+    # Fast path for version 00, the only version defined so far, which has
+    # every component at a fixed offset. Anything else, including padding
+    # whitespace, is left to the regex.
+    if (len(header) == _TRACEPARENT_V00_LENGTH and header.startswith("00-")
+            and header[35] == "-" and header[52] == "-"):
+        trace_id = header[3:35]
+        parent_id = header[36:52]
+        trace_flags = header[53:]
+        # stripping the hex digits leaves nothing if that's all there is
+        if trace_id.strip(_HEX_DIGITS) or parent_id.strip(_HEX_DIGITS) or trace_flags.strip(_HEX_DIGITS):
+            return None
+        if trace_id == _EMPTY_TRACE_ID or parent_id == _EMPTY_PARENT_ID:
+            return None
+        return trace_id, parent_id, trace_flags
+
+    match = _TRACEPARENT_HEADER_FORMAT_RE.match(header)
     if not match:
         # Raise exception?
         return None
@@ -110,5 +150,126 @@ def unmarshal_traceparent(header):
 
 
 def unmarshal_tracestate(header):
-    # We treat the tracestate header as an opaque blob, and don't parse it at all.
-    return header
+    # The header is only parsed if its members are looked at or changed.
+    if header is None:
+        return None
+    return TraceState(header)
+
+
+class TraceState(object):
+    '''
+    The W3C tracestate header: an ordered mapping of vendor keys to values,
+    most recently updated first.
+
+    The header is parsed the first time its members are used, and the
+    serialized header is cached until they change, so a tracestate that is
+    passed through untouched costs nothing. The spec's limits of 32 members
+    and 512 bytes are enforced by dropping members from the end. Compares
+    equal to its serialized header.
+    '''
+
+    MAX_MEMBERS = 32
+    MAX_LENGTH = 512
+
+    def __init__(self, header=''):
+        # the serialized header, or None when members have changed since
+        self._header = header
+        # key -> value, parsed from the header on first use
+        self._members = None
+
+    def _parsed(self):
+        if self._members is None:
+            members = OrderedDict()
+            dropped = False
+            for member in self._header.split(','):
+                member = member.strip(' \t')
+                if not member:
+                    continue
+                key, sep, value = member.partition('=')
+                # invalid members are dropped, and only the first of any
+                # duplicate keys is kept
+                if len(members) == self.MAX_MEMBERS or not sep or key in members or \
+                        not _is_valid_member(key, value):
+                    dropped = True
+                    continue
+                members[key] = value
+            self._members = members
+            if dropped or len(self._header) > self.MAX_LENGTH:
+                self._header = None
+        return self._members
+
+    def get(self, key, default=None):
+        return self._parsed().get(key, default)
+
+    def __getitem__(self, key):
+        return self._parsed()[key]
+
+    def __contains__(self, key):
+        return key in self._parsed()
+
+    def __len__(self):
+        return len(self._parsed())
+
+    def __iter__(self):
+        return iter(self._parsed())
+
+    def items(self):
+        return self._parsed().items()
+
+    def __setitem__(self, key, value):
+        '''
+        Adds or updates a member, moving it to the front as the spec requires.
+        Raises ValueError if the key or value isn't valid.
+        '''
+        if not _is_valid_member(key, value):
+            raise ValueError(f"invalid tracestate member {key}={value}")
+        members = self._parsed()
+        members[key] = value
+        members.move_to_end(key, last=False)
+        while len(members) > self.MAX_MEMBERS:
+            members.popitem()
+        self._header = None
+
+    def __delitem__(self, key):
+        del self._parsed()[key]
+        self._header = None
+
+    def __str__(self):
+        if self._header is None:
+            self._header = self._serialize()
+        return self._header
+
+    def __repr__(self):
+        return f"TraceState({str(self)!r})"
+
+    def __bool__(self):
+        if self._members is None:
+            return bool(self._header)
+        return bool(self._members)
+
+    def __eq__(self, other):
+        if isinstance(other, (TraceState, str)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def _serialize(self):
+        members = [f"{k}={v}" for k, v in self._members.items()]
+        length = sum(len(m) for m in members) + len(members) - 1
+        if length > self.MAX_LENGTH:
+            # drop long members first, then whatever else it takes, from the end
+            for long_only in (True, False):
+                for i in range(len(members) - 1, -1, -1):
+                    if length <= self.MAX_LENGTH:
+                        break
+                    if long_only and len(members[i]) <= _TRACESTATE_LONG_MEMBER_LENGTH:
+                        continue
+                    length -= len(members[i]) + 1
+                    del self._members[members[i].partition('=')[0]]
+                    del members[i]
+        return ','.join(members)
+
+
+def _is_valid_member(key, value):
+    return bool(_TRACESTATE_KEY_FORMAT_RE.fullmatch(key) and _TRACESTATE_VALUE_FORMAT_RE.fullmatch(value))
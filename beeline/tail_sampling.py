@@ -0,0 +1,151 @@
+''' Whole-trace buffering for tail-based sampling.
+
+Spans are normally sent as soon as they finish, so they can only be sampled
+on the trace ID or one event at a time. A `TraceBuffer` instead holds on to a
+trace's finished spans until its root span finishes, then asks a trace
+sampler whether to keep the whole trace:
+
+    beeline.init(
+        ...,
+        trace_buffer=TraceBuffer(error_or_slow_sampler(slow_ms=1000, sample_rate=50)),
+    )
+'''
+import sys
+import threading
+from collections import OrderedDict
+
+from beeline.internal import log, stringify_exception
+from beeline.trace import _should_sample
+
+# how many sampling verdicts are remembered for spans that finish after their
+# trace's root span
+_MAX_VERDICTS = 10000
+
+
+def error_or_slow_sampler(slow_ms, sample_rate):
+    ''' Returns a trace sampler that keeps every trace with an exception,
+    a 5xx response or a root span slower than `slow_ms`, and deterministically
+    samples the rest at 1 in `sample_rate`. '''
+    def sampler(spans):
+        for fields in spans:
+            if 'app.exception_type' in fields or 'error' in fields:
+                return True, 1
+            status = fields.get('response.status_code')
+            if isinstance(status, int) and status >= 500:
+                return True, 1
+        root = spans[-1]
+        if root.get('duration_ms', 0) >= slow_ms:
+            return True, 1
+        return _should_sample(root.get('trace.trace_id'), sample_rate), sample_rate
+    return sampler
+
+
+def _estimate_size(fields):
+    # keys are mostly shared between spans, so only count the dict and the
+    # string values, which is where the bulk of a large span is
+    size = sys.getsizeof(fields)
+    for v in fields.values():
+        if isinstance(v, str):
+            size += len(v)
+    return size
+
+
+class _BufferedTrace(object):
+    __slots__ = ('spans', 'size', 'dropped')
+
+    def __init__(self):
+        self.spans = []
+        self.size = 0
+        self.dropped = 0
+
+
+class TraceBuffer(object):
+    ''' Holds finished spans until their trace's root span finishes.
+
+    - `sampler`: accepts a list of the field dicts of every span in the
+            trace, with the root span last, and returns a tuple of type
+            (bool, int): whether to keep the trace, and the sample rate to
+            send its spans with. It is called with the buffer locked, so it
+            should be quick.
+    - `max_spans_per_trace`: spans past this many in one trace are dropped.
+            The root span is always kept, and records the number dropped in
+            `meta.dropped_spans`.
+    - `max_bytes`: an estimate of the memory all buffered spans may use. When
+            it is exceeded, the oldest traces are evicted and not sent.
+    '''
+
+    def __init__(self, sampler, max_spans_per_trace=1000, max_bytes=64 * 1024 * 1024):
+        self.sampler = sampler
+        self.max_spans_per_trace = max_spans_per_trace
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evicted_traces = 0
+        self.dropped_spans = 0
+        self._traces = OrderedDict()
+        # trace ID -> sample rate, or None if the trace was dropped
+        self._verdicts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        ''' Adds a finished span, whose fields are complete. Returns a list of
+        (span, sample_rate) tuples to send now: empty until the trace's root
+        span is added and the trace is kept. '''
+        trace_id = span.trace_id
+        with self._lock:
+            if trace_id in self._verdicts:
+                # the trace has already been decided on
+                sample_rate = self._verdicts[trace_id]
+                return [] if sample_rate is None else [(span, sample_rate)]
+
+            trace = self._traces.get(trace_id)
+            if not span.is_root():
+                if trace is None:
+                    trace = self._traces[trace_id] = _BufferedTrace()
+                if len(trace.spans) >= self.max_spans_per_trace:
+                    trace.dropped += 1
+                    self.dropped_spans += 1
+                    return []
+                size = _estimate_size(span.fields)
+                trace.spans.append(span)
+                trace.size += size
+                self.size += size
+                self._evict()
+                return []
+
+            # the verdict is recorded before the lock is released, so a span
+            # finishing while the sampler runs waits for it rather than
+            # starting a new buffered trace that would later be evicted
+            if trace is not None:
+                del self._traces[trace_id]
+                self.size -= trace.size
+            spans = trace.spans if trace is not None else []
+            spans.append(span)
+            if trace is not None and trace.dropped:
+                span.fields['meta.dropped_spans'] = trace.dropped
+
+            try:
+                keep, sample_rate = self.sampler([s.fields for s in spans])
+            except Exception as e:
+                log('error: trace sampler raised, keeping trace: %s', stringify_exception(e))
+                keep, sample_rate = True, 1
+
+            self._record_verdict(trace_id, sample_rate if keep else None)
+        if not keep:
+            return []
+        return [(s, sample_rate) for s in spans]
+
+    def _evict(self):
+        # must be called with the lock held
+        while self.size > self.max_bytes and self._traces:
+            trace_id, trace = self._traces.popitem(last=False)
+            self.size -= trace.size
+            self.evicted_traces += 1
+            self._record_verdict(trace_id, None)
+            log('warning: trace buffer is full, evicted trace %s with %d spans',
+                trace_id, len(trace.spans))
+
+    def _record_verdict(self, trace_id, sample_rate):
+        # must be called with the lock held
+        self._verdicts[trace_id] = sample_rate
+        if len(self._verdicts) > _MAX_VERDICTS:
+            self._verdicts.popitem(last=False)
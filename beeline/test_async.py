@@ -41,7 +41,7 @@ def async_test(fn):
 def span_data(span):
     """Utility for converting Span objects to dicts."""
     name = span.event.fields().get("name")
-    start = span.event.start_time
+    start = span.event.created_at
     duration = datetime.timedelta(
         milliseconds=span.event.fields()["duration_ms"]
     )
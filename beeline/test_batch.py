@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+import unittest
+from mock import Mock, patch
+
+from beeline.batch import BatchHookWorker
+
+
+def _event(fields):
+    ev = Mock()
+    ev.fields.return_value = fields
+    return ev
+
+
+class TestBatchHookWorker(unittest.TestCase):
+    def test_hooks_run_over_batches(self):
+        batches = []
+
+        def sampler_hook(fields_list):
+            batches.append(len(fields_list))
+            return [(fields['keep'], 5) for fields in fields_list]
+
+        def presend_hook(fields_list):
+            for fields in fields_list:
+                fields['db.query'] = 'scrubbed'
+
+        worker = BatchHookWorker(sampler_hook=sampler_hook, presend_hook=presend_hook,
+                                 max_batch_size=2, send_frequency=10)
+        kept = _event({'keep': True, 'db.query': 'secret'})
+        dropped = _event({'keep': False, 'db.query': 'secret'})
+        last = _event({'keep': True, 'db.query': 'secret'})
+        for ev in (kept, dropped, last):
+            worker.send(ev)
+        worker.close()
+
+        # batches are cut at max_batch_size, and the rest is flushed on close
+        self.assertEqual(batches, [2, 1])
+        kept.send_presampled.assert_called_once_with()
+        self.assertEqual(kept.sample_rate, 5)
+        self.assertEqual(kept.fields()['db.query'], 'scrubbed')
+        last.send_presampled.assert_called_once_with()
+        dropped.send_presampled.assert_not_called()
+        self.assertEqual(dropped.fields()['db.query'], 'secret')
+
+    def test_presend_only(self):
+        presend_hook = Mock()
+        worker = BatchHookWorker(presend_hook=presend_hook)
+        sampled = _event({'a': 1})
+        unsampled = _event({'b': 2})
+        worker.send(sampled)
+        worker.send(unsampled, presampled=False)
+        worker.close()
+
+        presend_hook.assert_called_once_with([{'a': 1}, {'b': 2}])
+        sampled.send_presampled.assert_called_once_with()
+        # libhoney still samples events that weren't sampled already
+        unsampled.send.assert_called_once_with()
+        unsampled.send_presampled.assert_not_called()
+
+    def test_batch_dropped_if_hooks_fail(self):
+        worker = BatchHookWorker(presend_hook=Mock(side_effect=ValueError('oops')))
+        ev = _event({'a': 1})
+        worker.send(ev)
+        worker.close()
+        ev.send_presampled.assert_not_called()
+
+    def test_batch_dropped_if_sampler_decisions_missing(self):
+        worker = BatchHookWorker(sampler_hook=Mock(return_value=[(True, 1)]))
+        events = [_event({'a': 1}), _event({'a': 2})]
+        for ev in events:
+            worker.send(ev)
+        worker.close()
+        for ev in events:
+            ev.send_presampled.assert_not_called()
+
+    def test_close_without_events(self):
+        worker = BatchHookWorker(presend_hook=Mock())
+        worker.close()
+        worker.send(_event({}))
+        worker.close()
+
+    def test_concurrent_first_sends_start_one_worker(self):
+        presend_hook = Mock()
+        worker = BatchHookWorker(presend_hook=presend_hook, send_frequency=0.01)
+        events = [_event({'i': i}) for i in range(8)]
+        barrier = threading.Barrier(len(events))
+
+        def send(ev):
+            barrier.wait()
+            worker.send(ev)
+
+        new_queue = queue.Queue
+
+        def slow_queue(*args):
+            # widen the window in which the other threads' first sends
+            # would start workers of their own
+            time.sleep(0.05)
+            return new_queue(*args)
+
+        with patch('beeline.batch.queue.Queue', side_effect=slow_queue):
+            threads = [threading.Thread(target=send, args=(ev,)) for ev in events]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        workers = [t for t in threading.enumerate() if t.name == 'honeycomb-beeline-batch-hooks']
+        self.assertEqual(len(workers), 1)
+
+        closer = threading.Thread(target=worker.close)
+        closer.start()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        for ev in events:
+            ev.send_presampled.assert_called_once_with()
@@ -1,3 +1,4 @@
+import inspect
 import threading
 import unittest
 from mock import Mock, patch, call
@@ -12,6 +13,16 @@ class TestBeeline(unittest.TestCase):
         self.addCleanup(patch.stopall)
         self.m_gbl = patch('beeline._GBL').start()
 
+    def test_positional_arguments_unchanged(self):
+        ''' options are added after the existing ones, so positional callers keep working '''
+        params = list(inspect.signature(beeline.Beeline).parameters)
+        self.assertEqual(params[:17], [
+            'writekey', 'dataset', 'service_name', 'tracer', 'sample_rate', 'api_host',
+            'max_concurrent_batches', 'max_batch_size', 'send_frequency', 'block_on_send',
+            'block_on_response', 'transmission_impl', 'sampler_hook', 'presend_hook',
+            'http_trace_parser_hook', 'http_trace_propagation_hook', 'debug',
+        ])
+
     def test_send_event(self):
         ''' test correct behavior for send_event '''
         _beeline = beeline.Beeline()
@@ -243,6 +254,59 @@ class TestBeeline(unittest.TestCase):
 
             self.raising_run_in_thread(target=traced_thread_func_2)
 
+    def test_head_sampling_is_passed_to_tracer(self):
+        _beeline = beeline.Beeline(head_sampling=True)
+        self.assertTrue(_beeline.tracer_impl.head_sampling)
+
+        _beeline = beeline.Beeline()
+        self.assertFalse(_beeline.tracer_impl.head_sampling)
+
+    def test_respect_parent_sampling_is_passed_to_tracer(self):
+        _beeline = beeline.Beeline(respect_parent_sampling=True)
+        self.assertTrue(_beeline.tracer_impl.respect_parent_sampling)
+
+        _beeline = beeline.Beeline()
+        self.assertFalse(_beeline.tracer_impl.respect_parent_sampling)
+
+    def test_deterministic_sampler_is_passed_to_tracer(self):
+        _beeline = beeline.Beeline(deterministic_sampler=beeline.trace.trace_id_ratio_sampler)
+        self.assertEqual(_beeline.tracer_impl.deterministic_sampler, beeline.trace.trace_id_ratio_sampler)
+
+    def test_batch_hooks_are_passed_to_tracer(self):
+        _beeline = beeline.Beeline()
+        self.assertIsNone(_beeline.batch_worker)
+        self.assertIsNone(_beeline.tracer_impl.batch_worker)
+
+        m_hook = Mock()
+        _beeline = beeline.Beeline(batch_presend_hook=m_hook, max_batch_size=7)
+        self.assertIs(_beeline.tracer_impl.batch_worker, _beeline.batch_worker)
+        self.assertIs(_beeline.batch_worker.presend_hook, m_hook)
+        self.assertEqual(_beeline.batch_worker._max_batch_size, 7)
+
+        _beeline.batch_worker = Mock()
+        _beeline.close()
+        _beeline.batch_worker.close.assert_called_once_with()
+
+    def test_trace_buffer_is_passed_to_tracer(self):
+        m_buffer = Mock()
+        _beeline = beeline.Beeline(trace_buffer=m_buffer)
+        self.assertIs(_beeline.tracer_impl.trace_buffer, m_buffer)
+
+    def test_propagation_policy_is_passed_to_tracer(self):
+        policy = beeline.propagation.PropagationPolicy(deny=['app.request.'])
+        _beeline = beeline.Beeline(propagation_policy=policy)
+        self.assertIs(_beeline.tracer_impl.propagation_policy, policy)
+
+    def test_id_generator_is_registered(self):
+        m_id_generator = Mock()
+        m_id_generator.generate_trace_id.return_value = 'bloop'
+        previous = beeline.trace.get_id_generator()
+        self.addCleanup(beeline.trace.set_id_generator, previous)
+
+        _beeline = beeline.Beeline(id_generator=m_id_generator)
+        span = _beeline.tracer_impl.start_trace()
+        self.assertEqual(span.trace_id, 'bloop')
+
     def test_finish_span_none(self):
         ''' ensure finish_span does not crash if an empty span is passed to it '''
         _beeline = beeline.Beeline()
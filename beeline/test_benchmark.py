@@ -0,0 +1,66 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import beeline
+from beeline import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        results = benchmark.run(iterations=5, repeat=1)
+        self.assertIn('tracer', results)
+        self.assertIn('traced.async', results)
+        self.assertIn('propagation.w3c.unmarshal', results)
+        for result in results.values():
+            self.assertGreater(result['ns_per_op'], 0)
+            self.assertGreaterEqual(result['alloc_bytes_per_op'], 0)
+        # each benchmark cleans up the beeline it ran against
+        self.assertIsNone(beeline.get_beeline())
+
+    def test_run_filters_by_name(self):
+        results = benchmark.run(names=['add_'], iterations=5, repeat=1)
+        self.assertEqual(set(results), {'add_context_field', 'add_rollup_field'})
+
+    def test_header_sizes(self):
+        sizes = benchmark.header_sizes()
+        self.assertEqual(set(sizes), {'honeycomb', 'w3c', 'compact'})
+        self.assertLess(sizes['compact'], sizes['honeycomb'])
+
+    def test_compare(self):
+        baseline = {
+            'a': {'ns_per_op': 100.0, 'alloc_bytes_per_op': 0.0},
+            'b': {'ns_per_op': 100.0, 'alloc_bytes_per_op': 100.0},
+        }
+        results = {
+            'a': {'ns_per_op': 119.0, 'alloc_bytes_per_op': 0.0},
+            'b': {'ns_per_op': 121.0, 'alloc_bytes_per_op': 200.0},
+            'c': {'ns_per_op': 1000.0, 'alloc_bytes_per_op': 1000.0},
+        }
+        self.assertEqual(benchmark.compare(results, baseline, 0.2), [
+            ('b', 'ns_per_op', 100.0, 121.0),
+            ('b', 'alloc_bytes_per_op', 100.0, 200.0),
+        ])
+
+    def test_main_save_and_compare(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'baseline.json')
+            args = ['add_context_field', '--iterations', '5', '--repeat', '1']
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(benchmark.main(args + ['--save', path]), 0)
+
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            self.assertIn('add_context_field', saved['results'])
+
+            # make the baseline impossibly fast so the comparison fails
+            saved['results']['add_context_field']['ns_per_op'] = 0.001
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(saved, f)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(benchmark.main(args + ['--compare', path]), 1)
+            self.assertIn('regression: add_context_field ns_per_op', out.getvalue())
@@ -0,0 +1,115 @@
+import threading
+import unittest
+from mock import Mock, patch
+
+from beeline.dynsampler import (
+    AvgSampleRate, DynamicSampler, EMASampleRate, TotalThroughput, _CounterTable, _avg_sample_rates,
+)
+from beeline.tail_sampling import TraceBuffer
+from beeline.trace import SynchronousTracer
+
+
+class TestCounterTable(unittest.TestCase):
+    def test_counts_across_threads(self):
+        table = _CounterTable()
+
+        def count():
+            for _ in range(1000):
+                table.increment('a')
+            table.increment('b')
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(table.swap(), {'a': 4000, 'b': 4})
+        # counting starts afresh after a swap
+        table.increment('a')
+        self.assertEqual(table.swap(), {'a': 1})
+
+
+class TestDynamicSamplers(unittest.TestCase):
+    def test_avg_sample_rates(self):
+        counts = {'/health,200': 10000, '/api,200': 500, '/api,500': 3}
+        rates = _avg_sample_rates(counts, 10)
+        self.assertEqual(rates['/api,500'], 1)
+        self.assertGreater(rates['/health,200'], rates['/api,200'])
+        # the events sent come out close to the goal rate overall
+        sent = sum(count / rates[key] for key, count in counts.items())
+        self.assertAlmostEqual(sum(counts.values()) / sent, 10, delta=1)
+
+        self.assertEqual(_avg_sample_rates({'a': 1, 'b': 1}, 10), {'a': 1, 'b': 1})
+        self.assertEqual(_avg_sample_rates({}, 10), {})
+
+    def test_rates_recomputed_each_interval(self):
+        sampler = AvgSampleRate(goal_sample_rate=10, interval=30)
+        fields = {'request.route': '/health', 'response.status_code': 200}
+        # unknown keys are sampled at 1 until there's data for them
+        self.assertEqual(sampler.sample_event(fields), (True, 1))
+        for _ in range(999):
+            sampler.sample_event(fields)
+        sampler.sample_event({'request.route': '/api', 'response.status_code': 500})
+
+        with patch('beeline.dynsampler.time.monotonic', return_value=sampler._next_update):
+            _, rate = sampler.sample_event(dict(fields, **{'trace.trace_id': 'abc'}))
+        self.assertGreater(rate, 1)
+        self.assertEqual(sampler.get_sample_rates(), {'/health,200': rate, '/api,500': 1})
+
+    def test_decision_is_consistent_per_trace(self):
+        sampler = TotalThroughput(goal_throughput_per_sec=1)
+        sampler._rates = {'/health,200': 10}
+        fields = {'request.route': '/health', 'response.status_code': 200}
+        with patch('beeline.dynsampler._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = False
+            self.assertEqual(sampler.sample_event(dict(fields, **{'trace.trace_id': 'abc'})), (False, 10))
+            m_sample_fn.assert_called_once_with('abc', 10)
+
+    def test_trace_sampled_on_root(self):
+        sampler = AvgSampleRate()
+        sampler._rates = {'/health,200': 1, ',': 50}
+        root = {'request.route': '/health', 'response.status_code': 200, 'trace.trace_id': 'abc'}
+        self.assertEqual(sampler([{'trace.trace_id': 'abc'}, root]), (True, 1))
+
+    def test_not_a_sampler_hook(self):
+        with self.assertRaises(TypeError):
+            AvgSampleRate()({'trace.trace_id': 'abc'})
+
+    def test_whole_trace_kept_or_dropped(self):
+        sampler = AvgSampleRate()
+        sampler._rates = {'/health,200': 50, ',': 1}
+        finished = []
+        tracer = SynchronousTracer(Mock())
+        tracer.trace_buffer = TraceBuffer(sampler)
+        tracer._run_hooks_and_send = finished.append
+        for _ in range(200):
+            root = tracer.start_trace(context={'request.route': '/health'})
+            tracer.finish_span(tracer.start_span(context={'name': 'child'}))
+            root.add_context_field('response.status_code', 200)
+            tracer.finish_trace(root)
+        # every kept trace has both of its spans
+        self.assertEqual(len(finished) % 2, 0)
+        self.assertLess(len(finished), 200)
+        self.assertEqual(len({span.trace_id for span in finished}) * 2, len(finished))
+
+    def test_compute_rates_is_abstract(self):
+        with self.assertRaises(TypeError):
+            DynamicSampler()  # pylint: disable=abstract-class-instantiated
+
+    def test_ema_sample_rate(self):
+        sampler = EMASampleRate(goal_sample_rate=10, weight=0.5, age_out=1)
+        sampler.compute_rates({'a': 1000, 'b': 10})
+        self.assertEqual(sampler._averages, {'a': 500, 'b': 5})
+        rates = sampler.compute_rates({'a': 1000})
+        self.assertEqual(sampler._averages, {'a': 750, 'b': 2.5})
+        self.assertEqual(rates['b'], 1)
+        sampler.compute_rates({})
+        sampler.compute_rates({})
+        # b decays below age_out and is forgotten
+        self.assertNotIn('b', sampler._averages)
+
+    def test_total_throughput(self):
+        sampler = TotalThroughput(goal_throughput_per_sec=10, interval=10)
+        self.assertEqual(sampler.compute_rates({'a': 1000, 'b': 20}), {'a': 20, 'b': 1})
+        self.assertEqual(sampler.compute_rates({}), {})
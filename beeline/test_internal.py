@@ -1,6 +1,7 @@
 import unittest
+from mock import patch
 
-from beeline.internal import stringify_exception
+from beeline.internal import is_sampled, stringify_exception
 
 
 class TestInternal(unittest.TestCase):
@@ -11,3 +12,14 @@ class TestInternal(unittest.TestCase):
 
         e = Exception("\u1024abcdef")
         self.assertEqual('\u1024abcdef', stringify_exception(e))
+
+    def test_is_sampled(self):
+        with patch('beeline.get_beeline') as m_gbl:
+            m_gbl.return_value = None
+            self.assertFalse(is_sampled())
+
+        with patch('beeline.get_beeline') as m_gbl:
+            m_gbl.return_value.tracer_impl.is_sampled.return_value = False
+            self.assertFalse(is_sampled())
+            m_gbl.return_value.tracer_impl.is_sampled.return_value = True
+            self.assertTrue(is_sampled())
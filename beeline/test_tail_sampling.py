@@ -0,0 +1,123 @@
+import threading
+import time
+import unittest
+from mock import Mock, patch
+
+from beeline.tail_sampling import TraceBuffer, error_or_slow_sampler
+from beeline.trace import Span
+
+
+def _span(trace_id, span_id, is_root=False, **fields):
+    fields['trace.trace_id'] = trace_id
+    return Span(trace_id, None, span_id, fields=fields, is_root=is_root)
+
+
+class TestTraceBuffer(unittest.TestCase):
+    def test_trace_sampled_when_root_finishes(self):
+        sampler = Mock(return_value=(True, 50))
+        buf = TraceBuffer(sampler)
+
+        child1 = _span('t1', 'c1', name='child1')
+        child2 = _span('t1', 'c2', name='child2')
+        root = _span('t1', 'r', is_root=True, name='root')
+        self.assertEqual(buf.add(child1), [])
+        self.assertEqual(buf.add(child2), [])
+        self.assertGreater(buf.size, 0)
+
+        self.assertEqual(buf.add(root), [(child1, 50), (child2, 50), (root, 50)])
+        sampler.assert_called_once_with([child1.fields, child2.fields, root.fields])
+        self.assertEqual(buf.size, 0)
+
+        # spans finishing after the root follow the trace's verdict
+        late = _span('t1', 'l')
+        self.assertEqual(buf.add(late), [(late, 50)])
+
+    def test_dropped_trace(self):
+        buf = TraceBuffer(Mock(return_value=(False, 50)))
+        buf.add(_span('t1', 'c'))
+        self.assertEqual(buf.add(_span('t1', 'r', is_root=True)), [])
+        self.assertEqual(buf.add(_span('t1', 'l')), [])
+
+    def test_traces_are_kept_separate(self):
+        buf = TraceBuffer(lambda spans: (True, len(spans)))
+        a = _span('a', 'c')
+        buf.add(a)
+        buf.add(_span('b', 'c'))
+        root = _span('a', 'r', is_root=True)
+        self.assertEqual(buf.add(root), [(a, 2), (root, 2)])
+
+    def test_span_cap(self):
+        sampler = Mock(return_value=(True, 1))
+        buf = TraceBuffer(sampler, max_spans_per_trace=2)
+        for i in range(5):
+            buf.add(_span('t1', str(i)))
+        root = _span('t1', 'r', is_root=True)
+        sent = buf.add(root)
+
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(root.fields['meta.dropped_spans'], 3)
+        self.assertEqual(buf.dropped_spans, 3)
+
+    def test_byte_budget_evicts_oldest_trace(self):
+        sampler = Mock(return_value=(True, 1))
+        buf = TraceBuffer(sampler, max_bytes=1500)
+        old = _span('old', 'c', payload='x' * 1000)
+        buf.add(old)
+        new = _span('new', 'c', payload='x' * 200)
+        buf.add(new)
+
+        self.assertEqual(buf.evicted_traces, 1)
+        self.assertLessEqual(buf.size, 1500)
+        # an evicted trace is dropped, even once its root finishes
+        self.assertEqual(buf.add(_span('old', 'r', is_root=True)), [])
+        sampler.assert_not_called()
+
+        root = _span('new', 'r', is_root=True)
+        self.assertEqual(buf.add(root), [(new, 1), (root, 1)])
+
+    def test_sampler_error_keeps_trace(self):
+        buf = TraceBuffer(Mock(side_effect=ValueError('oops')))
+        root = _span('t1', 'r', is_root=True)
+        self.assertEqual(buf.add(root), [(root, 1)])
+
+    def test_span_finishing_while_sampling_follows_verdict(self):
+        sampling = threading.Event()
+
+        def sampler(spans):
+            sampling.set()
+            # give the other thread time to add its span
+            time.sleep(0.1)
+            return True, 5
+
+        buf = TraceBuffer(sampler)
+        late = _span('t1', 'l')
+        sent = []
+
+        def add_late():
+            sampling.wait(5)
+            sent.extend(buf.add(late))
+
+        t = threading.Thread(target=add_late)
+        t.start()
+        root = _span('t1', 'r', is_root=True)
+        self.assertEqual(buf.add(root), [(root, 5)])
+        t.join(5)
+
+        self.assertEqual(sent, [(late, 5)])
+        self.assertEqual(buf.size, 0)
+        self.assertEqual(len(buf._traces), 0)
+
+
+class TestErrorOrSlowSampler(unittest.TestCase):
+    def test_sampler(self):
+        sampler = error_or_slow_sampler(slow_ms=1000, sample_rate=50)
+        root = {'trace.trace_id': 'abc', 'duration_ms': 10}
+
+        self.assertEqual(sampler([{'app.exception_type': 'ValueError'}, root]), (True, 1))
+        self.assertEqual(sampler([{'response.status_code': 503}, root]), (True, 1))
+        self.assertEqual(sampler([{'trace.trace_id': 'abc', 'duration_ms': 1500}]), (True, 1))
+
+        with patch('beeline.tail_sampling._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = False
+            self.assertEqual(sampler([{'response.status_code': 200}, root]), (False, 50))
+            m_sample_fn.assert_called_once_with('abc', 50)
@@ -0,0 +1,34 @@
+import datetime
+import unittest
+from mock import patch
+
+from beeline import timing
+
+
+class TestTiming(unittest.TestCase):
+    def test_elapsed_ms(self):
+        self.assertEqual(timing.elapsed_ms(1000000, 3500000), 2.5)
+
+        start = timing.now_ns()
+        self.assertGreaterEqual(timing.elapsed_ms(start), 0)
+
+    def test_to_datetime(self):
+        '''converted timestamps keep the monotonic clock's spacing'''
+        start = timing.now_ns()
+        end = start + 1500 * 1000 * 1000
+
+        start_dt = timing.to_datetime(start)
+        self.assertIsNone(start_dt.tzinfo)
+        self.assertLess(abs(start_dt - datetime.datetime.utcnow()), datetime.timedelta(seconds=1))
+        self.assertEqual(timing.to_datetime(end) - start_dt, datetime.timedelta(milliseconds=1500))
+
+    def test_to_datetime_reanchors(self):
+        '''the wall clock pairing is taken again once it gets old'''
+        anchor_wall = datetime.datetime(2020, 1, 1)
+        with patch('beeline.timing._anchor', (anchor_wall, 0)):
+            self.assertEqual(timing.to_datetime(1000), anchor_wall + datetime.timedelta(microseconds=1))
+
+            now = timing.now_ns()
+            dt = timing.to_datetime(now)
+            self.assertGreater(dt, anchor_wall + datetime.timedelta(days=365))
+            self.assertNotEqual(timing._anchor, (anchor_wall, 0))
@@ -1,5 +1,4 @@
-from collections import defaultdict
-from mock import ANY, Mock, call, patch
+from mock import Mock, call, patch
 import base64
 import datetime
 import json
@@ -9,14 +8,14 @@ import os
 import binascii
 import beeline.propagation
 
-from libhoney import Event
-
 from beeline.trace import (
-    _should_sample, SynchronousTracer, marshal_trace_context,
-    unmarshal_trace_context, Span, generate_span_id, generate_trace_id
+    _should_sample, trace_id_ratio_sampler, SynchronousTracer, marshal_trace_context,
+    unmarshal_trace_context, Span, UnsampledSpan, generate_span_id, generate_trace_id,
+    IdGenerator, RandomIdGenerator, SystemRandomIdGenerator, get_id_generator, set_id_generator
 )
 
-from beeline.propagation import DictRequest
+from beeline.propagation import DictRequest, honeycomb, w3c
+from beeline.tail_sampling import TraceBuffer
 
 
 class TestIDGeneration(unittest.TestCase):
@@ -30,6 +29,44 @@ class TestIDGeneration(unittest.TestCase):
         trace_id = generate_trace_id()
         self.assertIsNotNone(re.match(r"[\da-f]{32}", trace_id))
 
+    def test_id_generators(self):
+        '''Test that the built in generators produce w3c compatible, unique IDs'''
+        for gen in (RandomIdGenerator(), SystemRandomIdGenerator()):
+            span_ids = set(gen.generate_span_id() for _ in range(1000))
+            trace_ids = set(gen.generate_trace_id() for _ in range(1000))
+            self.assertEqual(len(span_ids), 1000)
+            self.assertEqual(len(trace_ids), 1000)
+            for span_id in span_ids:
+                self.assertIsNotNone(re.fullmatch(r"[\da-f]{16}", span_id))
+            for trace_id in trace_ids:
+                self.assertIsNotNone(re.fullmatch(r"[\da-f]{32}", trace_id))
+
+    def test_random_id_generator_reseed(self):
+        '''Test that reseeding (as happens after a fork) changes the ID sequence'''
+        gen = RandomIdGenerator()
+        state = gen._random.getstate()
+        first = gen.generate_trace_id()
+        gen._random.setstate(state)
+        gen.reseed()
+        self.assertNotEqual(gen.generate_trace_id(), first)
+
+    def test_set_id_generator(self):
+        class FixedIdGenerator(IdGenerator):
+            def generate_span_id(self):
+                return "b7ad6b7169203331"
+
+            def generate_trace_id(self):
+                return "0af7651916cd43dd8448eb211c80319c"
+
+        previous = get_id_generator()
+        self.addCleanup(set_id_generator, previous)
+        set_id_generator(FixedIdGenerator())
+
+        tracer = SynchronousTracer(Mock())
+        span = tracer.start_trace()
+        self.assertEqual(span.trace_id, "0af7651916cd43dd8448eb211c80319c")
+        self.assertEqual(span.id, "b7ad6b7169203331")
+
 
 class TestTraceSampling(unittest.TestCase):
     def test_deterministic(self):
@@ -124,6 +161,25 @@ class TestTraceSampling(unittest.TestCase):
             self.assertLessEqual(sampled, acceptable_upper_bound)
             self.assertGreaterEqual(sampled, acceptable_lower_bound)
 
+    def test_trace_id_ratio_sampler(self):
+        ''' test that the trace ID bits sampler is deterministic and approximates 1 in N sampling '''
+        self.assertTrue(trace_id_ratio_sampler('0af7651916cd43dd0000000000000000', 1000))
+        self.assertFalse(trace_id_ratio_sampler('0af7651916cd43ddffffffffffffffff', 2))
+        # non hex IDs fall back to the SHA1 sampler
+        self.assertEqual(trace_id_ratio_sampler('b8d674f1-04ed-4ea8-b16d-b4dbbe87c78e', 1000),
+                         _should_sample('b8d674f1-04ed-4ea8-b16d-b4dbbe87c78e', 1000))
+        # as do IDs that int() would parse, e.g. as negative numbers
+        for trace_id in ('-fffffffffffffff', '0af7-fffffffffffffff', '0af7ffff_ffff_ffff_ff',
+                         '0af7 ffffffffffffff', 'ffffffff'):
+            self.assertEqual(trace_id_ratio_sampler(trace_id, 1000), _should_sample(trace_id, 1000), trace_id)
+
+        tests_count = 50000
+        for rate in [1, 2, 10]:
+            sampled = sum(1 for _ in range(tests_count) if trace_id_ratio_sampler(generate_trace_id(), rate))
+            expected = tests_count // rate
+            self.assertLessEqual(sampled, int(expected * 1.05))
+            self.assertGreaterEqual(sampled, int(expected * 0.95))
+
     def should_sample_always_returns_true_when_sample_rate_is_1(self):
         for _ in range(1000):
             self.assertTrue(_should_sample(binascii.b2a_hex(os.urandom(16)), 1))
@@ -202,17 +258,18 @@ class TestSynchronousTracer(unittest.TestCase):
         tracer = SynchronousTracer(m_client)
 
         span = tracer.start_trace(context={'big': 'important_stuff'})
-        self.assertIsInstance(span.event.start_time, datetime.datetime)
-        # make sure our context got passed on to the event
-        m_client.new_event.return_value.add.assert_has_calls([
-            call(data={'big': 'important_stuff'}),
-            call(data={
-                'trace.trace_id': span.trace_id,
-                'trace.parent_id': span.parent_id,
-                'trace.span_id': span.id,
-                'meta.span_type': "root",
-            }),
-        ])
+        self.assertIsInstance(span.start_time, int)
+        # the event isn't built until the span is finished
+        self.assertIsNone(span.event)
+        m_client.new_event.assert_not_called()
+        # make sure our context got passed on to the span
+        self.assertDictEqual(span.fields, {
+            'big': 'important_stuff',
+            'trace.trace_id': span.trace_id,
+            'trace.parent_id': span.parent_id,
+            'trace.span_id': span.id,
+            'meta.span_type': "root",
+        })
         self.assertEqual(tracer._trace.stack[0], span)
         # ensure we started a trace
         self.assertIsNotNone(tracer._trace)
@@ -236,14 +293,12 @@ class TestSynchronousTracer(unittest.TestCase):
         self.assertEqual(span.id, span2.parent_id)
         # trace id should match what the tracer has
         self.assertEqual(span.trace_id, tracer._trace.id)
-        m_client.new_event.return_value.add.assert_has_calls([
-            call(data={'more': 'important_stuff'}),
-            call(data={
-                'trace.trace_id': span2.trace_id,
-                'trace.parent_id': span2.parent_id,
-                'trace.span_id': span2.id,
-            }),
-        ])
+        self.assertDictEqual(span2.fields, {
+            'more': 'important_stuff',
+            'trace.trace_id': span2.trace_id,
+            'trace.parent_id': span2.parent_id,
+            'trace.span_id': span2.id,
+        })
 
     def test_start_span_returns_none_if_no_trace(self):
         m_client = Mock()
@@ -257,20 +312,82 @@ class TestSynchronousTracer(unittest.TestCase):
     def test_finish_trace(self):
         # implicitly tests finish_span
         m_client = Mock()
-        # these values are used before sending
-        m_client.new_event.return_value.start_time = datetime.datetime.now()
-        m_client.new_event.return_value.sample_rate = 1
+        # used for deterministic sampling before the event is built
+        m_client.sample_rate = 1
         tracer = SynchronousTracer(m_client)
 
         span = tracer.start_trace(context={'big': 'important_stuff'})
         self.assertEqual(tracer._trace.stack[0], span)
 
         tracer.finish_trace(span)
-        # ensure the event is sent
+        # ensure the event is built from the span's fields and sent
+        m_client.new_event.assert_called_once_with(data=span.fields)
+        self.assertIn('duration_ms', span.fields)
+        self.assertIsInstance(span.event.created_at, datetime.datetime)
         span.event.send_presampled.assert_called_once_with()
         # ensure that there is no current trace
         self.assertIsNone(tracer._trace)
 
+    def test_finish_span_skips_event_when_sampled_out(self):
+        ''' spans dropped by deterministic sampling never build an event '''
+        m_client = Mock()
+        m_client.sample_rate = 10
+        tracer = SynchronousTracer(m_client)
+
+        span = tracer.start_trace(context={'big': 'important_stuff'})
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = False
+            tracer.finish_trace(span)
+            m_sample_fn.assert_called_once_with(span.trace_id, 10)
+
+        m_client.new_event.assert_not_called()
+        self.assertIsNone(span.event)
+        self.assertIsNone(tracer._trace)
+
+    def test_sampling_verdict_cached_on_trace(self):
+        ''' the deterministic sampler runs once per trace, not once per span '''
+        m_client = Mock()
+        m_client.sample_rate = 10
+        tracer = SynchronousTracer(m_client)
+
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = True
+            root = tracer.start_trace()
+            for _ in range(3):
+                tracer.finish_span(tracer.start_span())
+            tracer.finish_trace(root)
+            m_sample_fn.assert_called_once_with(root.trace_id, 10)
+
+        self.assertEqual(m_client.new_event.call_count, 4)
+
+    def test_spans_started_after_drop_verdict_are_unsampled(self):
+        m_client = Mock()
+        m_client.sample_rate = 10
+        tracer = SynchronousTracer(m_client)
+
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = False
+            root = tracer.start_trace()
+            tracer.finish_span(tracer.start_span())
+            span = tracer.start_span()
+            tracer.finish_span(span)
+            tracer.finish_trace(root)
+
+        self.assertIsInstance(span, UnsampledSpan)
+        m_client.new_event.assert_not_called()
+
+    def test_custom_deterministic_sampler(self):
+        m_client = Mock()
+        m_client.sample_rate = 10
+        tracer = SynchronousTracer(m_client)
+        m_sampler = Mock(return_value=True)
+        tracer.deterministic_sampler = m_sampler
+
+        span = tracer.start_trace()
+        tracer.finish_trace(span)
+        m_sampler.assert_called_once_with(span.trace_id, 10)
+        span.event.send_presampled.assert_called_once_with()
+
     def test_start_trace_with_trace_id_set(self):
         m_client = Mock()
         tracer = SynchronousTracer(m_client)
@@ -280,14 +397,12 @@ class TestSynchronousTracer(unittest.TestCase):
         self.assertEqual(span.parent_id, '999999')
         self.assertEqual(tracer._trace.id, '123456')
 
-        m_client.new_event.return_value.add.assert_has_calls([
-            call(data={
-                'trace.trace_id': span.trace_id,
-                'trace.parent_id': span.parent_id,
-                'trace.span_id': span.id,
-                'meta.span_type': 'subroot'
-            }),
-        ])
+        self.assertDictEqual(span.fields, {
+            'trace.trace_id': span.trace_id,
+            'trace.parent_id': span.parent_id,
+            'trace.span_id': span.id,
+            'meta.span_type': 'subroot'
+        })
 
     def test_add_trace_field_propagates(self):
         m_client = Mock()
@@ -298,8 +413,6 @@ class TestSynchronousTracer(unittest.TestCase):
         self.assertEqual(tracer._trace.stack[0], span)
         self.assertEqual(len(tracer._trace.stack), 1)
 
-        m_client.new_event.reset_mock()
-
         tracer.add_trace_field('another', 'important_thing')
         tracer.add_trace_field('wide', 'events_are_great')
         # ensure we don't crash if non-string added here
@@ -317,23 +430,20 @@ class TestSynchronousTracer(unittest.TestCase):
         self.assertEqual(span.id, span2.parent_id)
         # trace id should match what the tracer has
         self.assertEqual(span.trace_id, tracer._trace.id)
-        m_client.new_event.assert_called_once_with(data={
+        # the trace fields are kept as a snapshot until the span is finished
+        self.assertDictEqual(span2.trace_fields, {
             'app.another': 'important_thing',
             'app.wide': 'events_are_great',
             'app.12345': 54321,
             'app.prefixes': 'there should only be 1',
         })
-        m_client.new_event.return_value.add.assert_has_calls([
-            call(data={'more': 'important_stuff'}),
-            call(data={
-                'trace.trace_id': span2.trace_id,
-                'trace.parent_id': span2.parent_id,
-                'trace.span_id': span2.id,
-            }),
-        ])
-
-        m_client.new_event.reset_mock()
-        m_client.new_event.return_value.fields.return_value = {}
+        self.assertDictEqual(span2.fields, {
+            'more': 'important_stuff',
+            'trace.trace_id': span2.trace_id,
+            'trace.parent_id': span2.parent_id,
+            'trace.span_id': span2.id,
+        })
+
         # swap out some trace fields
         tracer.add_trace_field('more', 'data!')
         tracer.remove_trace_field('another')
@@ -346,65 +456,117 @@ class TestSynchronousTracer(unittest.TestCase):
         # should share the same trace id
         self.assertEqual(span.trace_id, span3.trace_id)
         self.assertEqual(span2.id, span3.parent_id)
-        m_client.new_event.assert_called_once_with(data={
+        self.assertDictEqual(span3.trace_fields, {
             'app.wide': 'events_are_great',
             'app.more': 'data!',
             'app.12345': 54321,
             'app.prefixes': 'there should only be 1',
         })
+        # span2 was active, so it got its own copy of the fields to change
+        self.assertIsNone(span2.trace_fields)
+        self.assertNotIn('app.another', span2.fields)
+        self.assertEqual(span2.fields['app.more'], 'data!')
+        self.assertEqual(span2.fields['app.wide'], 'events_are_great')
+
+    def test_trace_field_snapshot_shared_until_changed(self):
+        m_client = Mock()
+        tracer = SynchronousTracer(m_client)
+
+        tracer.start_trace()
+        tracer.add_trace_field('wide', 'events_are_great')
+        span2 = tracer.start_span()
+        span3 = tracer.start_span()
+        self.assertIs(span2.trace_fields, span3.trace_fields)
+
+        tracer.add_trace_field('more', 'data!')
+        span4 = tracer.start_span()
+        self.assertIsNot(span3.trace_fields, span4.trace_fields)
+        self.assertEqual(span3.trace_fields, {'app.wide': 'events_are_great'})
+        self.assertEqual(span4.trace_fields, {'app.wide': 'events_are_great', 'app.more': 'data!'})
+
+    def test_trace_fields_merged_at_finish(self):
+        m_client = Mock()
+        m_client.sample_rate = 1
+        tracer = SynchronousTracer(m_client)
+        tracer._run_hooks_and_send = Mock()
+
+        root = tracer.start_trace()
+        tracer.add_trace_field('a', 1)
+        tracer.add_trace_field('b', 1)
+        span = tracer.start_span(context={'app.b': 'mine'})
+        tracer.finish_span(tracer.start_span())
+
+        # added after the span started, and to a span that's no longer active
+        tracer.add_trace_field('c', 1)
+        # the span's snapshot wins over later changes to the trace
+        tracer._trace.add_field('app.a', 2)
+        tracer.finish_span(span)
+
+        self.assertEqual(span.fields['app.a'], 1)
+        self.assertEqual(span.fields['app.b'], 'mine')
+        self.assertEqual(span.fields['app.c'], 1)
+        self.assertIsNone(span.trace_fields)
+
+        tracer.finish_trace(root)
+        self.assertEqual(root.fields['app.c'], 1)
+
+    def test_remove_trace_field_from_active_span(self):
+        m_client = Mock()
+        m_client.sample_rate = 1
+        tracer = SynchronousTracer(m_client)
+        tracer._run_hooks_and_send = Mock()
+
+        tracer.start_trace()
+        tracer.add_trace_field('a', 1)
+        parent = tracer.start_span()
+        span = tracer.start_span()
+        tracer.remove_trace_field('a')
+
+        tracer.finish_span(span)
+        self.assertNotIn('app.a', span.fields)
+        # spans further up the stack keep the field, as they always have
+        self.assertEqual(parent.trace_fields, {'app.a': 1})
+        tracer.finish_span(parent)
+        self.assertEqual(parent.fields['app.a'], 1)
 
     def test_add_rollup_field_propagates(self):
         m_client = Mock()
+        m_client.sample_rate = 1
         tracer = SynchronousTracer(m_client)
         tracer._run_hooks_and_send = Mock()
 
         span1 = tracer.start_trace(context={'name': 'root'})
-        event1 = m_client.new_event.return_value
-
         span2 = tracer.start_span(context={'name': 'middle'})
-        event2 = m_client.new_event.return_value
-
         span3 = tracer.start_span(context={'name': 'inner1'})
-        event3 = m_client.new_event.return_value
 
         tracer.add_rollup_field('database_ms', 17)
         tracer.add_rollup_field('calories', 180)
         tracer.add_rollup_field('database_ms', 23.1)
 
-        event3.add_field.reset_mock()
         tracer.finish_span(span3)
-        event3.add_field.assert_has_calls([
-            call('database_ms', 17.0 + 23.1),
-            call('calories', 180.0),
-            call('duration_ms', ANY),
-        ], any_order=True)
+        self.assertEqual(span3.fields['database_ms'], 17.0 + 23.1)
+        self.assertEqual(span3.fields['calories'], 180.0)
+        self.assertIn('duration_ms', span3.fields)
 
         span4 = tracer.start_span(context={'name': 'inner2'})
-        event4 = m_client.new_event.return_value
 
         tracer.add_rollup_field('calories', 120)
 
-        event4.add_field.reset_mock()
         tracer.finish_span(span4)
-        event4.add_field.assert_has_calls([
-            call('calories', 120.0),
-            call('duration_ms', ANY),
-        ], any_order=True)
+        self.assertEqual(span4.fields['calories'], 120.0)
+        self.assertNotIn('database_ms', span4.fields)
+        self.assertIn('duration_ms', span4.fields)
 
-        event2.add_field.reset_mock()
         tracer.finish_span(span2)
-        event2.add_field.assert_has_calls([
-            # This intermediate span doesn't get any rollup fields.
-            call('duration_ms', ANY),
-        ], any_order=True)
+        # This intermediate span doesn't get any rollup fields.
+        self.assertNotIn('database_ms', span2.fields)
+        self.assertNotIn('calories', span2.fields)
+        self.assertIn('duration_ms', span2.fields)
 
-        event1.add_field.reset_mock()
         tracer.finish_span(span1)
-        event1.add_field.assert_has_calls([
-            call('rollup.database_ms', 17.0 + 23.1),
-            call('rollup.calories', 180.0 + 120.0),
-            call('duration_ms', ANY),
-        ], any_order=True)
+        self.assertEqual(span1.fields['rollup.database_ms'], 17.0 + 23.1)
+        self.assertEqual(span1.fields['rollup.calories'], 180.0 + 120.0)
+        self.assertIn('duration_ms', span1.fields)
 
     def test_get_active_span(self):
         m_client = Mock()
@@ -501,12 +663,8 @@ class TestSynchronousTracer(unittest.TestCase):
         m_client = Mock()
         tracer = SynchronousTracer(m_client)
         tracer.start_trace()
-        m_span = Mock()
-        m_span.event = Event()
-        m_span.event.start_time = datetime.datetime.now()
         # set an existing trace field
-        m_span.event.add_field('app.a', 1)
-        m_span.rollup_fields = defaultdict(float)
+        m_span = Span(tracer._trace.id, None, 'abcdef', fields={'app.a': 1})
 
         with patch('beeline.trace._should_sample') as m_sample_fn:
             m_sample_fn.return_value = True
@@ -517,11 +675,12 @@ class TestSynchronousTracer(unittest.TestCase):
             tracer.finish_span(m_span)
 
         # Check that the new, unique fields were successfully added
-        self.assertIn("app.b", m_span.event.fields())
-        self.assertIn("app.c", m_span.event.fields())
+        self.assertIn("app.b", m_span.fields)
+        self.assertIn("app.c", m_span.fields)
 
         # Check that a was not overwritten with the new value of 0.
-        self.assertEqual(m_span.event.fields()["app.a"], 1)
+        self.assertEqual(m_span.fields["app.a"], 1)
+        m_client.new_event.assert_called_once_with(data=m_span.fields)
 
     def test_trace_context_manager_does_not_crash_if_span_is_none(self):
         m_client = Mock()
@@ -546,6 +705,7 @@ class TestSynchronousTracer(unittest.TestCase):
     def test_custom_dataset_propagates_to_event(self):
         dataset = 'flibble'
         m_client = Mock()
+        m_client.sample_rate = 1
         tracer = SynchronousTracer(m_client)
         tracer._run_hooks_and_send = Mock()
         span = tracer.start_trace(dataset=dataset)
@@ -553,6 +713,195 @@ class TestSynchronousTracer(unittest.TestCase):
         tracer.finish_span(span)
         self.assertEqual(event.dataset, dataset)
 
+    def test_batch_worker_receives_events(self):
+        m_client = Mock()
+        m_client.sample_rate = 1
+        tracer = SynchronousTracer(m_client)
+        tracer.batch_worker = Mock()
+        tracer.batch_worker.sampler_hook = None
+
+        span = tracer.start_trace()
+        tracer.finish_trace(span)
+        tracer.batch_worker.send.assert_called_once_with(span.event)
+        span.event.send_presampled.assert_not_called()
+
+    def test_batch_sampler_hook_replaces_deterministic_sampling(self):
+        m_client = Mock()
+        m_client.sample_rate = 10
+        tracer = SynchronousTracer(m_client)
+        tracer.head_sampling = True
+        tracer.batch_worker = Mock()
+        tracer.batch_worker.sampler_hook = Mock()
+
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            span = tracer.start_trace()
+            tracer.finish_trace(span)
+            m_sample_fn.assert_not_called()
+        tracer.batch_worker.send.assert_called_once_with(span.event)
+
+    def test_trace_buffer_sends_whole_trace(self):
+        m_client = Mock()
+        m_client.sample_rate = 10
+        tracer = SynchronousTracer(m_client)
+        tracer._run_hooks_and_send = Mock()
+        tracer.trace_buffer = TraceBuffer(lambda spans: (True, 50))
+
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            root = tracer.start_trace()
+            child = tracer.start_span()
+            tracer.finish_span(child)
+            tracer._run_hooks_and_send.assert_not_called()
+            tracer.finish_trace(root)
+            # the trace buffer replaces deterministic sampling
+            m_sample_fn.assert_not_called()
+
+        tracer._run_hooks_and_send.assert_has_calls([call(child), call(root)])
+        self.assertEqual(child.event.sample_rate, 50)
+        self.assertEqual(root.event.sample_rate, 50)
+
+
+class TestHeadSampling(unittest.TestCase):
+    def setUp(self):
+        self.m_client = Mock()
+        self.m_client.sample_rate = 10
+        self.tracer = SynchronousTracer(self.m_client)
+        self.tracer.head_sampling = True
+
+    def test_unsampled_trace_records_nothing(self):
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = False
+            root = self.tracer.start_trace(context={'name': 'root'})
+            child = self.tracer.start_span(context={'name': 'child'})
+            self.tracer.add_context_field('big', 'important_stuff')
+            self.tracer.add_rollup_field('database_ms', 17)
+            self.tracer.finish_span(child)
+            self.tracer.finish_trace(root)
+            # the verdict is made once, when the trace starts
+            m_sample_fn.assert_called_once_with(root.trace_id, 10)
+
+        self.assertIsInstance(root, UnsampledSpan)
+        self.assertIsInstance(child, UnsampledSpan)
+        self.assertIsNone(child.fields)
+        self.assertEqual(child.parent_id, root.id)
+        self.m_client.new_event.assert_not_called()
+        self.assertIsNone(self.tracer._trace)
+
+    def test_unsampled_trace_still_propagates(self):
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = False
+            self.tracer.start_trace(trace_id='bloop', parent_span_id='scoop')
+            self.tracer.add_trace_field('tenant', 'acme')
+            span = self.tracer.start_span()
+
+        self.assertFalse(self.tracer.is_sampled())
+        pc = self.tracer.get_propagation_context()
+        self.assertEqual(pc.trace_id, 'bloop')
+        self.assertEqual(pc.parent_id, span.id)
+        self.assertEqual(pc.trace_fields, {'app.tenant': 'acme'})
+
+    def test_sampled_trace_is_sent_without_resampling(self):
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = True
+            root = self.tracer.start_trace(context={'name': 'root'})
+            self.tracer.finish_trace(root)
+            m_sample_fn.assert_called_once_with(root.trace_id, 10)
+
+        self.assertNotIsInstance(root, UnsampledSpan)
+        root.event.send_presampled.assert_called_once_with()
+
+    def test_sampler_hook_disables_head_sampling(self):
+        self.tracer.register_hooks(sampler=lambda fields: (True, 1))
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            root = self.tracer.start_trace()
+            m_sample_fn.assert_not_called()
+
+        self.assertIsNone(self.tracer._trace.sampled)
+        self.assertTrue(self.tracer.is_sampled())
+        self.assertNotIsInstance(root, UnsampledSpan)
+
+
+class TestRespectParentSampling(unittest.TestCase):
+    def setUp(self):
+        self.m_client = Mock()
+        self.m_client.sample_rate = 10
+        self.tracer = SynchronousTracer(self.m_client)
+        self.tracer.respect_parent_sampling = True
+
+    def _start_trace(self, traceflags):
+        request = DictRequest({
+            'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-' + traceflags})
+        self.tracer.http_trace_parser_hook = w3c.http_trace_parser_hook
+        return self.tracer.propagate_and_start_trace({'name': 'root'}, request)
+
+    def test_unsampled_parent(self):
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            root = self._start_trace('00')
+            child = self.tracer.start_span(context={'name': 'child'})
+            self.tracer.add_context_field('big', 'important_stuff')
+
+            # the flag is passed on unchanged
+            pc = self.tracer.get_propagation_context()
+            self.assertIs(pc.sampled, False)
+            self.assertEqual(w3c.marshal_traceparent(pc)[-3:], '-00')
+
+            self.tracer.finish_span(child)
+            self.tracer.finish_trace(root)
+            m_sample_fn.assert_not_called()
+
+        self.assertIsInstance(root, UnsampledSpan)
+        self.assertIsInstance(child, UnsampledSpan)
+        self.assertEqual(root.parent_id, 'b7ad6b7169203331')
+        self.m_client.new_event.assert_not_called()
+
+    def test_sampled_parent(self):
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = True
+            root = self._start_trace('01')
+            self.assertIs(self.tracer.get_propagation_context().sampled, True)
+            self.tracer.finish_trace(root)
+            m_sample_fn.assert_called_once_with('0af7651916cd43dd8448eb211c80319c', 10)
+
+        self.assertNotIsInstance(root, UnsampledSpan)
+        root.event.send_presampled.assert_called_once_with()
+
+    def test_sampled_parents_sampled_at_sample_rate(self):
+        self.tracer.http_trace_parser_hook = w3c.http_trace_parser_hook
+        trace_ids = [f"{i:032x}" for i in range(1, 201)]
+        sent = 0
+        for trace_id in trace_ids:
+            self.m_client.new_event.reset_mock()
+            request = DictRequest({'traceparent': f'00-{trace_id}-b7ad6b7169203331-01'})
+            root = self.tracer.propagate_and_start_trace({'name': 'root'}, request)
+            self.assertIs(self.tracer.get_propagation_context().sampled, True)
+            self.tracer.finish_trace(root)
+            if self.m_client.new_event.called:
+                sent += 1
+                root.event.send_presampled.assert_called_once_with()
+
+        # the same traces as without the upstream's decision are sent
+        self.assertEqual(sent, sum(_should_sample(trace_id, 10) for trace_id in trace_ids))
+        self.assertLess(sent, 50)
+
+    def test_parent_without_decision(self):
+        self.tracer.http_trace_parser_hook = honeycomb.http_trace_parser_hook
+        request = DictRequest({'X-Honeycomb-Trace': '1;trace_id=bloop,parent_id=scoop,context=e30K'})
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = False
+            root = self.tracer.propagate_and_start_trace({'name': 'root'}, request)
+            self.assertIsNone(self.tracer.get_propagation_context().sampled)
+            self.tracer.finish_trace(root)
+            m_sample_fn.assert_called_once_with('bloop', 10)
+
+    def test_off_by_default(self):
+        self.tracer.respect_parent_sampling = False
+        with patch('beeline.trace._should_sample') as m_sample_fn:
+            m_sample_fn.return_value = True
+            root = self._start_trace('00')
+            self.assertIsNone(self.tracer.get_propagation_context().sampled)
+            self.tracer.finish_trace(root)
+            m_sample_fn.assert_called_once_with(root.trace_id, 10)
+        root.event.send_presampled.assert_called_once_with()
+
 
 class TestTraceContext(unittest.TestCase):
     def test_marshal_trace_context(self):
@@ -608,18 +957,32 @@ class TestTraceContext(unittest.TestCase):
 
 class TestSpan(unittest.TestCase):
     def test_span_context(self):
-        ev = Event()
-        span = Span('', '', '', ev)
+        span = Span('', '', '')
         span.add_context_field("some", "value")
         span.add_context({"another": "value"})
         self.assertDictEqual({
             "some": "value",
             "another": "value"
-        }, ev.fields())
+        }, span.fields)
         span.remove_context_field("another")
         self.assertDictEqual({
             "some": "value",
-        }, ev.fields())
+        }, span.fields)
+        # removing a missing field is a no-op
+        span.remove_context_field("another")
+        self.assertIsNone(span.event)
+
+    def test_span_rollup_fields_allocated_lazily(self):
+        span = Span('', '', '')
+        self.assertIsNone(span.rollup_fields)
+        span.add_rollup_field("calories", 1)
+        span.add_rollup_field("calories", 2.5)
+        self.assertEqual(span.rollup_fields, {"calories": 3.5})
+
+    def test_span_has_no_instance_dict(self):
+        span = Span('', '', '')
+        with self.assertRaises(AttributeError):
+            setattr(span, 'unexpected', True)
 
 
 class TestPropagationHooks(unittest.TestCase):
@@ -629,9 +992,8 @@ class TestPropagationHooks(unittest.TestCase):
 
         # implicitly tests finish_span
         m_client = Mock()
-        # these values are used before sending
-        m_client.new_event.return_value.start_time = datetime.datetime.now()
-        m_client.new_event.return_value.sample_rate = 1
+        # used for deterministic sampling before the event is built
+        m_client.sample_rate = 1
         tracer = SynchronousTracer(m_client)
 
         header_value = '1;dataset=flibble,trace_id=bloop,parent_id=scoop,context=e30K'
@@ -660,9 +1022,8 @@ class TestPropagationHooks(unittest.TestCase):
 
         # implicitly tests finish_span
         m_client = Mock()
-        # these values are used before sending
-        m_client.new_event.return_value.start_time = datetime.datetime.now()
-        m_client.new_event.return_value.sample_rate = 1
+        # used for deterministic sampling before the event is built
+        m_client.sample_rate = 1
         tracer = SynchronousTracer(m_client)
 
         header_value = '1;dataset=flibble,trace_id=bloop,parent_id=scoop,context=e30K'
@@ -691,9 +1052,8 @@ class TestPropagationHooks(unittest.TestCase):
     def test_propagate_and_start_trace_uses_w3c_header_as_fallback(self):
         # implicitly tests finish_span
         m_client = Mock()
-        # these values are used before sending
-        m_client.new_event.return_value.start_time = datetime.datetime.now()
-        m_client.new_event.return_value.sample_rate = 1
+        # used for deterministic sampling before the event is built
+        m_client.sample_rate = 1
         tracer = SynchronousTracer(m_client)
 
         header_value = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00'
@@ -717,9 +1077,8 @@ class TestPropagationHooks(unittest.TestCase):
     def test_propagate_and_start_trace_uses_honeycomb_header_when_w3c_also_present(self):
         # implicitly tests finish_span
         m_client = Mock()
-        # these values are used before sending
-        m_client.new_event.return_value.start_time = datetime.datetime.now()
-        m_client.new_event.return_value.sample_rate = 1
+        # used for deterministic sampling before the event is built
+        m_client.sample_rate = 1
         tracer = SynchronousTracer(m_client)
 
         w3c_value = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00'
@@ -752,9 +1111,7 @@ class TestPropagationHooks(unittest.TestCase):
 
         # implicitly tests finish_span
         m_client = Mock()
-        # these values are used before sending
-        m_client.new_event.return_value.start_time = datetime.datetime.now()
-        m_client.new_event.return_value.sample_rate = 99
+        m_client.sample_rate = 99
         tracer = SynchronousTracer(m_client)
         tracer.register_hooks(http_trace_parser=error_parser)
 
@@ -769,5 +1126,5 @@ class TestPropagationHooks(unittest.TestCase):
 
         # Verify that our new span is at the top of the stack
         self.assertEqual(tracer._trace.stack[0], span)
-        # Verify that we got the event in the mock.
-        self.assertEqual(span.event.sample_rate, 99)
+        # Verify that the parser error was recorded on the new root span.
+        self.assertIn('parser_hook_error', span.fields)
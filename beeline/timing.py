@@ -0,0 +1,39 @@
+''' Span timing helpers.
+
+Spans are timed with the high resolution, monotonic `time.perf_counter_ns`
+clock, so durations stay correct when the system clock is stepped or slewed.
+A wall-clock timestamp is only derived once, when an event is sent.
+'''
+import datetime
+import time
+
+# how long a pairing of the wall clock and the monotonic clock is trusted
+# before it is taken again, to bound drift between the two clocks
+_REANCHOR_NS = 60 * 1000 * 1000 * 1000
+
+now_ns = time.perf_counter_ns
+
+
+def _take_anchor():
+    return datetime.datetime.utcnow(), time.perf_counter_ns()
+
+
+_anchor = _take_anchor()
+
+
+def elapsed_ms(start_ns, end_ns=None):
+    ''' Returns the milliseconds between two `now_ns` readings. If `end_ns` is
+    not given, measures up to now. '''
+    if end_ns is None:
+        end_ns = now_ns()
+    return (end_ns - start_ns) / 1000000.0
+
+
+def to_datetime(mono_ns):
+    ''' Converts a `now_ns` reading to a naive UTC datetime, which is what
+    libhoney expects for an event's `created_at`. '''
+    global _anchor
+    wall, anchor_ns = _anchor
+    if mono_ns - anchor_ns > _REANCHOR_NS:
+        _anchor = wall, anchor_ns = _take_anchor()
+    return wall + datetime.timedelta(microseconds=(mono_ns - anchor_ns) // 1000)
@@ -1,27 +1,30 @@
 import base64
 import copy
-import datetime
 import functools
 import hashlib
 import json
 import math
+import os
 import random
 import struct
 import sys
 import threading
 import traceback
 import inspect
+from abc import ABCMeta, abstractmethod
 from collections import defaultdict
 
 from contextlib import contextmanager
 
 from beeline.internal import log, stringify_exception
+from beeline import timing
 
 import beeline.propagation
 import beeline.propagation.default
 import beeline.propagation.honeycomb
 
 MAX_INT32 = math.pow(2, 32) - 1
+MAX_INT64 = math.pow(2, 64) - 1
 SPAN_ID_BYTES = 8
 TRACE_ID_BYTES = 16
 
@@ -29,20 +32,85 @@ TRACE_ID_BYTES = 16
 class Trace(object):
     '''Object encapsulating all state of an ongoing trace.'''
 
+    __slots__ = ('id', 'dataset', 'stack', 'fields', 'rollup_fields', 'sampled',
+                 'parent_sampled', '_fields_shared', '_propagated_fields', '_encoded_fields')
+
     def __init__(self, trace_id, dataset=None):
         self.id = trace_id
         self.dataset = dataset
         self.stack = []
         self.fields = {}
         self.rollup_fields = defaultdict(float)
+        # deterministic sampling verdict, cached the first time a span is
+        # finished, or when the trace starts with head sampling
+        self.sampled = None
+        # the upstream sampling decision, if the trace was continued from one
+        # that carried it and the tracer respects it. Propagated downstream.
+        self.parent_sampled = None
+        # set once `fields` has been handed out by `snapshot_fields`, after
+        # which it is copied before being changed
+        self._fields_shared = False
+        # the fields to propagate, and their encoding for propagation
+        # headers, cached until the fields change
+        self._propagated_fields = None
+        self._encoded_fields = None
 
     def copy(self):
         '''Copy the trace state for use in another thread or context.'''
         result = Trace(self.id)
         result.stack = copy.copy(self.stack)
         result.fields = copy.copy(self.fields)
+        result.sampled = self.sampled
+        result.parent_sampled = self.parent_sampled
         return result
 
+    def snapshot_fields(self):
+        '''Returns the current trace fields. Every span started until the
+        fields next change shares the same dict, so the snapshot's identity
+        doubles as its version. It must not be modified.'''
+        self._fields_shared = True
+        return self.fields
+
+    def add_field(self, key, value):
+        if self._fields_shared:
+            self.fields = self.fields.copy()
+            self._fields_shared = False
+        self.fields[key] = value
+        self._propagated_fields = None
+        self._encoded_fields = None
+
+    def remove_field(self, key):
+        if self._fields_shared:
+            self.fields = self.fields.copy()
+            self._fields_shared = False
+        self.fields.pop(key)
+        self._propagated_fields = None
+        self._encoded_fields = None
+
+    def propagated_fields(self, policy=None):
+        '''Returns the trace fields to propagate downstream, filtered by
+        `policy`, a `beeline.propagation.PropagationPolicy`, if set. Cached
+        until the fields change.'''
+        if self._propagated_fields is None:
+            self._propagated_fields = policy.filter(self.fields) if policy else self.fields
+        return self._propagated_fields
+
+    def encode_fields(self, fields, encoder=None):
+        '''Returns `fields` encoded for propagation headers by `encoder`,
+        `beeline.propagation.encode_trace_fields` by default. The encodings
+        of this trace's `propagated_fields` are cached, one per encoder,
+        until the fields change.'''
+        if encoder is None:
+            encoder = beeline.propagation.encode_trace_fields
+        if fields is not self._propagated_fields:
+            return encoder(fields)
+        if self._encoded_fields is None:
+            self._encoded_fields = {}
+        encoded = self._encoded_fields.get(encoder)
+        if encoded is None:
+            encoded = self._encoded_fields[encoder] = encoder(fields)
+        return encoded
+
 
 class Tracer(object):
     def __init__(self, client):
@@ -50,6 +118,21 @@ class Tracer(object):
 
         self.presend_hook = None
         self.sampler_hook = None
+        # decide deterministic sampling once, when the trace starts
+        self.head_sampling = False
+        # take the sampling decision of the upstream service, when the
+        # propagation format carries one
+        self.respect_parent_sampling = False
+        # a function (trace_id, sample_rate) -> bool. Defaults to the SHA1
+        # based _should_sample shared with the other beelines
+        self.deterministic_sampler = None
+        # a beeline.batch.BatchHookWorker, if batch hooks are set
+        self.batch_worker = None
+        # a beeline.tail_sampling.TraceBuffer, to sample whole traces
+        self.trace_buffer = None
+        # a beeline.propagation.PropagationPolicy, to limit the trace fields
+        # sent downstream
+        self.propagation_policy = None
         self.http_trace_parser_hook = beeline.propagation.default.http_trace_parser_hook
         self.http_trace_propagation_hook = beeline.propagation.default.http_trace_propagation_hook
 
@@ -71,7 +154,7 @@ class Tracer(object):
                         span.trace_id)
             yield span
         except Exception as e:
-            if span:
+            if span and span.sampled:
                 span.add_context({
                     "app.exception_type": str(type(e)),
                     "app.exception_string": stringify_exception(e),
@@ -91,7 +174,8 @@ class Tracer(object):
             else:
                 log('tracer context manager span for %s was unexpectedly None', name)
 
-    def start_trace(self, context=None, trace_id=None, parent_span_id=None, dataset=None):
+    def start_trace(self, context=None, trace_id=None, parent_span_id=None, dataset=None,
+                    parent_sampled=None):
         if trace_id:
             if self._trace:
                 log('warning: start_trace got explicit trace_id but we are already in a trace. '
@@ -100,6 +184,18 @@ class Tracer(object):
         else:
             self._trace = Trace(generate_trace_id(), dataset)
 
+        if self.respect_parent_sampling and parent_sampled is not None:
+            self._trace.parent_sampled = parent_sampled
+        if self._trace.parent_sampled is False:
+            # the upstream service dropped the trace, so it takes the
+            # no-record path for all its spans. Traces it kept are still
+            # sampled at `sample_rate`, which their events are sent with.
+            self._trace.sampled = False
+        # a sampler hook needs each event's fields, so it can't be applied
+        # at the head of the trace
+        elif self.head_sampling and not self._defers_sampling():
+            self._trace.sampled = self._deterministic_sample(self._trace.id)
+
         # start the root span
         return self.start_span(context=context, parent_id=parent_span_id, is_root_span=True)
 
@@ -113,62 +209,78 @@ class Tracer(object):
             parent_span_id = parent_id
         else:
             parent_span_id = self._trace.stack[-1].id if self._trace.stack else None
-        ev = self._client.new_event(data=self._trace.fields)
-        if context:
-            ev.add(data=context)
-
-        fields = {
-            'trace.trace_id': self._trace.id,
-            'trace.parent_id': parent_span_id,
-            'trace.span_id': span_id,
-        }
+
+        is_root = len(self._trace.stack) == 0
+        if self._trace.sampled is False:
+            # keep the IDs so propagation still works, but record nothing
+            span = UnsampledSpan(trace_id=self._trace.id, parent_id=parent_span_id,
+                                 id=span_id, is_root=is_root)
+            self._trace.stack.append(span)
+            return span
+
+        # fields are collected on the span itself; the libhoney event is only
+        # built in finish_span, once we know the span is going to be sent.
+        # Trace fields aren't copied in, the span just keeps the snapshot.
+        fields = dict(context) if context else {}
+
+        fields['trace.trace_id'] = self._trace.id
+        fields['trace.parent_id'] = parent_span_id
+        fields['trace.span_id'] = span_id
         if is_root_span:
             spanType = "root"
             if parent_span_id:
                 spanType = "subroot"
             fields['meta.span_type'] = spanType
-        ev.add(data=fields)
 
-        is_root = len(self._trace.stack) == 0
         span = Span(trace_id=self._trace.id, parent_id=parent_span_id,
-                    id=span_id, event=ev, is_root=is_root)
+                    id=span_id, fields=fields, trace_fields=self._trace.snapshot_fields(),
+                    is_root=is_root)
         self._trace.stack.append(span)
 
         return span
 
-    def finish_span(self, span):
+    def finish_span(self, span, end_time=None):
+        ''' Sends the span, unless it is sampled out, and pops it off the
+        trace's stack. `end_time` is a `timing.now_ns()` reading, for spans
+        recorded after the fact; it defaults to now. '''
         # avoid exception if called with None
         if span is None:
             return
 
-        # send the span's event. Even if the stack is in an unhealthy state,
-        # it's probably better to send event data than not
-        if span.event:
+        # spans in a trace dropped by head sampling have nothing to send, and
+        # spans dropped by deterministic sampling never build their fields or
+        # an event. If a sampler hook or trace buffer is set it makes the
+        # decision instead, and needs the event's fields to do so.
+        if span.sampled and (self._defers_sampling() or self._should_sample_span(span)):
+            # send the span's event. Even if the stack is in an unhealthy state,
+            # it's probably better to send event data than not
+            dataset = None
             if self._trace:
-                if self._trace.dataset:
-                    span.event.dataset = self._trace.dataset
+                dataset = self._trace.dataset
+
+                # propagate trace fields that may have been added in later spans
+                span.merge_trace_fields(self._trace.fields)
 
                 # add the trace's rollup fields to the root span
                 if span.is_root():
-                    for k, v in self._trace.rollup_fields.items():
-                        span.event.add_field(k, v)
-
-                for k, v in span.rollup_fields.items():
-                    span.event.add_field(k, v)
+                    span.fields.update(self._trace.rollup_fields)
 
-                # propagate trace fields that may have been added in later spans
-                for k, v in self._trace.fields.items():
-                    # don't overwrite existing values because they may be different
-                    if k not in span.event.fields():
-                        span.event.add_field(k, v)
+                if span.rollup_fields:
+                    span.fields.update(span.rollup_fields)
+            else:
+                span.merge_trace_fields()
 
-            duration = datetime.datetime.now() - span.event.start_time
-            duration_ms = duration.total_seconds() * 1000.0
-            span.event.add_field('duration_ms', duration_ms)
+            span.fields['duration_ms'] = timing.elapsed_ms(span.start_time, end_time)
 
-            self._run_hooks_and_send(span)
-        else:
-            log('warning: span has no event, was it initialized correctly?')
+            if self.trace_buffer:
+                # held until the root span finishes and the trace is sampled
+                for buffered, sample_rate in self.trace_buffer.add(span):
+                    buffered.event = self._new_event(buffered, dataset)
+                    buffered.event.sample_rate = sample_rate
+                    self._run_hooks_and_send(buffered)
+            else:
+                span.event = self._new_event(span, dataset)
+                self._run_hooks_and_send(span)
 
         if not self._trace:
             log('warning: span finished without an active trace')
@@ -211,7 +323,8 @@ class Tracer(object):
         if propagation_context:
             return self.start_trace(context=context, trace_id=propagation_context.trace_id,
                                     parent_span_id=propagation_context.parent_id,
-                                    dataset=propagation_context.dataset)
+                                    dataset=propagation_context.dataset,
+                                    parent_sampled=propagation_context.sampled)
             for k, v in propagation_context.trace_fields:
                 self.add_trace_field(k, v)
         else:
@@ -228,7 +341,9 @@ class Tracer(object):
         return beeline.propagation.PropagationContext(
             self.get_active_trace_id(),
             self.get_active_span().id,
-            self._trace.fields)
+            self._trace.propagated_fields(self.propagation_policy),
+            trace=self._trace,
+            sampled=self._trace.parent_sampled)
 
     def get_active_trace_id(self):
         if self._trace:
@@ -256,11 +371,14 @@ class Tracer(object):
             span.remove_context_field(name=name)
 
     def add_rollup_field(self, name, value):
+        if self._trace and self._trace.sampled is False:
+            return
+
         value = float(value)
 
         span = self.get_active_span()
         if span:
-            span.rollup_fields[name] += value
+            span.add_rollup_field(name, value)
 
         if not self._trace:
             log('warning: adding rollup field without an active trace')
@@ -283,7 +401,7 @@ class Tracer(object):
         if not self._trace:
             log('warning: adding trace field without an active trace')
             return
-        self._trace.fields[key] = value
+        self._trace.add_field(key, value)
 
     def remove_trace_field(self, name):
         key = f"app.{name}"
@@ -291,7 +409,7 @@ class Tracer(object):
         if not self._trace:
             log('warning: removing trace field without an active trace')
             return
-        self._trace.fields.pop(key)
+        self._trace.remove_field(key)
 
     def marshal_trace_context(self):
         if not self._trace:
@@ -301,7 +419,7 @@ class Tracer(object):
         return marshal_trace_context(
             self._trace.id,
             self._trace.stack[-1].id,
-            self._trace.fields
+            self._trace.propagated_fields(self.propagation_policy)
         )
 
     def register_hooks(self, presend=None, sampler=None, http_trace_parser=None, http_trace_propagation=None):
@@ -310,9 +428,48 @@ class Tracer(object):
         self.http_trace_parser_hook = http_trace_parser
         self.http_trace_propagation_hook = http_trace_propagation
 
+    def is_sampled(self):
+        '''Returns False if the active trace is known to be dropped by
+        deterministic sampling, in which case there is no point collecting
+        fields for it.'''
+        return self._trace is None or self._trace.sampled is not False
+
+    def _defers_sampling(self):
+        ''' internal - whether sampling is decided from the events' fields,
+        in which case deterministic sampling isn't applied '''
+        return bool(self.sampler_hook or self.trace_buffer or
+                    (self.batch_worker and self.batch_worker.sampler_hook))
+
+    def _deterministic_sample(self, trace_id):
+        sampler = self.deterministic_sampler or _should_sample
+        return sampler(trace_id, self._client.sample_rate)
+
+    def _should_sample_span(self, span):
+        ''' internal - deterministic sampling verdict for a finished span. The
+        verdict is the same for every span in a trace, so it is cached on the
+        trace. '''
+        trace = self._trace
+        if trace is None or trace.id != span.trace_id:
+            return self._deterministic_sample(span.trace_id)
+        if trace.sampled is None:
+            trace.sampled = self._deterministic_sample(trace.id)
+        return trace.sampled
+
+    def _new_event(self, span, dataset=None):
+        ''' internal - build the libhoney event for a finished span '''
+        ev = self._client.new_event(data=span.fields)
+        # the event would otherwise be stamped with the time it was built
+        ev.created_at = timing.to_datetime(span.start_time)
+        if dataset:
+            ev.dataset = dataset
+        return ev
+
     def _run_hooks_and_send(self, span):
         ''' internal - run any defined hooks on the event and send
 
+        Deterministic sampling has already been applied by `finish_span` when
+        no sampler hook is set, so events that reach here are sent.
+
         kind of hacky: we fetch the hooks from the beeline, but they are only
         used here. Pass them to the tracer implementation?
         '''
@@ -331,12 +488,13 @@ class Tracer(object):
             log("executing presend hook on event ev = %s", span.event.fields())
             self.presend_hook(span.event.fields())
 
+        if self.batch_worker:
+            self.batch_worker.send(span.event)
+            return
+
         if presampled:
             log("enqueuing presampled event ev = %s", span.event.fields())
-            span.event.send_presampled()
-        elif _should_sample(span.trace_id, span.event.sample_rate):
-            # if our sampler hook wasn't used, use deterministic sampling
-            span.event.send_presampled()
+        span.event.send_presampled()
 
 
 class SynchronousTracer(Tracer):
@@ -355,31 +513,107 @@ class SynchronousTracer(Tracer):
 
 class Span(object):
     ''' Span represents an active span. Should not be initialized directly, but
-    through a Tracer object's `start_span` method. '''
+    through a Tracer object's `start_span` method.
 
-    def __init__(self, trace_id, parent_id, id, event, is_root=False):
+    Fields are collected in a plain dict. `trace_fields` is the snapshot of
+    the trace fields taken when the span started; it is shared with other
+    spans and only merged into `fields` once the span is finished and
+    survives sampling. `event` stays None until then, at which point the
+    tracer builds the libhoney event from `fields`. '''
+
+    __slots__ = ('trace_id', 'parent_id', 'id', 'fields', 'trace_fields', 'event',
+                 'start_time', 'rollup_fields', '_is_root')
+
+    sampled = True
+
+    def __init__(self, trace_id, parent_id, id, fields=None, trace_fields=None, is_root=False):
         self.trace_id = trace_id
         self.parent_id = parent_id
         self.id = id
-        self.event = event
-        self.event.start_time = datetime.datetime.now()
-        self.rollup_fields = defaultdict(float)
+        self.fields = fields if fields is not None else {}
+        self.trace_fields = trace_fields
+        self.event = None
+        # a monotonic timing.now_ns() reading; see timing.to_datetime
+        self.start_time = timing.now_ns()
+        # most spans never roll anything up; allocated on first use
+        self.rollup_fields = None
         self._is_root = is_root
 
     def add_context_field(self, name, value):
-        self.event.add_field(name, value)
+        self.fields[name] = value
 
     def add_context(self, data):
-        self.event.add(data)
+        self.fields.update(data)
 
     def remove_context_field(self, name):
-        if name in self.event.fields():
-            del self.event.fields()[name]
+        if self.trace_fields and name in self.trace_fields:
+            # the snapshot is shared, so take our own copy to remove it from
+            self.merge_trace_fields()
+        self.fields.pop(name, None)
+
+    def add_rollup_field(self, name, value):
+        if self.rollup_fields is None:
+            self.rollup_fields = defaultdict(float)
+        self.rollup_fields[name] += value
+
+    def merge_trace_fields(self, current=None):
+        ''' Merges the trace fields into `fields`. The span's own fields take
+        precedence over the snapshot taken when it started, which takes
+        precedence over `current`, the trace fields as they are now. '''
+        snapshot = self.trace_fields
+        if current is snapshot:
+            current = None
+        if not current and not snapshot:
+            return
+        fields = {}
+        if current:
+            fields.update(current)
+        if snapshot:
+            fields.update(snapshot)
+        fields.update(self.fields)
+        self.fields = fields
+        self.trace_fields = None
 
     def is_root(self):
         return self._is_root
 
 
+class UnsampledSpan(Span):
+    ''' UnsampledSpan is started in place of a Span once the trace is known to
+    be dropped by deterministic sampling. It keeps its IDs so that trace propagation
+    still works, but records no fields and is never sent. '''
+
+    __slots__ = ()
+
+    sampled = False
+
+    def __init__(self, trace_id, parent_id, id, is_root=False):  # pylint: disable=super-init-not-called
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.id = id
+        self.fields = None
+        self.trace_fields = None
+        self.event = None
+        self.start_time = None
+        self.rollup_fields = None
+        self._is_root = is_root
+
+    def add_context_field(self, name, value):
+        pass
+
+    def add_context(self, data):
+        pass
+
+    def remove_context_field(self, name):
+        pass
+
+    def add_rollup_field(self, name, value):
+        pass
+
+
+_HEX_DIGITS = '0123456789abcdefABCDEF'
+
+
 def _should_sample(trace_id, sample_rate):
     # Always return True if sample rate is 1
     if sample_rate == 1:
@@ -396,6 +630,27 @@ def _should_sample(trace_id, sample_rate):
     return False
 
 
+def trace_id_ratio_sampler(trace_id, sample_rate):
+    '''
+    Deterministic sampler that uses the low 64 bits of a hex trace ID as the
+    random value, the same way as OpenTelemetry's TraceIdRatioBased sampler.
+    It is much cheaper than hashing, but only makes the same decisions as
+    other services that sample on the trace ID bits, not other beelines.
+    Falls back to _should_sample for trace IDs that don't end in 16 hex
+    digits.
+
+    Use it by passing `deterministic_sampler=trace_id_ratio_sampler` to `init`.
+    '''
+    if sample_rate == 1:
+        return True
+
+    suffix = trace_id[-16:]
+    # int() would also take a sign, underscores and whitespace
+    if len(suffix) != 16 or suffix.strip(_HEX_DIGITS):
+        return _should_sample(trace_id, sample_rate)
+    return int(suffix, 16) < MAX_INT64 / sample_rate
+
+
 def marshal_trace_context(trace_id, parent_id, context):
     """Deprecated: Use beeline.propagation.honeycomb.marshal_trace_context instead"""
     version = 1
@@ -435,14 +690,88 @@ def traced_impl(tracer_fn, name, trace_id, parent_id):
 # Use system random instead of default psuedorandom generator
 system_random = random.SystemRandom()
 
+_SPAN_ID_FORMAT = "{{:0{:d}x}}".format(SPAN_ID_BYTES*2)  # pylint: disable=C0209
+_TRACE_ID_FORMAT = "{{:0{:d}x}}".format(TRACE_ID_BYTES*2)  # pylint: disable=C0209
+
+
+class IdGenerator(object, metaclass=ABCMeta):
+    '''
+    IdGenerator is the interface for generating trace and span IDs. Register an
+    implementation with `set_id_generator`. IDs should be lowercase hex strings
+    of SPAN_ID_BYTES and TRACE_ID_BYTES bytes to be compatible with the w3c
+    tracing spec.
+    '''
+
+    @abstractmethod
+    def generate_span_id(self):
+        pass
+
+    @abstractmethod
+    def generate_trace_id(self):
+        pass
+
+
+class RandomIdGenerator(IdGenerator):
+    '''
+    The default IdGenerator. Uses a pseudorandom generator seeded from
+    os.urandom, rather than reading os.urandom for every ID. Forked child
+    processes reseed, so they don't repeat their parent's IDs.
+    '''
+
+    def __init__(self):
+        self._random = random.Random()
+        self.reseed()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reseed)
+
+    def reseed(self):
+        self._random.seed(os.urandom(32))
+
+    def generate_span_id(self):
+        # an all-zero ID is invalid in the w3c spec
+        bits = 0
+        while not bits:
+            bits = self._random.getrandbits(SPAN_ID_BYTES*8)
+        return _SPAN_ID_FORMAT.format(bits)
+
+    def generate_trace_id(self):
+        bits = 0
+        while not bits:
+            bits = self._random.getrandbits(TRACE_ID_BYTES*8)
+        return _TRACE_ID_FORMAT.format(bits)
+
+
+class SystemRandomIdGenerator(IdGenerator):
+    '''
+    IdGenerator that reads os.urandom for every ID. This was the behavior
+    before RandomIdGenerator became the default.
+    '''
+
+    def generate_span_id(self):
+        return _SPAN_ID_FORMAT.format(system_random.getrandbits(SPAN_ID_BYTES*8))
+
+    def generate_trace_id(self):
+        return _TRACE_ID_FORMAT.format(system_random.getrandbits(TRACE_ID_BYTES*8))
+
+
+_id_generator = RandomIdGenerator()
+
+
+def set_id_generator(id_generator):
+    """Register the IdGenerator used for all new trace and span IDs."""
+    global _id_generator
+    _id_generator = id_generator
+
+
+def get_id_generator():
+    return _id_generator
+
 
 def generate_span_id():
     """Generate span ID compatible with w3c tracing spec."""
-    format_str = "{{:0{:d}x}}".format(SPAN_ID_BYTES*2)  # pylint: disable=C0209
-    return format_str.format(system_random.getrandbits(SPAN_ID_BYTES*8))
+    return _id_generator.generate_span_id()
 
 
 def generate_trace_id():
     """Generate trace ID compatible with w3c tracing spec."""
-    format_str = "{{:0{:d}x}}".format(TRACE_ID_BYTES*2)  # pylint: disable=C0209
-    return format_str.format(system_random.getrandbits(TRACE_ID_BYTES*8))
+    return _id_generator.generate_trace_id()